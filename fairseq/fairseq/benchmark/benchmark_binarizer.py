@@ -0,0 +1,182 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compare the preprocessing throughput of VocabularyDatasetBinarizer and
+FastVocabularyDatasetBinarizer on a synthetic corpus, e.g.:
+
+    python -m fairseq.benchmark.benchmark_binarizer --num-lines 200000 --workers 8
+
+For each binarizer we also report what every worker has to unpickle before it
+can start (the binarizer and its dictionary, or a DictionaryHashTable handle
+when the dictionary is shared) and the peak RSS of the workers.
+"""
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import pickle
+import random
+import resource
+import tempfile
+import time
+
+import numpy as np
+
+from fairseq.binarizer import (
+    FastVocabularyDatasetBinarizer,
+    FileBinarizer,
+    VocabularyDatasetBinarizer,
+)
+from fairseq.data import Dictionary, indexed_dataset
+
+
+def make_corpus(path, num_lines, vocab_size, duplication_n, duplication_k, seed):
+    rng = random.Random(seed)
+    symbols = [f"tok{i}@@" if i % 3 else f"tok{i}" for i in range(vocab_size)]
+    # mimic the duplicated vocabularies of duplication_bpe: the top n symbols
+    # get k extra variants carrying a 複複k複複 marker
+    variants = {
+        sym: [f"複複{k}複複{sym}" for k in range(1, duplication_k + 1)]
+        for sym in symbols[:duplication_n]
+    }
+    cum_weights = list(
+        itertools.accumulate(1.0 / (rank + 1) for rank in range(vocab_size))
+    )
+
+    dictionary = Dictionary()
+    for sym in symbols:
+        dictionary.add_symbol(sym)
+        for variant in variants.get(sym, []):
+            dictionary.add_symbol(variant)
+    dictionary.finalize()
+
+    with open(path, "w", encoding="utf-8") as f:
+        for _ in range(num_lines):
+            words = rng.choices(symbols, cum_weights=cum_weights, k=rng.randint(5, 60))
+            words = [
+                rng.choice(variants[w]) if w in variants and rng.random() < 0.5 else w
+                for w in words
+            ]
+            print(" ".join(words), file=f)
+    return dictionary
+
+
+def _run_binarizer(binarizer, input_file, output_prefix, vocab_size, workers, queue):
+    # forked workers start with our resident pages, only count what they add
+    base_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    start = time.perf_counter()
+    summary = FileBinarizer.multiprocess_dataset(
+        input_file,
+        "mmap",
+        binarizer,
+        output_prefix,
+        vocab_size=vocab_size,
+        num_workers=workers,
+    )
+    elapsed = time.perf_counter() - start
+    # the pool workers have been joined, so they count as our children
+    max_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    queue.put((elapsed, summary, max_rss_mb - base_rss_mb))
+
+
+def time_binarizer(binarizer, input_file, output_prefix, vocab_size, workers):
+    """run in a fresh process so that the children RSS is only for this run"""
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(
+        target=_run_binarizer,
+        args=(binarizer, input_file, output_prefix, vocab_size, workers, queue),
+    )
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def worker_startup(binarizer, path):
+    """size and unpickling time of what is sent to every worker"""
+    if isinstance(binarizer, FastVocabularyDatasetBinarizer) and (
+        binarizer.shared_dictionary
+    ):
+        binarizer = binarizer.share_dictionary(path)
+    payload = pickle.dumps(binarizer)
+    start = time.perf_counter()
+    pickle.loads(payload)
+    elapsed = time.perf_counter() - start
+    if getattr(binarizer, "table", None) is not None:
+        binarizer.table.remove()
+    return len(payload), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-lines", type=int, default=100000)
+    parser.add_argument("--vocab-size", type=int, default=10000)
+    parser.add_argument("--duplication-n", type=int, default=100)
+    parser.add_argument("--duplication-k", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dirname:
+        input_file = os.path.join(dirname, "train.txt")
+        dictionary = make_corpus(
+            input_file,
+            args.num_lines,
+            args.vocab_size,
+            args.duplication_n,
+            args.duplication_k,
+            args.seed,
+        )
+        size_mb = os.path.getsize(input_file) / 2**20
+        print(
+            f"corpus: {args.num_lines} lines, {size_mb:.1f}MB, "
+            f"{len(dictionary)} types, {args.workers} workers"
+        )
+
+        results = {}
+        for name, binarizer in [
+            ("default", VocabularyDatasetBinarizer(dictionary)),
+            (
+                "fast-private",
+                FastVocabularyDatasetBinarizer(dictionary, shared_dictionary=False),
+            ),
+            ("fast", FastVocabularyDatasetBinarizer(dictionary)),
+        ]:
+            prefix = os.path.join(dirname, name)
+            timings, max_rss = [], []
+            for _ in range(args.repeat):
+                elapsed, summary, rss = time_binarizer(
+                    binarizer, input_file, prefix, len(dictionary), args.workers
+                )
+                timings.append(elapsed)
+                max_rss.append(rss)
+            best = min(timings)
+            results[name] = best
+            payload, unpickle = worker_startup(binarizer, prefix + ".startup")
+            print(
+                f"{name:>12}: {best:.2f}s, {summary.num_seq / best:,.0f} lines/s, "
+                f"{summary.num_tok / best:,.0f} tokens/s ({summary})\n"
+                f"{'':>12}  per worker: {payload:,}B task payload, "
+                f"{unpickle * 1000:.1f}ms to unpickle, "
+                f"+{max(max_rss):,.1f}MB peak RSS"
+            )
+
+        default_ds = indexed_dataset.MMapIndexedDataset(
+            os.path.join(dirname, "default")
+        )
+        fast_ds = indexed_dataset.MMapIndexedDataset(os.path.join(dirname, "fast"))
+        assert np.array_equal(default_ds.sizes, fast_ds.sizes)
+        assert all(
+            np.array_equal(default_ds[i].numpy(), fast_ds[i].numpy())
+            for i in range(len(default_ds))
+        ), "binarizers disagree"
+        print(f"     speedup: {results['default'] / results['fast']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compare the time to fetch and collate a batch of a LanguagePairDataset with
+per-sample reads and :func:`collate`, and with :meth:`__getitems__`, which
+gathers each side from the MMapIndexedDataset buffer in one go, e.g.:
+
+    python -m fairseq.benchmark.benchmark_collate --max-tokens 4096
+
+A binarized dataset can be given with ``--data`` (and ``-s``/``-t``),
+otherwise a synthetic one is used.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from fairseq.data import Dictionary, LanguagePairDataset, data_utils, indexed_dataset
+
+
+def make_dataset(dirname, num_sentences, vocab_size, seed):
+    rng = np.random.RandomState(seed)
+    dictionary = Dictionary()
+    for i in range(vocab_size):
+        dictionary.add_symbol(str(i))
+    datasets = []
+    for side in ["src", "tgt"]:
+        prefix = os.path.join(dirname, side)
+        builder = indexed_dataset.MMapIndexedDatasetBuilder(
+            prefix + ".bin", dtype=indexed_dataset.best_fitting_int_dtype(vocab_size)
+        )
+        for length in rng.randint(1, 100, size=num_sentences):
+            tokens = rng.randint(dictionary.nspecial, len(dictionary), size=length)
+            builder.add_item(torch.IntTensor(tokens.tolist() + [dictionary.eos()]))
+        builder.finalize(prefix + ".idx")
+        datasets.append(indexed_dataset.MMapIndexedDataset(prefix))
+    return datasets, dictionary
+
+
+def load_dataset(data, src, tgt, split):
+    if src is None or tgt is None:
+        src, tgt = data_utils.infer_language_pair(data)
+    prefix = os.path.join(data, f"{split}.{src}-{tgt}.")
+    datasets = [
+        indexed_dataset.MMapIndexedDataset(prefix + lang) for lang in [src, tgt]
+    ]
+    return datasets, Dictionary.load(os.path.join(data, f"dict.{src}.txt"))
+
+
+def time_collate(dataset, batches, gathered, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for batch in batches:
+            if gathered:
+                dataset.collater(dataset.__getitems__(batch))
+            else:
+                dataset.collater([dataset[i] for i in batch])
+        timings.append(time.perf_counter() - start)
+    return min(timings) / len(batches)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", default=None, help="data-bin directory")
+    parser.add_argument("-s", "--source-lang", default=None)
+    parser.add_argument("-t", "--target-lang", default=None)
+    parser.add_argument("--split", default="train")
+    parser.add_argument("--num-sentences", type=int, default=50000)
+    parser.add_argument("--vocab-size", type=int, default=10000)
+    parser.add_argument("--max-tokens", type=int, default=4096)
+    parser.add_argument("--num-batches", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dirname:
+        if args.data is not None:
+            (src, tgt), dictionary = load_dataset(
+                args.data, args.source_lang, args.target_lang, args.split
+            )
+        else:
+            (src, tgt), dictionary = make_dataset(
+                dirname, args.num_sentences, args.vocab_size, args.seed
+            )
+        dataset = LanguagePairDataset(
+            src, src.sizes, dictionary, tgt, tgt.sizes, dictionary
+        )
+        with data_utils.numpy_seed(args.seed):
+            indices = dataset.ordered_indices()
+            batches = dataset.batch_by_size(indices, max_tokens=args.max_tokens)
+            batches = [
+                batches[i].tolist()
+                for i in np.random.permutation(len(batches))[: args.num_batches]
+            ]
+        sentences = sum(len(b) for b in batches) / len(batches)
+        print(
+            f"{len(batches)} batches of {sentences:.1f} sentences, "
+            f"--max-tokens {args.max_tokens}"
+        )
+
+        per_sample = time_collate(dataset, batches, False, args.repeat)
+        gathered = time_collate(dataset, batches, True, args.repeat)
+        print(f"  per-sample: {per_sample * 1000:.3f}ms/batch")
+        print(f"    gathered: {gathered * 1000:.3f}ms/batch")
+        print(f"     speedup: {per_sample / gathered:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
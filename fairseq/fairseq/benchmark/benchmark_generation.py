@@ -0,0 +1,240 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Measure the throughput, per-step latency and peak memory of
+:class:`SequenceGenerator` with a randomly initialized
+``transformer_iwslt_de_en``, over a grid of beam sizes, batch sizes,
+vocabularies and search strategies, e.g.:
+
+    python -m fairseq.benchmark.benchmark_generation --beam 1 5 \\
+        --batch-size 16 64 --duplicates 0 4 --search beam merge-duplicates
+
+Each configuration is printed as a line of JSON, for regression tracking.
+With ``--duplicates k``, the vocabulary gets ``k`` duplicated variants
+(``複複k複複token``) of each of its ``--duplicated-tokens`` first tokens.
+
+The decoders of random models rarely predict eos, so most sentences are
+decoded for ``--max-len`` steps. The peak memory is the peak of the memory
+allocated by torch over a decoding, measured by the profiler on CPU.
+"""
+
+import argparse
+import itertools
+import json
+import sys
+import time
+from argparse import Namespace
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from fairseq.data import Dictionary, data_utils
+from fairseq.dataclass.configs import GenerationConfig
+from fairseq.models.transformer import TransformerModel, transformer_iwslt_de_en
+from fairseq.tasks.translation import TranslationConfig, TranslationTask
+
+SEARCH_STRATEGIES = {
+    "beam": {},
+    "sampling": {"sampling": True, "sampling_topk": 10},
+    "diverse-beam": {"diverse_beam_groups": 2},
+    "diverse-siblings": {"diversity_rate": 0.5},
+    "merge-duplicates": {"merge_duplicates": True},
+    "fold-duplicates": {"fold_duplicate_outputs": True},
+}
+
+
+def make_dictionary(vocab_size, duplicates, duplicated_tokens):
+    dictionary = Dictionary()
+    for i in range(vocab_size):
+        dictionary.add_symbol(str(i))
+    for i in range(min(duplicated_tokens, vocab_size)):
+        for k in range(1, duplicates + 1):
+            dictionary.add_symbol(f"複複{k}複複{i}")
+    return dictionary
+
+
+def make_batches(dictionary, vocab_size, bsz, src_len, num_batches):
+    batches = []
+    for _ in range(num_batches):
+        lengths = torch.randint(max(src_len // 2, 1), src_len + 1, (bsz,))
+        sentences = [
+            torch.cat(
+                [
+                    torch.randint(
+                        dictionary.nspecial, dictionary.nspecial + vocab_size, (n,)
+                    ),
+                    torch.LongTensor([dictionary.eos()]),
+                ]
+            )
+            for n in lengths.tolist()
+        ]
+        batches.append(
+            {
+                "net_input": {
+                    "src_tokens": data_utils.collate_tokens(
+                        sentences, dictionary.pad(), left_pad=True
+                    ),
+                    "src_lengths": lengths + 1,
+                }
+            }
+        )
+    return batches
+
+
+def build_model(task, gen_cfg, seed):
+    torch.manual_seed(seed)
+    args = Namespace()
+    transformer_iwslt_de_en(args)
+    model = TransformerModel.build_model(args, task)
+    # also puts the model in eval mode
+    model.prepare_for_inference_(Namespace(generation=gen_cfg))
+    return model
+
+
+def decode(generator, batches, seed):
+    # reseed, so that sampling draws the same tokens on each run
+    torch.manual_seed(seed)
+    num_tokens = 0
+    with torch.no_grad():
+        for sample in batches:
+            hypos = generator.generate(generator.model.models, sample)
+            num_tokens += sum(sent_hypos[0]["tokens"].numel() for sent_hypos in hypos)
+    return num_tokens
+
+
+def peak_memory(fn, device):
+    """Return the peak of the memory allocated by torch while *fn* runs, in
+    bytes, over the memory allocated before it."""
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        allocated = torch.cuda.memory_allocated()
+        fn()
+        return torch.cuda.max_memory_allocated() - allocated
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    # allocations are recorded by the ops making them, releases by [memory] events
+    allocated = peak = 0
+    for event in sorted(prof.events(), key=lambda e: e.time_range.start):
+        allocated += event.self_cpu_memory_usage
+        peak = max(peak, allocated)
+    return peak
+
+
+def benchmark(task, model, batches, beam, search, args, device):
+    gen_cfg = GenerationConfig(
+        beam=beam, max_len_a=0, max_len_b=args.max_len, **SEARCH_STRATEGIES[search]
+    )
+    generator = task.build_generator([model], gen_cfg)
+    # count the decoder steps
+    steps = []
+    forward_decoder = generator.model.forward_decoder
+
+    def counting_forward_decoder(*inputs, **kwargs):
+        steps.append(1)
+        return forward_decoder(*inputs, **kwargs)
+
+    generator.model.forward_decoder = counting_forward_decoder
+
+    def run():
+        return decode(generator, batches, args.seed)
+
+    run()  # warmup
+    timings = []
+    for _ in range(args.repeat):
+        steps.clear()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        num_tokens = run()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    elapsed = min(timings)
+    num_steps = len(steps)
+    num_sentences = sum(b["net_input"]["src_tokens"].size(0) for b in batches)
+    return {
+        "sentences_per_sec": num_sentences / elapsed,
+        "tokens_per_sec": num_tokens / elapsed,
+        "ms_per_step": elapsed * 1000 / num_steps,
+        "steps": num_steps,
+        "generated_tokens": num_tokens,
+        "peak_memory_mb": peak_memory(run, device) / 2**20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--beam", type=int, nargs="+", default=[1, 5])
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--vocab-size", type=int, nargs="+", default=[10000])
+    parser.add_argument("--duplicates", type=int, nargs="+", default=[0, 4])
+    parser.add_argument("--duplicated-tokens", type=int, default=1000)
+    parser.add_argument(
+        "--search",
+        nargs="+",
+        default=["beam", "sampling", "merge-duplicates"],
+        choices=list(SEARCH_STRATEGIES.keys()),
+    )
+    parser.add_argument("--src-len", type=int, default=20)
+    parser.add_argument("--max-len", type=int, default=30)
+    parser.add_argument("--num-batches", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--cuda", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cuda" if args.cuda else "cpu")
+    env = {
+        "torch": torch.__version__,
+        "device": device.type,
+        "threads": torch.get_num_threads(),
+    }
+    for vocab_size, duplicates in itertools.product(args.vocab_size, args.duplicates):
+        dictionary = make_dictionary(vocab_size, duplicates, args.duplicated_tokens)
+        task = TranslationTask(TranslationConfig(), dictionary, dictionary)
+        # one model per fold_duplicate_outputs setting, with the same weights
+        models = {}
+        for search in args.search:
+            fold = SEARCH_STRATEGIES[search].get("fold_duplicate_outputs", False)
+            if fold not in models:
+                gen_cfg = GenerationConfig(fold_duplicate_outputs=fold)
+                models[fold] = build_model(task, gen_cfg, args.seed).to(device)
+        for bsz in args.batch_size:
+            torch.manual_seed(args.seed)
+            batches = make_batches(
+                dictionary, vocab_size, bsz, args.src_len, args.num_batches
+            )
+            batches = [
+                {"net_input": {k: v.to(device) for k, v in b["net_input"].items()}}
+                for b in batches
+            ]
+            for beam, search in itertools.product(args.beam, args.search):
+                config = {
+                    "beam": beam,
+                    "batch_size": bsz,
+                    "vocab_size": vocab_size,
+                    "duplicates": duplicates,
+                    "dict_size": len(dictionary),
+                    "search": search,
+                    "src_len": args.src_len,
+                    "max_len": args.max_len,
+                }
+                if search == "diverse-beam" and beam % 2 != 0:
+                    print(f"skipping {config}: needs an even beam", file=sys.stderr)
+                    continue
+                fold = SEARCH_STRATEGIES[search].get("fold_duplicate_outputs", False)
+                results = benchmark(
+                    task, models[fold], batches, beam, search, args, device
+                )
+                print(json.dumps({**config, **results, **env}), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compare the time spent by :class:`NGramRepeatBlock` without the cuda
+extension over a whole decoding, with the vectorised implementation and with
+a per-hypothesis Python loop over ``tokens.tolist()``, e.g.:
+
+    python -m fairseq.benchmark.benchmark_ngram_repeat_block --beam 5
+
+Decodings of several output lengths are timed, the cost of the loop growing
+quadratically with the length.
+"""
+
+import argparse
+import math
+import time
+
+import torch
+
+from fairseq.ngram_repeat_block import NGramRepeatBlock
+
+
+def loop_no_repeat_ngram(tokens, lprobs, step, ngram_size):
+    for row, hypo in enumerate(tokens[:, : step + 1].tolist()):
+        current = hypo[step - ngram_size + 2 :]
+        for i in range(step - ngram_size + 2):
+            if hypo[i : i + ngram_size - 1] == current:
+                lprobs[row, hypo[i + ngram_size - 1]] = -math.inf
+    return lprobs
+
+
+def time_decoding(blocker, tokens, lprobs, bsz, beam_size, vectorised, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for step in range(tokens.size(1)):
+            if vectorised:
+                blocker(tokens, lprobs, bsz, beam_size, step)
+            else:
+                loop_no_repeat_ngram(tokens, lprobs, step, blocker.no_repeat_ngram_size)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--beam", type=int, default=5)
+    parser.add_argument("--vocab-size", type=int, default=10000)
+    parser.add_argument("--no-repeat-ngram-size", type=int, default=3)
+    parser.add_argument("--max-len", type=int, nargs="+", default=[25, 50, 100, 200])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    bsz, beam_size = args.batch_size, args.beam
+    blocker = NGramRepeatBlock(args.no_repeat_ngram_size, use_extension=False)
+    lprobs = torch.rand(bsz * beam_size, args.vocab_size).log()
+    print(
+        f"--batch-size {bsz} --beam {beam_size} "
+        f"--no-repeat-ngram-size {args.no_repeat_ngram_size}"
+    )
+    for max_len in args.max_len:
+        # tokens from a few symbols only, so that some n-grams are repeated
+        tokens = torch.randint(4, 20, (bsz * beam_size, max_len))
+        loop = time_decoding(
+            blocker, tokens, lprobs, bsz, beam_size, False, args.repeat
+        )
+        vectorised = time_decoding(
+            blocker, tokens, lprobs, bsz, beam_size, True, args.repeat
+        )
+        print(f"--max-len {max_len}")
+        print(f"        loop: {loop * 1000:.3f}ms/decoding")
+        print(f"  vectorised: {vectorised * 1000:.3f}ms/decoding")
+        print(f"     speedup: {loop / vectorised:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
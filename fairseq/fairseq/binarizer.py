@@ -3,6 +3,9 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import copy
+import hashlib
+import itertools
 import logging
 import os
 import typing as tp
@@ -11,10 +14,16 @@ from collections import Counter
 from dataclasses import dataclass
 from multiprocessing import Pool
 
+import numpy as np
 import torch
 
 from fairseq.data import Dictionary, indexed_dataset
-from fairseq.file_chunker_utils import Chunker, find_offsets
+from fairseq.file_chunker_utils import (
+    Chunker,
+    find_offsets,
+    find_offsets_every,
+    read_line_batches,
+)
 from fairseq.file_io import PathManager
 from fairseq.tokenizer import tokenize_line
 
@@ -80,6 +89,28 @@ def _worker_prefix(output_prefix: str, worker_id: int):
     return f"{output_prefix}.pt{worker_id}"
 
 
+def _chunk_sha1(filename: str, offset_start: int, offset_end: int) -> str:
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        f.seek(offset_start)
+        remaining = offset_end - offset_start
+        while remaining > 0:
+            data = f.read(min(remaining, 1024 * 1024))
+            if not data:
+                break
+            sha1.update(data)
+            remaining -= len(data)
+    return sha1.hexdigest()
+
+
+def _remove_dataset(prefix: str):
+    try:
+        os.remove(indexed_dataset.data_file_path(prefix))
+        os.remove(indexed_dataset.index_file_path(prefix))
+    except Exception as e:
+        logger.error(f"couldn't remove {prefix}.*", exc_info=e)
+
+
 class FileBinarizer:
     """
     An file binarizer can take a file, tokenize it, and binarize each line to a tensor
@@ -103,6 +134,17 @@ class FileBinarizer:
         # we zip the list with itself shifted by one to get all the pairs.
         (first_chunk, *more_chunks) = zip(offsets, offsets[1:])
         pool = None
+        shared_table = None
+        if (
+            num_workers > 1
+            and isinstance(binarizer, FastVocabularyDatasetBinarizer)
+            and binarizer.shared_dictionary
+            and binarizer.table is None
+        ):
+            # map one copy of the dictionary in all workers instead of
+            # pickling it into every task
+            binarizer = binarizer.share_dictionary(f"{output_prefix}.dict")
+            shared_table = binarizer.table
         if num_workers > 1:
             pool = Pool(processes=num_workers - 1)
             worker_results = [
@@ -149,26 +191,188 @@ class FileBinarizer:
         final_summary.merge(summ)
 
         if num_workers > 1:
-            for worker_id in range(1, num_workers):
-                # merge the worker outputs
-                worker_output_prefix = _worker_prefix(
-                    output_prefix,
-                    worker_id,
+            worker_output_prefixes = [
+                _worker_prefix(output_prefix, worker_id)
+                for worker_id in range(1, num_workers)
+            ]
+            if isinstance(final_ds, indexed_dataset.MMapIndexedDatasetBuilder):
+                # copy the worker outputs concurrently, freeing each as we go
+                final_ds.merge_files_(
+                    worker_output_prefixes, num_workers=num_workers, remove=True
                 )
-                final_ds.merge_file_(worker_output_prefix)
-                try:
-                    os.remove(indexed_dataset.data_file_path(worker_output_prefix))
-                    os.remove(indexed_dataset.index_file_path(worker_output_prefix))
-                except Exception as e:
-                    logger.error(
-                        f"couldn't remove {worker_output_prefix}.*", exc_info=e
-                    )
+            else:
+                for worker_output_prefix in worker_output_prefixes:
+                    # merge the worker outputs
+                    final_ds.merge_file_(worker_output_prefix)
+                    _remove_dataset(worker_output_prefix)
+
+        if shared_table is not None:
+            shared_table.remove()
 
         #  now we can close the file
         idx_file = indexed_dataset.index_file_path(output_prefix)
         final_ds.finalize(idx_file)
         return final_summary
 
+    @classmethod
+    def incremental_dataset(
+        cls,
+        input_file: str,
+        dataset_impl: str,
+        binarizer: Binarizer,
+        output_prefix: str,
+        fingerprint: str,
+        previous_chunks: tp.Optional[tp.List[tp.Dict[str, tp.Any]]] = None,
+        vocab_size=None,
+        num_workers=1,
+        chunk_bytes=2**26,
+    ) -> tp.Tuple[BinarizeSummary, tp.List[tp.Dict[str, tp.Any]]]:
+        """
+        like multiprocess_dataset, but the input is cut about every
+        `chunk_bytes` bytes and a record (offsets, sha1, item counts) is
+        returned for each chunk. When the records of the previous run are
+        given back as `previous_chunks`, the chunks with the same content and
+        `fingerprint` (e.g. a hash of the dictionary) are copied from the
+        existing output instead of being binarized again.
+        """
+        assert (
+            dataset_impl == "mmap"
+        ), "incremental binarization requires --dataset-impl mmap"
+
+        offsets = find_offsets_every(input_file, chunk_bytes)
+        chunks = list(zip(offsets, offsets[1:]))
+        sha1s = [_chunk_sha1(input_file, start, end) for start, end in chunks]
+
+        reusable = {}
+        if previous_chunks and indexed_dataset.MMapIndexedDataset.exists(output_prefix):
+            previous_len = len(
+                indexed_dataset.MMapIndexedDataset.Index(
+                    indexed_dataset.index_file_path(output_prefix)
+                )
+            )
+            # only trust the records if they describe the existing output
+            if previous_len == sum(c["num_seq"] for c in previous_chunks):
+                reusable = {(c["sha1"], c["fingerprint"]): c for c in previous_chunks}
+
+        previous_keys = [(c["sha1"], c["fingerprint"]) for c in previous_chunks or []]
+        if reusable and previous_keys == [(sha1, fingerprint) for sha1 in sha1s]:
+            # nothing changed, keep the output as it is
+            logger.info(f"{input_file}: unchanged, keeping {output_prefix}")
+            summary = BinarizeSummary()
+            for record in previous_chunks:
+                summary.merge(cls._record_summary(record))
+            return summary, previous_chunks
+
+        todo = [
+            i for i, sha1 in enumerate(sha1s) if (sha1, fingerprint) not in reusable
+        ]
+        logger.info(
+            f"{input_file}: binarizing {len(todo)} of {len(chunks)} chunks, "
+            f"reusing the others from {output_prefix}"
+        )
+
+        chunk_args = {
+            i: (
+                binarizer,
+                input_file,
+                chunks[i][0],
+                chunks[i][1],
+                _worker_prefix(output_prefix, i),
+                dataset_impl,
+            )
+            for i in todo
+        }
+        kwds = {"vocab_size": vocab_size} if vocab_size is not None else {}
+        shared_table = None
+        if num_workers > 1 and len(todo) > 1:
+            if (
+                isinstance(binarizer, FastVocabularyDatasetBinarizer)
+                and binarizer.shared_dictionary
+                and binarizer.table is None
+            ):
+                binarizer = binarizer.share_dictionary(f"{output_prefix}.dict")
+                shared_table = binarizer.table
+                chunk_args = {
+                    i: (binarizer, *args[1:]) for i, args in chunk_args.items()
+                }
+            pool = Pool(processes=min(num_workers, len(todo)))
+            worker_results = {
+                i: pool.apply_async(
+                    cls._binarize_chunk_and_finalize, args=args, kwds=kwds
+                )
+                for i, args in chunk_args.items()
+            }
+            pool.close()
+            pool.join()
+            summaries = {i: r.get() for i, r in worker_results.items()}
+            if shared_table is not None:
+                shared_table.remove()
+        else:
+            summaries = {
+                i: cls._binarize_chunk_and_finalize(*args, **kwds)
+                for i, args in chunk_args.items()
+            }
+
+        tmp_prefix = f"{output_prefix}.tmp"
+        final_ds = indexed_dataset.make_builder(
+            indexed_dataset.data_file_path(tmp_prefix),
+            impl=dataset_impl,
+            vocab_size=vocab_size,
+        )
+        final_summary = BinarizeSummary()
+        records = []
+        first_item = 0
+        for i, ((start, end), sha1) in enumerate(zip(chunks, sha1s)):
+            if i in summaries:
+                summ = summaries[i]
+                final_ds.merge_file_(_worker_prefix(output_prefix, i))
+                _remove_dataset(_worker_prefix(output_prefix, i))
+            else:
+                previous = reusable[(sha1, fingerprint)]
+                summ = cls._record_summary(previous)
+                final_ds.merge_file_(
+                    output_prefix,
+                    start=previous["first_item"],
+                    end=previous["first_item"] + previous["num_seq"],
+                )
+            records.append(
+                {
+                    "start": start,
+                    "end": end,
+                    "sha1": sha1,
+                    "fingerprint": fingerprint,
+                    "first_item": first_item,
+                    "num_seq": summ.num_seq,
+                    "num_tok": summ.num_tok,
+                    "replaced": (
+                        None if summ.replaced is None else dict(summ.replaced)
+                    ),
+                }
+            )
+            first_item += summ.num_seq
+            final_summary.merge(summ)
+
+        final_ds.finalize(indexed_dataset.index_file_path(tmp_prefix))
+        os.replace(
+            indexed_dataset.data_file_path(tmp_prefix),
+            indexed_dataset.data_file_path(output_prefix),
+        )
+        os.replace(
+            indexed_dataset.index_file_path(tmp_prefix),
+            indexed_dataset.index_file_path(output_prefix),
+        )
+        return final_summary, records
+
+    @staticmethod
+    def _record_summary(record: tp.Dict[str, tp.Any]) -> BinarizeSummary:
+        return BinarizeSummary(
+            num_seq=record["num_seq"],
+            num_tok=record["num_tok"],
+            replaced=(
+                None if record["replaced"] is None else Counter(record["replaced"])
+            ),
+        )
+
     @staticmethod
     def _binarize_file_chunk(
         binarizer: Binarizer,
@@ -192,11 +396,22 @@ class FileBinarizer:
         )
         summary = BinarizeSummary()
 
-        with Chunker(
-            PathManager.get_local_path(filename), offset_start, offset_end
-        ) as line_iterator:
-            for line in line_iterator:
-                ds.add_item(binarizer.binarize_line(line, summary))
+        if isinstance(binarizer, FastVocabularyDatasetBinarizer) and isinstance(
+            ds, indexed_dataset.MMapIndexedDatasetBuilder
+        ):
+            for lines in read_line_batches(
+                PathManager.get_local_path(filename),
+                offset_start,
+                offset_end,
+                batch_bytes=binarizer.batch_bytes,
+            ):
+                ds.add_items(*binarizer.binarize_lines(lines, summary))
+        else:
+            with Chunker(
+                PathManager.get_local_path(filename), offset_start, offset_end
+            ) as line_iterator:
+                for line in line_iterator:
+                    ds.add_item(binarizer.binarize_line(line, summary))
 
         return ds, summary
 
@@ -286,6 +501,200 @@ class VocabularyDatasetBinarizer(Binarizer):
         return ids
 
 
+class DictionaryHashTable:
+    """
+    A read-only symbol -> index table for binarizer workers.
+
+    The sorted hash() of the symbols of a Dictionary and their indices are
+    saved to .npy files that every process memory-maps, so that all the
+    workers of a pool share one copy of the table through the page cache
+    instead of each unpickling and indexing its own Dictionary. Lookups are
+    a vectorized binary search over the hashes, and the symbols found are
+    compared to the words, so that a word whose hash collides with the hash
+    of a symbol is still mapped to unk.
+    """
+
+    _HASH_CHECK = "fairseq.binarizer.DictionaryHashTable"
+
+    def __init__(self, path: str, hash_check: int) -> None:
+        self.path = path
+        self.hash_check = hash_check
+        self._load()
+
+    @staticmethod
+    def _hash_all(symbols) -> np.ndarray:
+        return np.fromiter(map(hash, symbols), dtype=np.int64, count=len(symbols))
+
+    @classmethod
+    def build(cls, dictionary: Dictionary, path: str) -> "DictionaryHashTable":
+        symbols = list(dictionary.indices.keys())
+        hashes = cls._hash_all(symbols)
+        order = np.argsort(hashes, kind="stable")
+        hashes = hashes[order]
+        if np.any(hashes[1:] == hashes[:-1]):
+            raise ValueError("hash collision between dictionary symbols")
+        ids = np.fromiter(dictionary.indices.values(), dtype=np.int64)[order]
+
+        np.save(f"{path}.hashes.npy", hashes)
+        np.save(f"{path}.ids.npy", ids)
+        np.save(f"{path}.symbols.npy", np.array(symbols)[order])
+        return cls(path, hash(cls._HASH_CHECK))
+
+    def _load(self) -> None:
+        self._ids = np.load(f"{self.path}.ids.npy", mmap_mode="r")
+        self._symbols = np.load(f"{self.path}.symbols.npy", mmap_mode="r")
+        if hash(self._HASH_CHECK) == self.hash_check:
+            self._hashes = np.load(f"{self.path}.hashes.npy", mmap_mode="r")
+        else:
+            # str hashes are salted per interpreter (e.g. with spawned instead
+            # of forked workers), rebuild a private table in that case
+            hashes = self._hash_all(self._symbols.tolist())
+            order = np.argsort(hashes, kind="stable")
+            self._hashes = hashes[order]
+            self._ids = self._ids[order]
+            self._symbols = self._symbols[order]
+
+    def __getstate__(self):
+        return {"path": self.path, "hash_check": self.hash_check}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.hash_check = state["hash_check"]
+        self._load()
+
+    def lookup(self, words: tp.List[str], unk_index: int) -> np.ndarray:
+        hashes = self._hash_all(words)
+        pos = np.minimum(np.searchsorted(self._hashes, hashes), len(self._hashes) - 1)
+        found = self._hashes[pos] == hashes
+        candidates = np.flatnonzero(found)
+        if len(candidates) > 0:
+            # rule out hash collisions with words outside of the dictionary
+            found[candidates] = self._symbols[pos[candidates]] == np.array(
+                [words[i] for i in candidates.tolist()]
+            )
+        return np.where(found, self._ids[pos], unk_index)
+
+    def remove(self) -> None:
+        for suffix in ["hashes", "ids", "symbols"]:
+            try:
+                os.remove(f"{self.path}.{suffix}.npy")
+            except Exception as e:
+                logger.error(f"couldn't remove {self.path}.{suffix}.npy", exc_info=e)
+
+
+class FastVocabularyDatasetBinarizer(VocabularyDatasetBinarizer):
+    """
+    Same output as VocabularyDatasetBinarizer with the default whitespace
+    tokenizer, but encodes many lines at once with a single hash map lookup
+    per token and numpy bookkeeping, instead of going through
+    Dictionary.encode_line and a consumer callback for every line.
+
+    FileBinarizer feeds it batches of about `batch_bytes` bytes of lines when
+    writing mmap datasets, which are then appended to the builder in bulk.
+    With several workers, the binarizer sent to them looks symbols up in a
+    shared DictionaryHashTable (see `share_dictionary`) unless
+    `shared_dictionary` is False.
+    """
+
+    def __init__(
+        self,
+        dict: Dictionary,
+        append_eos: bool = True,
+        reverse_order: bool = False,
+        already_numberized: bool = False,
+        batch_bytes: int = 2**22,
+        shared_dictionary: bool = True,
+    ) -> None:
+        super().__init__(
+            dict,
+            tokenize=tokenize_line,
+            append_eos=append_eos,
+            reverse_order=reverse_order,
+            already_numberized=already_numberized,
+        )
+        self.batch_bytes = batch_bytes
+        self.shared_dictionary = shared_dictionary
+        self.table: tp.Optional[DictionaryHashTable] = None
+        self.unk_index = dict.unk_index
+        self.unk_word = dict.unk_word
+        self.eos_index = dict.eos()
+
+    def share_dictionary(self, path: str) -> "FastVocabularyDatasetBinarizer":
+        """
+        returns a copy of this binarizer that looks symbols up in a
+        DictionaryHashTable saved under `path` instead of carrying the
+        Dictionary, to be sent to worker processes
+        """
+        shared = copy.copy(self)
+        shared.table = DictionaryHashTable.build(self.dict, path)
+        shared.dict = None
+        return shared
+
+    def binarize_lines(
+        self,
+        lines: tp.List[str],
+        summary: BinarizeSummary,
+    ) -> tp.Tuple[np.ndarray, np.ndarray]:
+        """
+        binarize a list of lines, returns the concatenated ids of all the
+        lines and the size of each of them
+        """
+        if summary.replaced is None:
+            summary.replaced = Counter()
+
+        words_per_line = [line.split() for line in lines]
+        sizes = np.fromiter(
+            map(len, words_per_line), dtype=np.int64, count=len(words_per_line)
+        )
+        words = list(itertools.chain.from_iterable(words_per_line))
+
+        if self.already_numberized:
+            ids = np.array(words, dtype=np.int64)
+        else:
+            unk = self.unk_index
+            if self.table is not None:
+                ids = self.table.lookup(words, unk)
+            else:
+                ids = np.fromiter(
+                    map(self.dict.indices.get, words, itertools.repeat(unk)),
+                    dtype=np.int64,
+                    count=len(words),
+                )
+            summary.replaced.update(
+                word
+                for word in map(words.__getitem__, np.flatnonzero(ids == unk))
+                if word != self.unk_word
+            )
+
+        starts = np.cumsum(sizes) - sizes
+        if self.reverse_order and len(ids) > 0:
+            line_starts = np.repeat(starts, sizes)
+            line_ends = np.repeat(starts + sizes - 1, sizes)
+            ids = ids[line_starts + line_ends - np.arange(len(ids))]
+
+        if self.append_eos:
+            # every item grows by one and the eos goes in its last position
+            eos_positions = starts + np.arange(len(sizes)) + sizes
+            with_eos = np.full(len(ids) + len(sizes), self.eos_index, dtype=np.int64)
+            keep = np.ones(len(with_eos), dtype=bool)
+            keep[eos_positions] = False
+            with_eos[keep] = ids
+            ids = with_eos
+            sizes = sizes + 1
+
+        summary.num_seq += len(sizes)
+        summary.num_tok += len(ids)
+        return ids, sizes
+
+    def binarize_line(
+        self,
+        line: str,
+        summary: BinarizeSummary,
+    ):
+        ids, _ = self.binarize_lines([line], summary)
+        return torch.from_numpy(ids.astype(np.int32))
+
+
 class AlignmentDatasetBinarizer(Binarizer):
     """
     binarize by parsing a set of alignments and packing
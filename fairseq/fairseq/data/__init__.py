@@ -20,6 +20,11 @@ from .colorize_dataset import ColorizeDataset
 from .concat_dataset import ConcatDataset
 from .concat_sentences_dataset import ConcatSentencesDataset
 from .denoising_dataset import DenoisingDataset
+from .duplication_sampling_dataset import (
+    DuplicationSamplingDataset,
+    get_duplicate_variants,
+    load_bpe_merges,
+)
 from .id_dataset import IdDataset
 from .indexed_dataset import (
     IndexedCachedDataset,
@@ -39,6 +44,7 @@ from .noising import NoisingDataset
 from .numel_dataset import NumelDataset
 from .num_samples_dataset import NumSamplesDataset
 from .offset_tokens_dataset import OffsetTokensDataset
+from .output_length_sorted_dataset import OutputLengthSortedDataset
 from .padding_mask_dataset import (
     LeftPaddingMaskDataset,
     PaddingMaskDataset,
@@ -84,6 +90,7 @@ __all__ = [
     "ConcatSentencesDataset",
     "CountingIterator",
     "DenoisingDataset",
+    "DuplicationSamplingDataset",
     "Dictionary",
     "EncodedFastaDataset",
     "EpochBatchIterator",
@@ -111,6 +118,7 @@ __all__ = [
     "NumelDataset",
     "NumSamplesDataset",
     "OffsetTokensDataset",
+    "OutputLengthSortedDataset",
     "PadDataset",
     "PrependDataset",
     "PrependTokenDataset",
@@ -134,4 +142,6 @@ __all__ = [
     "TransformEosConcatLangPairDataset",
     "TruncateDataset",
     "TruncatedDictionary",
+    "get_duplicate_variants",
+    "load_bpe_merges",
 ]
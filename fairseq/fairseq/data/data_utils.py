@@ -71,8 +71,94 @@ def collate_tokens(
     return res
 
 
+def collate_flat_tokens(
+    tokens,
+    lengths,
+    pad_idx,
+    eos_idx=None,
+    left_pad=False,
+    move_eos_to_beginning=False,
+    pad_to_length=None,
+    pad_to_multiple=1,
+    pad_to_bsz=None,
+    sort_order=None,
+    pin_memory=False,
+    starts=None,
+    out=None,
+):
+    """Like :func:`collate_tokens`, for 1d arrays of *lengths* read from the
+    flat array *tokens*, at *starts* if set, else one after the other.
+
+    Each array is copied once, straight from *tokens* (e.g. the buffer of a
+    :class:`~fairseq.data.indexed_dataset.MMapIndexedDataset`) into its row
+    of the padded LongTensor, in the row order given by *sort_order* if set.
+    The tensor is a view of *out* if it is large enough, so that a buffer can
+    be reused across batches, otherwise it is allocated, in pinned memory if
+    *pin_memory* is set.
+    """
+    tokens = tokens.numpy() if torch.is_tensor(tokens) else np.asarray(tokens)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    size = int(lengths.max()) if len(lengths) > 0 else 0
+    size = size if pad_to_length is None else max(size, pad_to_length)
+    if pad_to_multiple != 1 and size % pad_to_multiple != 0:
+        size = int(((size - 0.1) // pad_to_multiple + 1) * pad_to_multiple)
+
+    batch_size = len(lengths) if pad_to_bsz is None else max(len(lengths), pad_to_bsz)
+    if out is not None and out.numel() >= batch_size * size:
+        res = out.view(-1)[: batch_size * size].view(batch_size, size)
+        res.fill_(pad_idx)
+    else:
+        res = torch.full(
+            (batch_size, size), pad_idx, dtype=torch.long, pin_memory=pin_memory
+        )
+
+    rows = np.arange(len(lengths), dtype=np.int64)
+    if sort_order is not None:
+        rows[np.asarray(sort_order)] = rows.copy()
+    if starts is None:
+        starts = np.cumsum(lengths) - lengths
+    batch = res.numpy()
+    for row, start, length in zip(rows.tolist(), starts.tolist(), lengths.tolist()):
+        if length == 0:
+            continue
+        col = size - length if left_pad else 0
+        src, dst = tokens[start : start + length], batch[row, col : col + length]
+        if move_eos_to_beginning:
+            # if no eos_idx is specified, then use the last token of the array
+            dst[0] = src[-1] if eos_idx is None else eos_idx
+            dst[1:] = src[:-1]
+        else:
+            dst[:] = src
+    return res
+
+
+# set in background data loading processes, which must not initialize CUDA
+_pin_memory_disabled = False
+
+
+def disable_pin_memory():
+    """Never build batches in pinned memory in this process."""
+    global _pin_memory_disabled
+    _pin_memory_disabled = True
+
+
+def can_pin_memory():
+    """Whether batches built here may go to pinned memory: only in the main
+    process, as CUDA must not be initialized by data loading processes."""
+    return (
+        not _pin_memory_disabled
+        and torch.utils.data.get_worker_info() is None
+        and torch.cuda.is_available()
+    )
+
+
 def load_indexed_dataset(
-    path, dictionary=None, dataset_impl=None, combine=False, default="cached"
+    path,
+    dictionary=None,
+    dataset_impl=None,
+    combine=False,
+    default="cached",
+    shared_cache=None,
 ):
     """A helper function for loading indexed datasets.
 
@@ -86,6 +172,8 @@ def load_indexed_dataset(
             datasets. For example, if *path* is 'data-bin/train', then we will
             combine 'data-bin/train', 'data-bin/train1', ... and return a
             single ConcatDataset instance.
+        shared_cache (str, optional): directory of a host-local cache in
+            shared memory for the index of mmap datasets.
     """
     import fairseq.data.indexed_dataset as indexed_dataset
     from fairseq.data.concat_dataset import ConcatDataset
@@ -109,6 +197,7 @@ def load_indexed_dataset(
             impl=dataset_impl_k or default,
             fix_lua_indexing=True,
             dictionary=dictionary,
+            shared_cache=shared_cache,
         )
         if dataset is None:
             break
@@ -288,6 +377,7 @@ def batch_by_size(
     max_sentences=None,
     required_batch_size_multiple=1,
     fixed_shapes=None,
+    padding_sizes=None,
 ):
     """
     Yield mini-batches of indices bucketed by size. Batches may contain
@@ -308,10 +398,19 @@ def batch_by_size(
         fixed_shapes (List[Tuple[int, int]], optional): if given, batches will
             only be created with the given shapes. *max_sentences* and
             *required_batch_size_multiple* will be ignored (default: None).
+        padding_sizes (np.ndarray, optional): if given, the lengths that get
+            padded in a batch, one row per index (e.g. source and target
+            lengths). The indices are then sorted by length and split into
+            the fewest batches with the least padding of these lengths,
+            instead of being filled greedily in the given order. This takes
+            O(len(indices) * max batch length), so it is only done when
+            *max_tokens* or *max_sentences* bound the batches; otherwise all
+            the indices fit in a single greedy batch anyway (default: None).
     """
     try:
         from fairseq.data.data_utils_fast import (
             batch_by_size_fn,
+            batch_by_size_min_padding_vec,
             batch_by_size_vec,
             batch_fixed_shapes_fast,
         )
@@ -337,7 +436,25 @@ def batch_by_size(
         num_tokens_vec = np.fromiter(num_tokens_vec, dtype=np.int64, count=-1)
 
     if fixed_shapes is None:
-        if num_tokens_vec is None:
+        if padding_sizes is not None and (max_tokens > 0 or max_sentences > 0):
+            if num_tokens_vec is None:
+                num_tokens_vec = np.fromiter(
+                    (num_tokens_fn(idx) for idx in indices), dtype=np.int64
+                )
+            padding_sizes = np.asarray(padding_sizes, dtype=np.int64)
+            if padding_sizes.ndim == 1:
+                padding_sizes = padding_sizes[:, None]
+            # sort by num_tokens, then by each padded length
+            order = np.lexsort([*padding_sizes.T[::-1], num_tokens_vec])
+            b = batch_by_size_min_padding_vec(
+                indices[order],
+                num_tokens_vec[order],
+                np.ascontiguousarray(padding_sizes[order]),
+                max_tokens,
+                max_sentences,
+                bsz_mult,
+            )
+        elif num_tokens_vec is None:
             b = batch_by_size_fn(
                 indices,
                 num_tokens_fn,
@@ -371,6 +488,36 @@ def batch_by_size(
         return batch_fixed_shapes_fast(indices, num_tokens_fn, fixed_shapes_sorted)
 
 
+def save_batches(path, batches):
+    """
+    Save a batch plan (a list of index arrays) as one int64 ``.npy``: the
+    number of batches, the end offset of each batch, then all the indices.
+    """
+    ends = np.cumsum([len(batch) for batch in batches], dtype=np.int64)
+    plan = np.concatenate(
+        [np.array([len(batches)], dtype=np.int64), ends]
+        + [np.asarray(batch, dtype=np.int64) for batch in batches]
+    )
+    # several runs may fill the same cache at once
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, plan)
+    os.replace(tmp_path, path)
+
+
+def load_batches(path):
+    """Memory-map a batch plan written by :func:`save_batches`."""
+    plan = np.load(path, mmap_mode="r")
+    num_batches = int(plan[0])
+    if num_batches == 0:
+        return []
+    ends = plan[1 : num_batches + 1]
+    return [
+        np.asarray(batch)
+        for batch in np.split(plan[num_batches + 1 :], ends[: num_batches - 1])
+    ]
+
+
 def post_process(sentence: str, symbol: str):
     if symbol == "sentencepiece":
         sentence = sentence.replace(" ", "").replace("\u2581", " ").strip()
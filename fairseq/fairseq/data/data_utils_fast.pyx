@@ -103,6 +103,105 @@ cpdef list batch_by_size_vec(
     return np.split(indices, batches_ends[:batches_count])
 
 
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef list batch_by_size_min_padding_vec(
+    np.ndarray[int64_t, ndim=1] indices,
+    np.ndarray[int64_t, ndim=1] num_tokens_vec,
+    np.ndarray[int64_t, ndim=2] sizes,
+    int64_t max_tokens,
+    int64_t max_sentences,
+    int32_t bsz_mult,
+):
+    """
+    Split *indices* into contiguous batches that respect the same constraints
+    as batch_by_size_vec, using the fewest batches and, among those, the
+    fewest padding tokens summed over the columns of *sizes* (e.g. source and
+    target lengths). Solved exactly by dynamic programming over the batch
+    ends, which is cheap when *indices* are sorted by length. Each batch end
+    is tried with every batch start allowed by *max_tokens* and
+    *max_sentences*, so at least one of them should be set: unbounded, the
+    search is quadratic in the number of indices.
+    """
+    if indices.shape[0] == 0:
+        return []
+
+    assert max_tokens <= 0 or np.max(num_tokens_vec) <= max_tokens, (
+        f"Sentences lengths should not exceed max_tokens={max_tokens}"
+    )
+
+    cdef int64_t indices_len = indices.shape[0]
+    cdef int64_t num_sides = sizes.shape[1]
+    cdef int64_t[:] num_tokens_view = num_tokens_vec
+    cdef int64_t[:, :] sizes_view = sizes
+
+    # best (batch count, padding) for the prefix [0:end), and where the last
+    # batch of that prefix starts
+    cdef np.ndarray[int64_t, ndim=1] best_count = \
+            np.full(indices_len + 1, np.iinfo(np.int64).max, dtype=np.int64)
+    cdef np.ndarray[int64_t, ndim=1] best_padding = \
+            np.zeros(indices_len + 1, dtype=np.int64)
+    cdef np.ndarray[int64_t, ndim=1] best_start = \
+            np.zeros(indices_len + 1, dtype=np.int64)
+    cdef int64_t[:] best_count_view = best_count
+    cdef int64_t[:] best_padding_view = best_padding
+    cdef int64_t[:] best_start_view = best_start
+
+    cdef np.ndarray[int64_t, ndim=1] side_max = np.zeros(num_sides, dtype=np.int64)
+    cdef np.ndarray[int64_t, ndim=1] side_sum = np.zeros(num_sides, dtype=np.int64)
+    cdef int64_t[:] side_max_view = side_max
+    cdef int64_t[:] side_sum_view = side_sum
+
+    cdef int64_t end, start, side, batch_sentences, batch_max_tokens
+    cdef int64_t padding, count
+
+    best_count_view[0] = 0
+    for end in range(1, indices_len + 1):
+        batch_max_tokens = 0
+        for side in range(num_sides):
+            side_max_view[side] = 0
+            side_sum_view[side] = 0
+
+        # grow the last batch [start:end) backwards until it overflows
+        start = end - 1
+        while start >= 0:
+            batch_sentences = end - start
+            if num_tokens_view[start] > batch_max_tokens:
+                batch_max_tokens = num_tokens_view[start]
+            if batch_sentences > max_sentences > 0 or \
+                    batch_sentences * batch_max_tokens > max_tokens > 0:
+                break
+
+            padding = 0
+            for side in range(num_sides):
+                if sizes_view[start, side] > side_max_view[side]:
+                    side_max_view[side] = sizes_view[start, side]
+                side_sum_view[side] += sizes_view[start, side]
+                padding += batch_sentences * side_max_view[side] - side_sum_view[side]
+
+            if batch_sentences < bsz_mult or batch_sentences % bsz_mult == 0:
+                count = best_count_view[start] + 1
+                padding += best_padding_view[start]
+                if count < best_count_view[end] or (
+                    count == best_count_view[end] and padding < best_padding_view[end]
+                ):
+                    best_count_view[end] = count
+                    best_padding_view[end] = padding
+                    best_start_view[end] = start
+            start -= 1
+
+    cdef np.ndarray[int64_t, ndim=1] batches_ends = \
+            np.zeros(best_count_view[indices_len], dtype=np.int64)
+    end = indices_len
+    count = best_count_view[indices_len]
+    while end > 0:
+        count -= 1
+        batches_ends[count] = end
+        end = best_start_view[end]
+    return np.split(indices, batches_ends[:best_count_view[indices_len] - 1])
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 cpdef list batch_by_size_fn(
@@ -0,0 +1,176 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import re
+from typing import Optional
+
+import numpy as np
+import torch
+
+from fairseq.data import Dictionary
+
+from . import BaseWrapperDataset
+
+DUPLICATION_MARKER = re.compile(r"^複複(\d+)複複(.+)$")
+
+
+class DuplicationSamplingDataset(BaseWrapperDataset):
+    """
+    Sample the duplicated and BPE-dropout segmentations on the fly.
+
+    The wrapped dataset stores one canonical copy of the corpus. Every time an
+    item is read, each token that has duplicated variants (``複複k複複token``
+    in *vocab*) is replaced by one of its variants drawn uniformly, like
+    ``apply_bpe.py --duplication-k`` does at preprocessing time. Items that
+    already contain variants are first mapped back to their base tokens.
+
+    With *dropout* > 0 and *merges* (see :func:`load_bpe_merges`), each token
+    is also split back into the two subwords it was merged from with
+    probability *dropout*, recursively. This approximates BPE-dropout on the
+    token ids without the raw text. Items then get longer than ``sizes``,
+    which still holds the canonical lengths used for batching and filtering;
+    with *max_len*, the merges undone are limited so that items are at most
+    *max_len* tokens long, and still pass the ``--max-positions`` filtering.
+
+    The randomness only depends on (*seed*, epoch, index), so every epoch sees
+    a fresh sample while runs stay reproducible.
+
+    Args:
+        dataset: dataset of canonical token ids to wrap.
+        vocab: dictionary with the duplicated variants.
+        seed: seed for the random number generator.
+        merges: optional ``(left, right)`` arrays giving, for each token id,
+            the ids it was merged from (or -1).
+        dropout: probability of undoing a merge.
+        max_len: optional maximum length of the items resegmented by dropout.
+    """
+
+    def __init__(
+        self,
+        dataset: torch.utils.data.Dataset,
+        vocab: Dictionary,
+        seed: int = 1,
+        merges=None,
+        dropout: float = 0.0,
+        max_len: Optional[int] = None,
+    ):
+        super().__init__(dataset)
+        assert 0.0 <= dropout < 1.0
+        assert dropout == 0.0 or merges is not None, "dropout requires merges"
+        self.seed = seed
+        self.dropout = dropout
+        self.max_len = max_len
+        self.epoch = 0
+
+        self.canonical = np.arange(len(vocab), dtype=np.int64)
+        variants = {}
+        for idx, base in zip(*get_duplicate_variants(vocab)):
+            self.canonical[idx] = base
+            variants.setdefault(base, []).append(idx)
+
+        self.num_variants = np.zeros(len(vocab), dtype=np.int64)
+        self.variant_offsets = np.zeros(len(vocab), dtype=np.int64)
+        self.variant_ids = np.zeros(
+            sum(len(ids) for ids in variants.values()), dtype=np.int64
+        )
+        offset = 0
+        for base, ids in sorted(variants.items()):
+            self.num_variants[base] = len(ids)
+            self.variant_offsets[base] = offset
+            self.variant_ids[offset : offset + len(ids)] = ids
+            offset += len(ids)
+
+        if merges is not None:
+            self.left, self.right = (np.asarray(m, dtype=np.int64) for m in merges)
+            assert len(self.left) == len(self.right) == len(vocab)
+
+    @property
+    def can_reuse_epoch_itr_across_epochs(self):
+        # the items change every epoch, and persistent data loader workers
+        # would keep the copy of the dataset of the first epoch
+        if self.dropout > 0.0 or len(self.variant_ids) > 0:
+            return False
+        return self.dataset.can_reuse_epoch_itr_across_epochs
+
+    def set_epoch(self, epoch, **unused):
+        super().set_epoch(epoch)
+        self.epoch = epoch
+
+    def __getitem__(self, index: int):
+        item = self.dataset[index]
+        rng = np.random.default_rng((self.seed, self.epoch, index))
+        tokens = self.canonical[item.numpy()]
+
+        if self.dropout > 0.0:
+            while True:
+                split = (self.left[tokens] >= 0) & (
+                    rng.random(len(tokens)) < self.dropout
+                )
+                if self.max_len is not None:
+                    # undo the first merges only, up to max_len tokens
+                    room = max(self.max_len - len(tokens), 0)
+                    split[np.flatnonzero(split)[room:]] = False
+                if not split.any():
+                    break
+                starts = np.cumsum(1 + split) - (1 + split)
+                split_tokens = tokens[split]
+                tokens = np.repeat(tokens, 1 + split)
+                tokens[starts[split]] = self.left[split_tokens]
+                tokens[starts[split] + 1] = self.right[split_tokens]
+
+        num_variants = self.num_variants[tokens]
+        duplicated = num_variants > 0
+        if duplicated.any():
+            choice = rng.random(int(duplicated.sum())) * num_variants[duplicated]
+            tokens[duplicated] = self.variant_ids[
+                self.variant_offsets[tokens[duplicated]] + choice.astype(np.int64)
+            ]
+        return torch.from_numpy(tokens).to(item.dtype)
+
+
+def get_duplicate_variants(vocab: Dictionary):
+    """
+    Return the ids of the duplicated variants (``複複k複複token``) in *vocab*
+    and the ids of their base tokens, as two lists.
+    """
+    variant_ids, base_ids = [], []
+    for idx, symbol in enumerate(vocab.symbols):
+        match = DUPLICATION_MARKER.match(symbol)
+        if match is not None and match.group(2) in vocab:
+            variant_ids.append(idx)
+            base_ids.append(vocab.index(match.group(2)))
+    return variant_ids, base_ids
+
+
+def load_bpe_merges(codes_path: str, vocab: Dictionary, separator: str = "@@"):
+    """
+    Read subword-nmt merge operations and return, for each token id of *vocab*,
+    the ids of the two subwords it is built from (-1 if it is not a merge or a
+    part is missing from *vocab*).
+    """
+    left = np.full(len(vocab), -1, dtype=np.int64)
+    right = np.full(len(vocab), -1, dtype=np.int64)
+
+    def to_symbol(subword):
+        if subword.endswith("</w>"):
+            return subword[: -len("</w>")]
+        return subword + separator
+
+    with open(codes_path, "r", encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if i == 0 and line.startswith("#version"):
+                continue
+            parts = line.rstrip("\r\n").split(" ")
+            if len(parts) != 2:
+                continue
+            merged = to_symbol(parts[0] + parts[1])
+            a, b = to_symbol(parts[0]), to_symbol(parts[1])
+            if merged not in vocab or a not in vocab or b not in vocab:
+                continue
+            idx = vocab.index(merged)
+            # the first merge producing a symbol has the highest priority
+            if left[idx] < 0:
+                left[idx], right[idx] = vocab.index(a), vocab.index(b)
+    return left, right
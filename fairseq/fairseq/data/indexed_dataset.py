@@ -3,9 +3,11 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-import shutil
+import errno
+import os
 import struct
 from functools import lru_cache
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import torch
@@ -14,7 +16,7 @@ from fairseq.data.fasta_dataset import FastaDataset
 from fairseq.file_io import PathManager
 from fairseq.data.huffman import HuffmanMMapIndexedDataset, HuffmanMMapIndex
 
-from . import FairseqDataset
+from . import FairseqDataset, data_utils, plasma_utils
 
 from typing import Union
 
@@ -74,7 +76,9 @@ def make_builder(out_file, impl, vocab_size=None):
         return IndexedDatasetBuilder(out_file)
 
 
-def make_dataset(path, impl, fix_lua_indexing=False, dictionary=None):
+def make_dataset(
+    path, impl, fix_lua_indexing=False, dictionary=None, shared_cache=None
+):
     if impl == "raw" and IndexedRawTextDataset.exists(path):
         assert dictionary is not None
         return IndexedRawTextDataset(path, dictionary)
@@ -83,7 +87,7 @@ def make_dataset(path, impl, fix_lua_indexing=False, dictionary=None):
     elif impl == "cached" and IndexedDataset.exists(path):
         return IndexedCachedDataset(path, fix_lua_indexing=fix_lua_indexing)
     elif impl == "mmap" and MMapIndexedDataset.exists(path):
-        return MMapIndexedDataset(path)
+        return MMapIndexedDataset(path, shared_cache=shared_cache)
     elif impl == "fasta" and FastaDataset.exists(path):
         from fairseq.data.fasta_dataset import EncodedFastaDataset
 
@@ -389,6 +393,9 @@ def _warmup_mmap_file(path):
 
 
 class MMapIndexedDataset(torch.utils.data.Dataset):
+    """Memory-mapped dataset. With *shared_cache*, the index is read from a
+    :class:`~fairseq.data.plasma_utils.SharedFileCache` in that directory."""
+
     class Index:
         _HDR_MAGIC = b"MMIDIDX\x00\x00"
 
@@ -434,7 +441,7 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
 
             return _Writer()
 
-        def __init__(self, path):
+        def __init__(self, path, shared_cache=None):
             with open(path, "rb") as stream:
                 magic_test = stream.read(9)
                 assert self._HDR_MAGIC == magic_test, (
@@ -451,6 +458,8 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
                 self._len = struct.unpack("<Q", stream.read(8))[0]
                 offset = stream.tell()
 
+            if shared_cache is not None:
+                path = plasma_utils.SharedFileCache(shared_cache).get(path)
             _warmup_mmap_file(path)
 
             self._bin_buffer_mmap = np.memmap(path, mode="r", order="C")
@@ -484,24 +493,31 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         def __len__(self):
             return self._len
 
-    def __init__(self, path):
+    def __init__(self, path, shared_cache=None):
         super().__init__()
 
         self._path = None
+        self._shared_cache = None
         self._index = None
         self._bin_buffer = None
 
-        self._do_init(path)
+        self._do_init(path, shared_cache)
 
     def __getstate__(self):
-        return self._path
+        if self._shared_cache is None:
+            return self._path
+        return self._path, self._shared_cache
 
     def __setstate__(self, state):
-        self._do_init(state)
+        if isinstance(state, tuple):
+            self._do_init(*state)
+        else:
+            self._do_init(state)
 
-    def _do_init(self, path):
+    def _do_init(self, path, shared_cache=None):
         self._path = path
-        self._index = self.Index(index_file_path(self._path))
+        self._shared_cache = shared_cache
+        self._index = self.Index(index_file_path(self._path), shared_cache)
 
         _warmup_mmap_file(data_file_path(self._path))
         self._bin_buffer_mmap = np.memmap(
@@ -528,6 +544,46 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
 
         return torch.from_numpy(np_array)
 
+    def spans(self, indices):
+        """Locate the items at *indices* in the data buffer, without reading
+        them.
+
+        Returns the whole data buffer, as an array of the dataset's dtype, and
+        the start and size of each item in it.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        sizes = self._index.sizes[indices].astype(np.int64)
+        starts = self._index._pointers[indices] // self._index._dtype_size
+        data = np.frombuffer(
+            self._bin_buffer,
+            dtype=self._index.dtype,
+            count=len(self._bin_buffer) // self._index._dtype_size,
+        )
+        return data, starts, sizes
+
+    def get_batch(self, indices, pad_idx, left_pad=False, pin_memory=False, out=None):
+        """Read the items at *indices* into a padded 2D LongTensor.
+
+        The token ids are copied straight from the data buffer into the batch
+        tensor. It is a view of the LongTensor *out* if that is large enough,
+        so that a (pinned) buffer can be reused across batches, once the
+        copies from the previous batch are done. Otherwise it is allocated, in
+        pinned memory if *pin_memory* is set so that it can be sent to the GPU
+        with ``non_blocking=True``. Returns the batch and the sizes of the
+        items.
+        """
+        data, starts, sizes = self.spans(indices)
+        batch = data_utils.collate_flat_tokens(
+            data,
+            sizes,
+            pad_idx,
+            left_pad=left_pad,
+            pin_memory=pin_memory,
+            starts=starts,
+            out=out,
+        )
+        return batch, torch.from_numpy(sizes)
+
     @property
     def sizes(self):
         return self._index.sizes
@@ -562,6 +618,47 @@ def get_indexed_dataset_to_local(path) -> str:
     return local_path
 
 
+# copy_file_range is not supported between these files, copy them by hand
+_NO_COPY_FILE_RANGE = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+}
+
+
+def _copy_data(src_path, dst_path, src_offset, dst_offset, count):
+    """
+    Copy `count` bytes of src_path at src_offset into dst_path at dst_offset.
+    On Linux the copy stays in the kernel (os.copy_file_range), which also
+    shares the extents instead of duplicating them on filesystems with
+    reflinks (btrfs, XFS); elsewhere it falls back to a buffered copy.
+    """
+    with open(src_path, "rb") as src, open(dst_path, "r+b") as dst:
+        if hasattr(os, "copy_file_range"):
+            try:
+                while count > 0:
+                    copied = os.copy_file_range(
+                        src.fileno(), dst.fileno(), count, src_offset, dst_offset
+                    )
+                    if copied == 0:
+                        break
+                    count -= copied
+                    src_offset += copied
+                    dst_offset += copied
+            except OSError as e:
+                if e.errno not in _NO_COPY_FILE_RANGE:
+                    raise
+        src.seek(src_offset)
+        dst.seek(dst_offset)
+        while count > 0:
+            data = src.read(min(count, 1024 * 1024))
+            assert data, f"{src_path} is truncated"
+            dst.write(data)
+            count -= len(data)
+
+
 class MMapIndexedDatasetBuilder:
     def __init__(self, out_file, dtype=np.int64):
         self._data_file = open(out_file, "wb")
@@ -573,17 +670,76 @@ class MMapIndexedDatasetBuilder:
         self._data_file.write(np_array.tobytes(order="C"))
         self._sizes.append(np_array.size)
 
-    def merge_file_(self, another_file):
+    def add_items(self, np_array, sizes):
+        """Append several items at once, given their concatenation and sizes."""
+        np_array = np.asarray(np_array, dtype=self._dtype)
+        assert np_array.size == np.sum(sizes)
+        self._data_file.write(np_array.tobytes(order="C"))
+        self._sizes.extend(int(size) for size in sizes)
+
+    def merge_file_(self, another_file, start=None, end=None):
+        """Append the items of another dataset, or only its items [start, end)."""
         # Concatenate index
         index = MMapIndexedDataset.Index(index_file_path(another_file))
         assert index.dtype == self._dtype
 
-        for size in index.sizes:
-            self._sizes.append(size)
+        if start is None and end is None:
+            self._sizes.extend(index.sizes.tolist())
+            offset, count = 0, os.path.getsize(data_file_path(another_file))
+        else:
+            start = 0 if start is None else start
+            end = len(index) if end is None else end
+            sizes = index.sizes[start:end]
+            self._sizes.extend(sizes.tolist())
+            if len(sizes) == 0:
+                return
+            offset = int(index[start][0])
+            count = int(sizes.sum()) * index.dtype().itemsize
 
         # Concatenate data
-        with open(data_file_path(another_file), "rb") as f:
-            shutil.copyfileobj(f, self._data_file)
+        self._data_file.flush()
+        position = self._data_file.tell()
+        _copy_data(
+            data_file_path(another_file), self._data_file.name, offset, position, count
+        )
+        self._data_file.seek(0, os.SEEK_END)
+
+    def merge_files_(self, other_files, num_workers=1, remove=False):
+        """
+        Append several datasets at once: their data is copied concurrently to
+        its final position, and each file is deleted as soon as it has been
+        copied if `remove` is set.
+        """
+        counts = []
+        for another_file in other_files:
+            index = MMapIndexedDataset.Index(index_file_path(another_file))
+            assert index.dtype == self._dtype
+            self._sizes.extend(index.sizes.tolist())
+            counts.append(os.path.getsize(data_file_path(another_file)))
+
+        self._data_file.flush()
+        positions = np.cumsum([self._data_file.tell()] + counts).tolist()
+        os.truncate(self._data_file.name, positions[-1])
+
+        def merge(i):
+            _copy_data(
+                data_file_path(other_files[i]),
+                self._data_file.name,
+                0,
+                positions[i],
+                counts[i],
+            )
+            if remove:
+                os.remove(data_file_path(other_files[i]))
+                os.remove(index_file_path(other_files[i]))
+
+        if num_workers > 1 and len(other_files) > 1:
+            with ThreadPool(min(num_workers, len(other_files))) as pool:
+                pool.map(merge, range(len(other_files)))
+        else:
+            for i in range(len(other_files)):
+                merge(i)
+        self._data_file.seek(0, os.SEEK_END)
 
     def finalize(self, index_file):
         self._data_file.close()
@@ -10,12 +10,16 @@ import operator
 import os
 import queue
 import time
+import weakref
 from threading import Thread
 from typing import Iterator, List
 
 import numpy as np
 import torch
+from torch._utils import ExceptionWrapper
+
 from fairseq.data import data_utils
+from fairseq.logging import metrics
 
 
 logger = logging.getLogger(__name__)
@@ -303,6 +307,9 @@ class EpochBatchIterator(EpochBatchIterating):
         grouped_shuffling (bool, optional): enable shuffling batches in groups
             of num_shards. Ensures that each GPU receives similar length sequences when
             batches are sorted by length.
+        buffer_process (bool, optional): fill the buffer from a background
+            process instead of a thread, see :class:`BufferedIterator`
+            (default: ``False``).
     """
 
     def __init__(
@@ -322,6 +329,7 @@ class EpochBatchIterator(EpochBatchIterating):
         grouped_shuffling=False,
         reuse_dataloader=False,
         persistent_workers=True,
+        buffer_process=False,
     ):
         assert isinstance(dataset, torch.utils.data.Dataset)
         self.dataset = dataset
@@ -338,6 +346,7 @@ class EpochBatchIterator(EpochBatchIterating):
         # This upper limit here is to prevent people from abusing this feature
         # in a shared computing environment.
         self.buffer_size = min(buffer_size, 20)
+        self.buffer_process = buffer_process and self.buffer_size > 0
         self.timeout = timeout
         self.disable_shuffling = disable_shuffling
         self.skip_remainder_batch = skip_remainder_batch
@@ -506,7 +515,8 @@ class EpochBatchIterator(EpochBatchIterating):
                 batch_sampler=self.epoch_batch_sampler,
                 num_workers=self.num_workers,
                 timeout=self.timeout,
-                pin_memory=True,
+                # a background buffer process must not initialize CUDA
+                pin_memory=not self.buffer_process,
                 persistent_workers=self.persistent_workers,
             )
 
@@ -515,7 +525,9 @@ class EpochBatchIterator(EpochBatchIterating):
 
         # Wrap with a BufferedIterator if needed
         if self.buffer_size > 0:
-            itr = BufferedIterator(self.buffer_size, itr)
+            itr = BufferedIterator(
+                self.buffer_size, itr, use_process=self.buffer_process
+            )
 
         # Wrap with CountingIterator
         itr = CountingIterator(itr, start=offset)
@@ -688,26 +700,68 @@ class BackgroundConsumer(Thread):
             self._queue.put(e)
 
 
+def _background_process_consumer(queue, source, max_len, done):
+    """Fill *queue* from a forked process. Tensors are sent through shared
+    memory, and this process never touches CUDA."""
+    data_utils.disable_pin_memory()
+    try:
+        for count, item in enumerate(source, start=1):
+            queue.put(item)
+            if max_len is not None and count >= max_len:
+                break
+        queue.put(StopIteration())
+    except Exception:
+        queue.put(ExceptionWrapper(where="in background data loading process"))
+    # the shared memory of the last items is handed over by this process,
+    # so it has to stay alive until they are received
+    done.acquire()
+
+
 class BufferedIterator(object):
-    def __init__(self, size, iterable):
-        self._queue = queue.Queue(size)
+    """Prefetch up to *size* items of *iterable* in the background.
+
+    By default the items are produced by a thread. With *use_process*, they
+    are produced by a forked process and sent back through shared memory, so
+    that collating batches does not compete with training for the GIL.
+    Batches built in the process are not pinned.
+
+    The depth of the queue and the time spent waiting for each item are
+    logged as the ``data_queue`` and ``data_stall`` metrics.
+    """
+
+    def __init__(self, size, iterable, use_process=False):
+        if use_process:
+            context = torch.multiprocessing.get_context("fork")
+            self._queue = context.Queue(size)
+            self._done = context.Semaphore(0)
+        else:
+            self._queue = queue.Queue(size)
         self._iterable = iterable
         self._consumer = None
-
-        self.start_time = time.time()
-        self.warning_time = None
+        self.use_process = use_process
 
         self.total = len(iterable)
 
     def _create_consumer(self):
-        self._consumer = BackgroundConsumer(
-            self._queue,
-            self._iterable,
-            self.total,
-            torch.cuda.current_device() if torch.cuda.is_available() else None,
-        )
-        self._consumer.daemon = True
-        self._consumer.start()
+        if self.use_process:
+            # not a daemon, as it starts the DataLoader workers, so it has to
+            # be terminated explicitly, also before multiprocessing joins it
+            # at exit
+            self._consumer = torch.multiprocessing.get_context("fork").Process(
+                target=_background_process_consumer,
+                args=(self._queue, self._iterable, self.total, self._done),
+            )
+            self._consumer.start()
+            weakref.finalize(self, self._consumer.terminate)
+        else:
+            self._consumer = BackgroundConsumer(
+                self._queue,
+                self._iterable,
+                self.total,
+                torch.cuda.current_device() if torch.cuda.is_available() else None,
+            )
+            self._consumer.daemon = True
+            self._consumer.start()
 
     def __iter__(self):
         return self
@@ -727,26 +781,30 @@ class BufferedIterator(object):
         if self._consumer is None:
             self._create_consumer()
 
-        # Notify the user if there is a data loading bottleneck
-        if self._queue.qsize() < min(2, max(1, self._queue.maxsize // 2)):
-            if time.time() - self.start_time > 5 * 60:
-                if (
-                    self.warning_time is None
-                    or time.time() - self.warning_time > 15 * 60
-                ):
-                    logger.debug(
-                        "Data loading buffer is empty or nearly empty. This may "
-                        "indicate a data loading bottleneck, and increasing the "
-                        "number of workers (--num-workers) may help."
-                    )
-                    self.warning_time = time.time()
+        try:
+            depth = self._queue.qsize()
+        except NotImplementedError:  # multiprocessing queues on macOS
+            depth = None
 
         # Get next example
+        start = time.perf_counter()
         item = self._queue.get(True)
+        if isinstance(item, (ExceptionWrapper, Exception)) and self.use_process:
+            self._done.release()
+        if isinstance(item, ExceptionWrapper):
+            item.reraise()
         if isinstance(item, Exception):
             raise item
         if item is _sentinel:
             raise StopIteration()
+
+        # a queue that runs empty indicates a data loading bottleneck, which
+        # more workers (--num-workers) or --data-buffer-process may help
+        if depth is not None:
+            metrics.log_scalar("data_queue", depth, priority=900, round=1)
+        metrics.log_scalar(
+            "data_stall", time.perf_counter() - start, priority=900, round=3
+        )
         return item
 
 
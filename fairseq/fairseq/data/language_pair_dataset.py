@@ -8,6 +8,7 @@ import logging
 import numpy as np
 import torch
 from fairseq.data import FairseqDataset, data_utils
+from fairseq.data.indexed_dataset import MMapIndexedDataset
 
 
 logger = logging.getLogger(__name__)
@@ -165,6 +166,94 @@ def collate(
     return batch
 
 
+def collate_gathered(
+    samples,
+    pad_idx,
+    eos_idx,
+    left_pad_source=True,
+    left_pad_target=False,
+    input_feeding=True,
+    pad_to_length=None,
+    pad_to_multiple=1,
+    pin_memory=False,
+):
+    """Same as :func:`collate` for the concatenated samples returned by
+    :meth:`LanguagePairDataset.__getitems__`.
+
+    The samples are sorted before being written into the batch, so each
+    token is copied once, straight from the dataset buffer into tensors
+    allocated in pinned memory if *pin_memory* is set.
+    """
+    if len(samples["id"]) == 0:
+        return {}
+
+    def merge(key, left_pad, move_eos_to_beginning=False, pad_to_length=None):
+        return data_utils.collate_flat_tokens(
+            samples[key],
+            samples[key + "_sizes"],
+            pad_idx,
+            eos_idx,
+            left_pad,
+            move_eos_to_beginning,
+            pad_to_length=pad_to_length,
+            pad_to_multiple=pad_to_multiple,
+            sort_order=sort_order,
+            pin_memory=pin_memory,
+            starts=samples[key + "_starts"],
+        )
+
+    # sort by descending source length, which is the size of the samples
+    # unless they contain padding
+    src_pad_to_length = pad_to_length["source"] if pad_to_length is not None else None
+    src_lengths, sort_order = torch.from_numpy(samples["source_sizes"]).sort(
+        descending=True
+    )
+    src_tokens = merge("source", left_pad_source, pad_to_length=src_pad_to_length)
+    lengths = src_tokens.ne(pad_idx).long().sum(1)
+    if not torch.equal(lengths, src_lengths):
+        src_lengths = torch.empty_like(lengths)
+        src_lengths[sort_order] = lengths
+        src_lengths, sort_order = src_lengths.sort(descending=True)
+        src_tokens = merge("source", left_pad_source, pad_to_length=src_pad_to_length)
+    id = samples["id"].index_select(0, sort_order)
+
+    prev_output_tokens = None
+    target = None
+    if samples.get("target", None) is not None:
+        tgt_pad_to_length = (
+            pad_to_length["target"] if pad_to_length is not None else None
+        )
+        target = merge(
+            "target", left_pad=left_pad_target, pad_to_length=tgt_pad_to_length
+        )
+        ntokens = target.ne(pad_idx).long().sum().item()
+        if input_feeding:
+            # we create a shifted version of targets for feeding the
+            # previous output token(s) into the next decoder step
+            prev_output_tokens = merge(
+                "target",
+                left_pad=left_pad_target,
+                move_eos_to_beginning=True,
+                pad_to_length=tgt_pad_to_length,
+            )
+    else:
+        ntokens = src_lengths.sum().item()
+
+    batch = {
+        "id": id,
+        "nsentences": len(id),
+        "ntokens": ntokens,
+        "net_input": {
+            "src_tokens": src_tokens,
+            "src_lengths": src_lengths,
+        },
+        "target": target,
+    }
+    if prev_output_tokens is not None:
+        batch["net_input"]["prev_output_tokens"] = prev_output_tokens
+    return batch
+
+
 class LanguagePairDataset(FairseqDataset):
     """
     A pair of torch.utils.data.Datasets.
@@ -202,6 +291,9 @@ class LanguagePairDataset(FairseqDataset):
         tgt_lang_id (int, optional): target language ID, if set, the collated batch
             will contain a field 'tgt_lang_id' which indicates the target language
              of the samples.
+        min_padding_batches (bool, optional): split the length-sorted samples
+            into the fewest batches with the least source and target padding
+            instead of filling batches greedily (default: False).
     """
 
     def __init__(
@@ -226,6 +318,7 @@ class LanguagePairDataset(FairseqDataset):
         src_lang_id=None,
         tgt_lang_id=None,
         pad_to_multiple=1,
+        min_padding_batches=False,
     ):
         if tgt_dict is not None:
             assert src_dict.pad() == tgt_dict.pad()
@@ -297,6 +390,7 @@ class LanguagePairDataset(FairseqDataset):
         else:
             self.buckets = None
         self.pad_to_multiple = pad_to_multiple
+        self.min_padding_batches = min_padding_batches
 
     def get_batch_shapes(self):
         return self.buckets
@@ -338,6 +432,44 @@ class LanguagePairDataset(FairseqDataset):
             example["constraints"] = self.constraints[index]
         return example
 
+    def __getitems__(self, indices):
+        """Fetch the samples at *indices* for :func:`collater`.
+
+        When the source and target are plain :class:`MMapIndexedDataset` and
+        the samples need no editing, they are only located in the data buffer
+        of each side, and read by :func:`collater` straight into the batch.
+        They are returned as a dict of the ``id`` tensor and, for the
+        ``source`` and ``target`` sides, of the data buffer and the
+        ``{side}_starts`` and ``{side}_sizes`` of the samples in it. Otherwise
+        this returns a list of :func:`__getitem__` samples.
+        """
+        if not self._can_gather():
+            return [self[index] for index in indices]
+        samples = {"id": torch.LongTensor(indices)}
+        for key, dataset in [("source", self.src), ("target", self.tgt)]:
+            if dataset is not None:
+                (
+                    samples[key],
+                    samples[key + "_starts"],
+                    samples[key + "_sizes"],
+                ) = dataset.spans(indices)
+        return samples
+
+    def _can_gather(self):
+        return (
+            # subclasses reading or collating samples their own way expect
+            # the samples of __getitem__
+            type(self).__getitem__ is LanguagePairDataset.__getitem__
+            and type(self).collater is LanguagePairDataset.collater
+            and isinstance(self.src, MMapIndexedDataset)
+            and (self.tgt is None or isinstance(self.tgt, MMapIndexedDataset))
+            and not self.append_eos_to_target
+            and not self.append_bos
+            and not self.remove_eos_from_source
+            and self.align_dataset is None
+            and self.constraints is None
+        )
+
     def __len__(self):
         return len(self.src)
 
@@ -345,7 +477,8 @@ class LanguagePairDataset(FairseqDataset):
         """Merge a list of samples to form a mini-batch.
 
         Args:
-            samples (List[dict]): samples to collate
+            samples (List[dict]): samples to collate, or the concatenated
+                samples returned by :func:`__getitems__`
             pad_to_length (dict, optional): a dictionary of
                 {'source': source_pad_to_length, 'target': target_pad_to_length}
                 to indicate the max length to pad to in source and target respectively.
@@ -377,7 +510,14 @@ class LanguagePairDataset(FairseqDataset):
                 - `tgt_lang_id` (LongTensor): a long Tensor which contains target language
                    IDs of each sample in the batch
         """
-        res = collate(
+        kwargs = {}
+        if isinstance(samples, dict):
+            collate_fn = collate_gathered
+            # pinning the batch here saves the DataLoader a copy
+            kwargs["pin_memory"] = data_utils.can_pin_memory()
+        else:
+            collate_fn = collate
+        res = collate_fn(
             samples,
             pad_idx=self.src_dict.pad(),
             eos_idx=self.eos,
@@ -386,6 +526,7 @@ class LanguagePairDataset(FairseqDataset):
             input_feeding=self.input_feeding,
             pad_to_length=pad_to_length,
             pad_to_multiple=self.pad_to_multiple,
+            **kwargs,
         )
         if self.src_lang_id is not None or self.tgt_lang_id is not None:
             src_tokens = res["net_input"]["src_tokens"]
@@ -443,6 +584,33 @@ class LanguagePairDataset(FairseqDataset):
                 np.argsort(self.bucketed_num_tokens[indices], kind="mergesort")
             ]
 
+    def batch_by_size(
+        self,
+        indices,
+        max_tokens=None,
+        max_sentences=None,
+        required_batch_size_multiple=1,
+    ):
+        if not self.min_padding_batches or self.buckets is not None:
+            return super().batch_by_size(
+                indices,
+                max_tokens=max_tokens,
+                max_sentences=max_sentences,
+                required_batch_size_multiple=required_batch_size_multiple,
+            )
+        padding_sizes = self.src_sizes[indices]
+        if self.tgt_sizes is not None:
+            padding_sizes = np.stack([padding_sizes, self.tgt_sizes[indices]], axis=1)
+        return data_utils.batch_by_size(
+            indices,
+            num_tokens_fn=self.num_tokens,
+            num_tokens_vec=self.num_tokens_vec(indices).astype("int64"),
+            max_tokens=max_tokens,
+            max_sentences=max_sentences,
+            required_batch_size_multiple=required_batch_size_multiple,
+            padding_sizes=padding_sizes,
+        )
+
     @property
     def supports_prefetch(self):
         return getattr(self.src, "supports_prefetch", False) and (
@@ -456,6 +624,19 @@ class LanguagePairDataset(FairseqDataset):
         if self.align_dataset is not None:
             self.align_dataset.prefetch(indices)
 
+    @property
+    def can_reuse_epoch_itr_across_epochs(self):
+        return all(
+            getattr(dataset, "can_reuse_epoch_itr_across_epochs", True)
+            for dataset in [self.src, self.tgt, self.align_dataset]
+        )
+
+    def set_epoch(self, epoch):
+        super().set_epoch(epoch)
+        for dataset in [self.src, self.tgt, self.align_dataset]:
+            if hasattr(dataset, "set_epoch"):
+                dataset.set_epoch(epoch)
+
     def filter_indices_by_size(self, indices, max_sizes):
         """Filter a list of sample indices. Remove those that are longer
             than specified in max_sizes.
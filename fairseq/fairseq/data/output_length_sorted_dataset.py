@@ -0,0 +1,69 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+
+from . import BaseWrapperDataset, FairseqDataset
+
+
+class OutputLengthSortedDataset(BaseWrapperDataset):
+    """Orders and batches a dataset for generation by predicted output length.
+
+    The output length of a sentence is predicted from its source length as
+    ``max_len_a * src_len + max_len_b``, or as the source length itself when
+    *max_len_a* is 0 (where ``max_len_b`` is only a cap). Sentences are
+    ordered longest first, so that the sentences of a batch stop decoding at
+    about the same step, and ``--max-tokens`` is enforced on the predicted
+    output lengths instead of the source and reference lengths.
+
+    Args:
+        dataset (~fairseq.data.FairseqDataset): dataset to wrap
+        src_sizes (np.ndarray): source sentence lengths
+        max_len_a (float): see ``--max-len-a``
+        max_len_b (int): see ``--max-len-b``
+    """
+
+    def __init__(self, dataset, src_sizes, max_len_a=0, max_len_b=200):
+        super().__init__(dataset)
+        self.max_len_a = max_len_a
+        self.max_len_b = max_len_b
+        src_sizes = np.asarray(src_sizes, dtype=np.int64)
+        if max_len_a > 0:
+            self.output_sizes = np.ceil(max_len_a * src_sizes).astype(np.int64)
+            self.output_sizes += max_len_b
+        else:
+            self.output_sizes = src_sizes
+
+    def __getitems__(self, indices):
+        if hasattr(self.dataset, "__getitems__"):
+            return self.dataset.__getitems__(indices)
+        return [self.dataset[index] for index in indices]
+
+    def num_tokens(self, index):
+        return self.output_sizes[index]
+
+    def num_tokens_vec(self, indices):
+        return self.output_sizes[indices]
+
+    def ordered_indices(self):
+        # stable, so that sentences of the same length keep the order of the
+        # wrapped dataset
+        indices = self.dataset.ordered_indices()
+        return indices[np.argsort(-self.output_sizes[indices], kind="mergesort")]
+
+    def batch_by_size(
+        self,
+        indices,
+        max_tokens=None,
+        max_sentences=None,
+        required_batch_size_multiple=1,
+    ):
+        return FairseqDataset.batch_by_size(
+            self,
+            indices,
+            max_tokens=max_tokens,
+            max_sentences=max_sentences,
+            required_batch_size_multiple=required_batch_size_multiple,
+        )
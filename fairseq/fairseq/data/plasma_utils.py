@@ -6,6 +6,8 @@
 
 import hashlib
 import json
+import os
+import shutil
 import subprocess
 import tempfile
 from typing import Hashable
@@ -195,3 +197,56 @@ class PlasmaStore:
         _server = subprocess.Popen(["plasma_store", "-m", str(nbytes), "-s", path])
         plasma.connect(path, num_retries=200)  # If we can't connect we fail immediately
         return _server
+
+
+DEFAULT_SHARED_CACHE_PATH = "/dev/shm/fairseq"
+
+
+class SharedFileCache:
+    """Host-local cache of read-only files in shared memory, without Plasma.
+
+    Like :class:`PlasmaView`, the data is stored once per host under a hash
+    key, here the hash of the file content: files are copied into a tmpfs
+    directory (such as /dev/shm) and every process memory-maps the same copy.
+    Processes reading identical files, even from different paths (e.g. copies
+    of a data-bin), then share one copy of their pages.
+
+    Copies stay in the cache until they are deleted (or the host reboots).
+    """
+
+    def __init__(self, path: str = DEFAULT_SHARED_CACHE_PATH):
+        self.path = path
+
+    @staticmethod
+    def file_hash(filename: str, chunk_size: int = 2**24) -> str:
+        hash = hashlib.blake2b(digest_size=20)
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                hash.update(chunk)
+        return hash.hexdigest()
+
+    def get(self, filename: str) -> str:
+        """Returns the path of the shared copy of *filename*."""
+        ext = os.path.splitext(filename)[1]
+        # remember the hash of this very file, to only hash it once
+        stat = os.stat(filename)
+        alias = os.path.join(
+            self.path,
+            f"{stat.st_dev}-{stat.st_ino}-{stat.st_size}-{stat.st_mtime_ns}{ext}",
+        )
+        if os.path.exists(alias):
+            return os.path.realpath(alias)
+
+        os.makedirs(self.path, exist_ok=True)
+        cached = os.path.join(self.path, self.file_hash(filename) + ext)
+        if not os.path.exists(cached):
+            self._atomic(lambda tmp: shutil.copyfile(filename, tmp), cached)
+        self._atomic(lambda tmp: os.symlink(os.path.basename(cached), tmp), alias)
+        return cached
+
+    @staticmethod
+    def _atomic(create, path):
+        # concurrent processes may create the same file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        create(tmp)
+        os.replace(tmp, path)
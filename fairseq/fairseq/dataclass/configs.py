@@ -494,6 +494,13 @@ class DatasetConfig(FairseqDataclass):
     data_buffer_size: int = field(
         default=10, metadata={"help": "Number of batches to preload"}
     )
+    data_buffer_process: bool = field(
+        default=False,
+        metadata={
+            "help": "preload batches in a background process rather than a thread, "
+            "so that collating them does not compete with training for the GIL"
+        },
+    )
     train_subset: str = field(
         default="train",
         metadata={"help": "data subset to use for training (e.g. train, valid, test)"},
@@ -844,6 +851,58 @@ class GenerationConfig(FairseqDataclass):
             "help": "generate sequences of maximum length ax + b, where x is the source length for the first-pass decoder"
         },
     )
+    sort_by_output_length: bool = field(
+        default=False,
+        metadata={
+            "help": "batch sentences by their predicted output length (ax + b, or x "
+            "if a is 0) longest first, enforce --max-tokens on it, and print the "
+            "results in the order of the dataset"
+        },
+    )
+    continuous_batching: int = field(
+        default=0,
+        metadata={
+            "help": "if > 0, keep up to this many sentences decoding and start the "
+            "next sentences in the slots of finished ones (use a smaller "
+            "--batch-size/--max-tokens to load them); beam search with "
+            "Transformer models only"
+        },
+    )
+    preallocate_kv_cache: bool = field(
+        default=False,
+        metadata={
+            "help": "write the keys and values of the decoder self-attention in "
+            "place into preallocated buffers at each step, and reorder them into "
+            "spare buffers, instead of concatenating and reallocating them"
+        },
+    )
+    bound_early_stopping: bool = field(
+        default=False,
+        metadata={
+            "help": "finish a sentence as soon as none of its active hypotheses "
+            "can score higher than its --nbest best finished ones, instead of "
+            "waiting for --beam finished hypotheses (needs --unkpen >= 0)"
+        },
+    )
+    encoder_out_cache_mb: int = field(
+        default=0,
+        metadata={
+            "help": "if > 0, cache the encoder outputs of up to this many MB of "
+            "sentences in host memory, keyed by checkpoint hash and sample id, "
+            "and reuse them when the same sentences are decoded again by the "
+            "same checkpoint"
+        },
+    )
+    decoding_configs: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "decode with several configs in one pass over the data, given "
+            "as a JSON list of generation args overriding the others, e.g. "
+            '\'[{"beam": 4}, {"beam": 8, "lenpen": 1.2}]\'. The encoder runs '
+            "once per batch and the output of config i is written to "
+            "generate-{subset}.{i}.txt in --results-path"
+        },
+    )
     min_len: int = field(
         default=1,
         metadata={"help": "minimum generation length"},
@@ -944,6 +1003,22 @@ class GenerationConfig(FairseqDataclass):
         default=-1.0,
         metadata={"help": "strength of diversity penalty for Diverse Siblings Search"},
     )
+    fold_duplicate_outputs: bool = field(
+        default=False,
+        metadata={
+            "help": "with a duplicated vocabulary, fold the duplicated variants of "
+            "each token (複複k複複token) into a single output of the decoder, which "
+            "only generates base tokens (Transformer models only)"
+        },
+    )
+    merge_duplicates: bool = field(
+        default=False,
+        metadata={
+            "help": "with a duplicated vocabulary, add up the probabilities of the "
+            "duplicated variants of a token (複複k複複token) and only search over "
+            "the base tokens"
+        },
+    )
     print_alignment: Optional[PRINT_ALIGNMENT_CHOICES] = field(
         default=None,
         metadata={
@@ -1095,6 +1170,35 @@ class InteractiveConfig(FairseqDataclass):
         default="-",
         metadata={"help": "file to read from; use - for stdin"},
     )
+    server_host: str = field(
+        default="localhost",
+        metadata={"help": "host to serve on with fairseq-interactive-server"},
+    )
+    server_port: Optional[int] = field(
+        default=None,
+        metadata={"help": "TCP port to serve on with fairseq-interactive-server"},
+    )
+    server_socket: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "unix socket to serve on with fairseq-interactive-server, "
+            "instead of a TCP port"
+        },
+    )
+    max_batch_delay: float = field(
+        default=10.0,
+        metadata={
+            "help": "with fairseq-interactive-server, decode a batch before it "
+            "is full once its first sentence has waited this many milliseconds"
+        },
+    )
+    preprocess_workers: int = field(
+        default=2,
+        metadata={
+            "help": "number of processes tokenizing and applying BPE to the "
+            "requests of fairseq-interactive-server"
+        },
+    )
 
 
 @dataclass
@@ -0,0 +1,223 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import hashlib
+import logging
+import weakref
+from collections import OrderedDict
+from typing import Dict, List
+
+import torch
+from torch import Tensor
+
+logger = logging.getLogger(__name__)
+
+# (time dim, batch dim) of the tensors of the output of a
+# :class:`~fairseq.models.transformer.TransformerEncoder`
+ENCODER_OUT_LAYOUTS = {
+    "encoder_out": (0, 1),
+    "encoder_states": (0, 1),
+    "fc_results": (0, 1),
+    "encoder_embedding": (1, 0),
+    "encoder_padding_mask": (1, 0),
+    "src_tokens": (1, 0),
+    "src_lengths": (None, 0),
+}
+
+
+def checkpoint_hash(model: torch.nn.Module) -> str:
+    """Hash of the names and values of the parameters and buffers of *model*."""
+    sha = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        sha.update(name.encode())
+        if tensor.dim() == 0:
+            tensor = tensor.view(1)
+        sha.update(tensor.detach().cpu().contiguous().view(torch.uint8).numpy())
+    return sha.hexdigest()
+
+
+class EncoderOutCache(object):
+    """LRU cache of the encoder outputs of sentences, in host memory.
+
+    The outputs are cached per sentence, keyed by the hash of the checkpoint
+    (see :func:`checkpoint_hash`) and the sample id, without their padding, so
+    that they can be reassembled into batches padded to other lengths. The
+    source tokens are checked on each hit, as ids are only unique within a
+    dataset. The hash of a model is only recomputed after its parameters or
+    buffers are modified (e.g. by an optimizer step).
+
+    Only the outputs of encoders returning them in the format of a
+    :class:`~fairseq.models.transformer.TransformerEncoder` are cached, the
+    other encoders are always run.
+
+    Args:
+        max_bytes (int): the maximum size of the cached outputs, beyond which
+            the least recently used ones are dropped
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        # model -> (its tensors and their versions, hash), held weakly so
+        # that a model loaded in the place of a freed one is hashed again
+        self.hashes = weakref.WeakKeyDictionary()
+        # models whose outputs cannot be cached
+        self.uncacheable = weakref.WeakSet()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def model_hash(self, model: torch.nn.Module) -> str:
+        tensors = list(model.parameters()) + list(model.buffers())
+        cached = self.hashes.get(model)
+        if cached is None or not _same_versions(cached[0], tensors):
+            versions = [(weakref.ref(t), t._version) for t in tensors]
+            cached = (versions, checkpoint_hash(model))
+            self.hashes[model] = cached
+        return cached[1]
+
+    def forward_encoder(
+        self, models, net_input: Dict[str, Tensor], ids: Tensor
+    ) -> List[Dict[str, List[Tensor]]]:
+        """Run the encoder of each of *models* on *net_input*, unless the
+        outputs of all the sentences, identified by their sample *ids*, are
+        cached."""
+        src_tokens = net_input["src_tokens"]
+        ids = ids.tolist()
+        encoder_outs = []
+        for model in models:
+            padding_idx = getattr(model.encoder, "padding_idx", None)
+            if padding_idx is None or model in self.uncacheable:
+                encoder_outs.append(model.encoder.forward_torchscript(net_input))
+                continue
+            padding_mask = src_tokens.eq(padding_idx)
+            lengths = (~padding_mask).long().sum(dim=1).tolist()
+            tokens = (~padding_mask).nonzero(as_tuple=True)
+            src_sents = [x.clone() for x in src_tokens[tokens].cpu().split(lengths)]
+            model_hash = self.model_hash(model)
+            keys = [(model_hash, i) for i in ids]
+            outputs = [self._get(key, src) for key, src in zip(keys, src_sents)]
+            if all(output is not None for output in outputs):
+                self.hits += len(outputs)
+                encoder_out = self._merge(outputs, padding_mask, padding_idx)
+            else:
+                self.misses += len(outputs)
+                encoder_out = model.encoder.forward_torchscript(net_input)
+                if _is_cacheable(encoder_out, padding_mask):
+                    outputs = self._split(encoder_out, tokens, lengths)
+                    for key, src, output in zip(keys, src_sents, outputs):
+                        self._put(key, src, output)
+                else:
+                    logger.warning(
+                        f"not caching the outputs of {type(model.encoder).__name__}, "
+                        "which are not one per source token"
+                    )
+                    self.uncacheable.add(model)
+            encoder_outs.append(encoder_out)
+        return encoder_outs
+
+    def _get(self, key, src_tokens: Tensor):
+        entry = self.entries.get(key)
+        if entry is None or not torch.equal(entry[0], src_tokens):
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def _put(self, key, src_tokens: Tensor, output: Dict[str, List[Tensor]]):
+        num_bytes = _num_bytes(src_tokens, output)
+        if num_bytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.num_bytes -= _num_bytes(*self.entries.pop(key))
+        self.entries[key] = (src_tokens, output)
+        self.num_bytes += num_bytes
+        while self.num_bytes > self.max_bytes:
+            _, dropped = self.entries.popitem(last=False)
+            self.num_bytes -= _num_bytes(*dropped)
+
+    def _split(
+        self, encoder_out: Dict[str, List[Tensor]], tokens, lengths: List[int]
+    ) -> List[Dict[str, List[Tensor]]]:
+        """Split the non-padding steps of the encoder output of a batch by
+        sentence, into copies in host memory."""
+        outputs = [{} for _ in lengths]
+        for name, values in encoder_out.items():
+            time_dim, batch_dim = ENCODER_OUT_LAYOUTS[name]
+            for output in outputs:
+                output[name] = []
+            for x in values:
+                if x is None:
+                    sents = [None] * len(lengths)
+                elif time_dim is None:
+                    sents = [y.clone() for y in x.movedim(batch_dim, 0).cpu()]
+                else:
+                    x = x.movedim((batch_dim, time_dim), (0, 1))[tokens].cpu()
+                    sents = [y.clone() for y in x.split(lengths)]
+                for output, sent in zip(outputs, sents):
+                    output[name].append(sent)
+        return outputs
+
+    def _merge(
+        self,
+        outputs: List[Dict[str, List[Tensor]]],
+        padding_mask: Tensor,
+        padding_idx: int,
+    ) -> Dict[str, List[Tensor]]:
+        """Pad the cached outputs of the sentences of a batch as given by
+        *padding_mask*."""
+        bsz, src_len = padding_mask.size()
+        tokens = ~padding_mask.cpu()
+        encoder_out = {}
+        for name in outputs[0]:
+            time_dim, batch_dim = ENCODER_OUT_LAYOUTS[name]
+            if name == "encoder_padding_mask":
+                fill = True
+            elif name == "src_tokens":
+                fill = padding_idx
+            else:
+                fill = 0
+            encoder_out[name] = []
+            for j, value in enumerate(outputs[0][name]):
+                if value is None:
+                    encoder_out[name].append(None)
+                    continue
+                sents = [output[name][j] for output in outputs]
+                if time_dim is None:
+                    x = torch.stack(sents)
+                else:
+                    x = value.new_full((bsz, src_len) + value.shape[1:], fill)
+                    x[tokens] = torch.cat(sents)
+                    x = x.movedim((0, 1), (batch_dim, time_dim))
+                encoder_out[name].append(x.to(padding_mask.device))
+        return encoder_out
+
+
+def _is_cacheable(encoder_out, padding_mask: Tensor) -> bool:
+    if not isinstance(encoder_out, dict) or any(
+        name not in ENCODER_OUT_LAYOUTS or not isinstance(values, list)
+        for name, values in encoder_out.items()
+    ):
+        return False
+    encoder_padding_mask = encoder_out.get("encoder_padding_mask", [])
+    return len(encoder_padding_mask) == 1 and torch.equal(
+        encoder_padding_mask[0], padding_mask
+    )
+
+
+def _same_versions(versions, tensors: List[Tensor]) -> bool:
+    return len(versions) == len(tensors) and all(
+        ref() is t and version == t._version
+        for (ref, version), t in zip(versions, tensors)
+    )
+
+
+def _num_bytes(src_tokens: Tensor, output: Dict[str, List[Tensor]]) -> int:
+    tensors = [src_tokens]
+    for values in output.values():
+        tensors.extend(x for x in values if x is not None)
+    return sum(x.numel() * x.element_size() for x in tensors)
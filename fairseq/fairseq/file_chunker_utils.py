@@ -34,6 +34,57 @@ def find_offsets(filename: str, num_chunks: int) -> tp.List[int]:
         return offsets
 
 
+def find_offsets_every(filename: str, chunk_bytes: int) -> tp.List[int]:
+    """
+    like find_offsets, but cut the file about every `chunk_bytes` bytes
+    instead of in a fixed number of chunks, so that the chunks before a
+    modification of the file keep the same boundaries.
+    """
+    with open(filename, "r", encoding="utf-8") as f:
+        size = os.fstat(f.fileno()).st_size
+        offsets = [0]
+        for pos in range(chunk_bytes, size, chunk_bytes):
+            if pos <= offsets[-1]:
+                continue
+            f.seek(pos)
+            _safe_readline(f)
+            offset = f.tell()
+            if offset >= size:
+                break
+            offsets.append(offset)
+        offsets.append(size)
+        return offsets
+
+
+def read_line_batches(
+    filename: str, start_offset: int, end_offset: int, batch_bytes: int = 2**22
+) -> tp.Iterable[tp.List[str]]:
+    """
+    Read the lines of a file chunk in batches of about `batch_bytes` bytes.
+    Same lines as ChunkLineIterator (without the line endings), but the file
+    is read in binary blocks and positions are tracked by counting bytes,
+    instead of calling the slow f.tell() of text files after every line.
+    """
+    with open(filename, "rb") as f:
+        f.seek(start_offset)
+        while True:
+            size = batch_bytes
+            if end_offset > 0:
+                size = min(size, end_offset - f.tell())
+                if size <= 0:
+                    break
+            block = f.read(size)
+            if not block:
+                break
+            # complete the last line of the block without going past the chunk
+            if end_offset > 0:
+                block += f.readline(max(end_offset - f.tell(), 0))
+            else:
+                block += f.readline()
+            # bytes.splitlines() splits on the same universal newlines as text files
+            yield [line.decode("utf-8") for line in block.splitlines()]
+
+
 class ChunkLineIterator:
     """
     Iterator to properly iterate over lines of a file chunck.
@@ -174,6 +174,9 @@ class BaseFairseqModel(nn.Module):
             else getattr(cfg.generation, "beam", 5)
         )
         kwargs["need_attn"] = getattr(cfg.generation, "print_alignment", False)
+        kwargs["fold_duplicate_outputs"] = getattr(
+            cfg.generation, "fold_duplicate_outputs", False
+        )
         if getattr(cfg.generation, "retain_dropout", False):
             kwargs["retain_dropout"] = cfg.generation.retain_dropout
             kwargs["retain_dropout_modules"] = cfg.generation.retain_dropout_modules
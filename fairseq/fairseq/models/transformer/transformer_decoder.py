@@ -11,6 +11,7 @@ import torch.nn as nn
 from torch import Tensor
 
 from fairseq import utils
+from fairseq.data.duplication_sampling_dataset import get_duplicate_variants
 from fairseq.distributed import fsdp_wrap
 from fairseq.models import FairseqIncrementalDecoder
 from fairseq.models.transformer import TransformerConfig
@@ -27,6 +28,10 @@ from fairseq.modules import (
 from fairseq.modules.checkpoint_activations import checkpoint_wrapper
 from fairseq.modules.quant_noise import quant_noise as apply_quant_noise_
 
+# key of the incremental state entry marking the rows of prev_output_tokens as
+# possibly left-padded, see SequenceGenerator.generate_continuous
+LEFT_PADDED_TARGET = "left_padded_target"
+
 
 # rewrite name for backward compatibility in `make_generation_fast_`
 def module_name_fordropout(module_name: str) -> str:
@@ -139,6 +144,14 @@ class TransformerDecoderBase(FairseqIncrementalDecoder):
         if self.output_projection is None:
             self.build_output_projection(cfg, dictionary, embed_tokens)
 
+        # see fold_duplicate_outputs_
+        self.output_ids: Optional[Tensor] = None
+        self.output_index: Optional[Tensor] = None
+        self.variant_ids: Optional[Tensor] = None
+        self.variant_groups: Optional[Tensor] = None
+        self.group_ids: Optional[Tensor] = None
+        self.group_outputs: Optional[Tensor] = None
+
     def build_output_projection(self, cfg, dictionary, embed_tokens):
         if cfg.adaptive_softmax_cutoff is not None:
             self.adaptive_softmax = AdaptiveSoftmax(
@@ -291,11 +304,20 @@ class TransformerDecoderBase(FairseqIncrementalDecoder):
             padding_mask = encoder_out["encoder_padding_mask"][0]
 
         # embed positions
-        positions = None
+        positions: Optional[Tensor] = None
         if self.embed_positions is not None:
-            positions = self.embed_positions(
-                prev_output_tokens, incremental_state=incremental_state
-            )
+            if (
+                incremental_state is not None
+                and "left_padded_target" in incremental_state
+            ):
+                # left-padded rows (see SequenceGenerator.generate_continuous)
+                # count their positions from their first token; the key is
+                # spelled out as TorchScript cannot read LEFT_PADDED_TARGET
+                positions = self.embed_positions(prev_output_tokens)
+            else:
+                positions = self.embed_positions(
+                    prev_output_tokens, incremental_state=incremental_state
+                )
 
         if incremental_state is not None:
             prev_output_tokens = prev_output_tokens[:, -1:]
@@ -373,10 +395,70 @@ class TransformerDecoderBase(FairseqIncrementalDecoder):
         """Project features to the vocabulary size."""
         if self.adaptive_softmax is None:
             # project back to size of vocabulary
-            return self.output_projection(features)
+            logits = self.output_projection(features)
+            if self.output_ids is not None:
+                logits = self.fold_duplicates(logits)
+            return logits
         else:
             return features
 
+    def make_generation_fast_(self, fold_duplicate_outputs: bool = False, **kwargs):
+        if fold_duplicate_outputs:
+            self.fold_duplicate_outputs_()
+
+    def fold_duplicate_outputs_(self):
+        """
+        Fold the duplicated variants of each token (``複複k複複token``) into a
+        single output, for inference.
+
+        :func:`output_layer` then returns one logit per base token, in the order
+        of ``self.output_ids`` (their ids in the dictionary): the logsumexp of
+        the logits of the token and its variants, so that the softmax gives the
+        sum of their probabilities. ``self.output_index`` maps the ids of the
+        dictionary to these outputs, and variants to the output of their base
+        token. The special symbols must come before the variants, so that they
+        keep their ids.
+        """
+        assert self.adaptive_softmax is None, "cannot fold an adaptive softmax"
+        variant_ids, base_ids = get_duplicate_variants(self.dictionary)
+        device = self.output_projection.weight.device
+        variant_ids = torch.tensor(variant_ids, dtype=torch.long, device=device)
+        base_ids = torch.tensor(base_ids, dtype=torch.long, device=device)
+
+        is_output = torch.ones(len(self.dictionary), dtype=torch.bool, device=device)
+        is_output[variant_ids] = False
+        output_index = is_output.long().cumsum(0) - 1
+        output_index[variant_ids] = output_index[base_ids]
+        nspecial = self.dictionary.nspecial
+        assert output_index[:nspecial].tolist() == list(range(nspecial))
+
+        self.output_ids = is_output.nonzero().squeeze(1)
+        self.output_index = output_index
+        self.variant_ids = variant_ids
+        self.group_ids, self.variant_groups = torch.unique(
+            base_ids, return_inverse=True
+        )
+        self.group_outputs = output_index[self.group_ids]
+
+    def fold_duplicates(self, logits):
+        """Fold the logits over the dictionary into the outputs of
+        :func:`fold_duplicate_outputs_`."""
+        assert self.output_ids is not None
+        assert self.variant_ids is not None and self.variant_groups is not None
+        assert self.group_ids is not None and self.group_outputs is not None
+        folded = logits.index_select(-1, self.output_ids)
+        if self.variant_ids.numel() > 0:
+            # logsumexp of each group, relative to the maximum of each row
+            max_logits = logits.max(dim=-1, keepdim=True)[0]
+            group_sums = torch.exp(logits.index_select(-1, self.group_ids) - max_logits)
+            group_sums.index_add_(
+                -1,
+                self.variant_groups,
+                torch.exp(logits.index_select(-1, self.variant_ids) - max_logits),
+            )
+            folded.index_copy_(-1, self.group_outputs, group_sums.log() + max_logits)
+        return folded
+
     def max_positions(self):
         """Maximum output length supported by the decoder."""
         if self.embed_positions is None:
@@ -142,6 +142,7 @@ class MultiheadAttention(FairseqIncrementalDecoder):
 
         self.add_zero_attn = add_zero_attn
         self.beam_size = 1
+        self.preallocate_kv_cache = False
         self.reset_parameters()
 
         if self.use_xformers:
@@ -636,6 +637,9 @@ class MultiheadAttention(FairseqIncrementalDecoder):
                 prev_key = _prev_key.view(kv_bsz * self.num_heads, -1, self.head_dim)
                 if static_kv:
                     k = prev_key
+                elif self._preallocates_kv_cache():
+                    assert k is not None
+                    k = self._append_to_kv_buffer(saved_state, "prev_key", _prev_key, k)
                 else:
                     assert k is not None
                     k = torch.cat([prev_key, k], dim=1)
@@ -649,6 +653,11 @@ class MultiheadAttention(FairseqIncrementalDecoder):
                 )
                 if static_kv:
                     v = prev_value
+                elif self._preallocates_kv_cache():
+                    assert v is not None
+                    v = self._append_to_kv_buffer(
+                        saved_state, "prev_value", _prev_value, v
+                    )
                 else:
                     assert v is not None
                     v = torch.cat([prev_value, v], dim=1)
@@ -835,7 +844,12 @@ class MultiheadAttention(FairseqIncrementalDecoder):
         """Reorder buffered internal state (for incremental generation)."""
         input_buffer = self._get_input_buffer(incremental_state)
         if input_buffer is not None:
+            reordered: List[str] = []
+            if self._preallocates_kv_cache():
+                reordered = self._reorder_kv_buffers(input_buffer, new_order)
             for k in input_buffer.keys():
+                if k in reordered or k.endswith("_buffer"):
+                    continue
                 input_buffer_k = input_buffer[k]
                 if input_buffer_k is not None:
                     if self.encoder_decoder_attention:
@@ -858,6 +872,74 @@ class MultiheadAttention(FairseqIncrementalDecoder):
         """Used for effiecient beamable enc-dec attention"""
         self.beam_size = beam_size
 
+    def set_preallocate_kv_cache(self, preallocate_kv_cache: bool):
+        """Used for writing the keys and values of the steps of incremental
+        self-attention in place into preallocated buffers, instead of
+        concatenating them to the cached ones at each step.
+
+        The buffers have room for as many steps again as they hold when they
+        are (re)allocated, and are reordered into spare buffers of the same
+        size, which are then swapped with them. The cached keys and values are
+        views of the buffers: they are only valid until the next step and
+        must not be shared between incremental states. Only used in eager
+        mode, without autograd.
+        """
+        self.preallocate_kv_cache = preallocate_kv_cache
+
+    def _preallocates_kv_cache(self) -> bool:
+        return (
+            self.preallocate_kv_cache
+            and not torch.jit.is_scripting()
+            and not torch.is_grad_enabled()
+        )
+
+    @torch.jit.unused
+    def _append_to_kv_buffer(
+        self,
+        saved_state: Dict[str, Optional[Tensor]],
+        name: str,
+        prev: Tensor,
+        x: Tensor,
+    ) -> Tensor:
+        """Write the keys or values *x* of the new steps after those of the
+        previous steps *prev*, of shape (bsz, num_heads, seq_len, head_dim), in
+        the buffer of *saved_state*. Returns the keys or values of all the
+        steps, a view of the buffer of shape (bsz * num_heads, seq_len,
+        head_dim)."""
+        bsz, num_heads, prev_len, head_dim = prev.size()
+        new_len = prev_len + x.size(1)
+        buffer = saved_state.get(name + "_buffer")
+        if buffer is None or not _is_prefix(prev, buffer) or buffer.size(2) < new_len:
+            buffer = prev.new_empty(bsz, num_heads, 2 * new_len, head_dim)
+            buffer[:, :, :prev_len] = prev
+            saved_state[name + "_buffer"] = buffer
+        buffer[:bsz, :, prev_len:new_len] = x.view(bsz, num_heads, -1, head_dim)
+        return buffer[:bsz, :, :new_len].view(bsz * num_heads, new_len, head_dim)
+
+    @torch.jit.unused
+    def _reorder_kv_buffers(
+        self, input_buffer: Dict[str, Optional[Tensor]], new_order: Tensor
+    ) -> List[str]:
+        """Reorder the cached keys and values held in buffers into the spare
+        buffers, and swap them. Returns the names of the reordered ones."""
+        reordered = []
+        for name in ["prev_key", "prev_value"]:
+            prev = input_buffer.get(name)
+            buffer = input_buffer.get(name + "_buffer")
+            if prev is None or buffer is None or not _is_prefix(prev, buffer):
+                continue
+            spare = input_buffer.get(name + "_spare_buffer")
+            bsz = new_order.numel()
+            if spare is None or spare.size(0) < bsz or spare.size(2) < buffer.size(2):
+                spare = buffer.new_empty((bsz,) + buffer.size()[1:])
+            input_buffer[name] = torch.index_select(
+                prev, 0, new_order, out=spare[:bsz, :, : prev.size(2)]
+            )
+            input_buffer[name + "_buffer"] = spare
+            input_buffer[name + "_spare_buffer"] = buffer
+            reordered.append(name)
+        return reordered
+
     def _get_input_buffer(
         self, incremental_state: Optional[Dict[str, Dict[str, Optional[Tensor]]]]
     ) -> Dict[str, Optional[Tensor]]:
@@ -908,3 +990,13 @@ class MultiheadAttention(FairseqIncrementalDecoder):
 
         for key, value in items_to_add.items():
             state_dict[key] = value
+
+
+def _is_prefix(x: Tensor, buffer: Tensor) -> bool:
+    """Whether *x* is ``buffer[:n, :, :m]``."""
+    return (
+        x.data_ptr() == buffer.data_ptr()
+        and x.stride() == buffer.stride()
+        and x.size(0) <= buffer.size(0)
+        and x.size(2) <= buffer.size(2)
+    )
@@ -4,7 +4,6 @@
 """ Wrapper for ngram_repeat_block cuda extension """
 import math
 import warnings
-from typing import List
 
 import torch
 from torch import nn
@@ -37,7 +36,11 @@ def is_cuda_extension_usable() -> bool:
 
 
 class NGramRepeatBlock(nn.Module):
-    """Wrapper class for calling ngram_repeat_block cuda extension"""
+    """Wrapper class for calling ngram_repeat_block cuda extension
+
+    Without the extension, the same tokens are blocked by a vectorised
+    implementation that works on any device.
+    """
 
     def __init__(self, no_repeat_ngram_size: int, use_extension: bool = True):
         super().__init__()
@@ -94,27 +97,25 @@ class NGramRepeatBlock(nn.Module):
             )
 
     def _no_repeat_ngram(self, tokens, lprobs, bsz: int, beam_size: int, step: int):
-        """For each hypothesis generate a list of previous ngrams and set associated lprobs to -inf"""
-        banned_tokens = [
-            torch.jit.annotate(List[int], []) for bbsz_idx in range(bsz * beam_size)
-        ]
-        if step + 2 - self.no_repeat_ngram_size >= 0:
-            cpu_tokens: List[List[int]] = tokens.cpu().tolist()
-            check_start_pos = step + 2 - self.no_repeat_ngram_size
-            for bbsz_idx in range(bsz * beam_size):
-                ngram_to_check = cpu_tokens[bbsz_idx][
-                    -(self.no_repeat_ngram_size - 1) :
-                ]
-                for i in range(check_start_pos):
-                    if (
-                        ngram_to_check
-                        == cpu_tokens[bbsz_idx][i : i + self.no_repeat_ngram_size - 1]
-                    ):
-                        banned_tokens[bbsz_idx].append(
-                            cpu_tokens[bbsz_idx][i + self.no_repeat_ngram_size - 1]
-                        )
-        for bbsz_idx in range(bsz * beam_size):
-            lprobs[bbsz_idx][
-                torch.tensor(banned_tokens[bbsz_idx], dtype=torch.int64)
-            ] = torch.tensor(-math.inf).to(lprobs)
-        return lprobs
+        """For each hypothesis, find the earlier occurrences of its last n-1 tokens
+        and set the lprobs of the tokens which followed them to -inf"""
+        ngram_size = self.no_repeat_ngram_size
+        # number of earlier n-grams, as in the cuda kernel only tokens up to
+        # *step* are looked at (*tokens* may be the whole buffer, padded beyond)
+        num_ngrams = step + 2 - ngram_size
+        if num_ngrams <= 0:
+            return lprobs
+        tokens = tokens[:, : step + 1]
+        if ngram_size > 1:
+            # (bsz * beam_size, num_ngrams, ngram_size - 1)
+            prefixes = tokens[:, :step].unfold(1, ngram_size - 1, 1)
+            current = tokens[:, num_ngrams:].unsqueeze(1)
+            matches = (prefixes == current).all(dim=2)
+        else:
+            matches = torch.ones_like(tokens, dtype=torch.bool)
+        banned_tokens = tokens[:, ngram_size - 1 :]
+        # a token may be banned several times, so -inf is added rather than set
+        penalties = torch.zeros(
+            banned_tokens.size(), dtype=lprobs.dtype, device=lprobs.device
+        ).masked_fill_(matches, -math.inf)
+        return lprobs.scatter_add_(1, banned_tokens, penalties)
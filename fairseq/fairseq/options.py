@@ -305,6 +305,15 @@ def add_preprocess_args(parser):
                        help="number of parallel workers")
     group.add_argument("--dict-only", action='store_true',
                        help="if true, only builds a dictionary and then exits")
+    group.add_argument("--fast-binarize", action='store_true',
+                       help="encode whole batches of lines with a vectorized binarizer "
+                            "(whitespace tokenization, mmap datasets only)")
+    group.add_argument("--incremental", action='store_true',
+                       help="keep a manifest of the input chunks in destdir and only "
+                            "binarize the chunks that changed since the last run "
+                            "(mmap datasets only)")
+    group.add_argument("--incremental-chunk-mb", metavar="N", default=64, type=int,
+                       help="size of the input chunks hashed by --incremental")
     # fmt: on
     return parser
 
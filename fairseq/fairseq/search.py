@@ -9,6 +9,7 @@ from typing import List, Optional
 
 import torch
 import torch.nn as nn
+from fairseq.data.duplication_sampling_dataset import get_duplicate_variants
 from fairseq.token_generation_constraints import (
     ConstraintState,
     OrderedConstraintState,
@@ -890,3 +891,58 @@ class DiverseSiblingsSearch(Search):
             final_indices[i] = indices[i][final_indices[i]]
 
         return final_scores, final_indices, final_beams
+
+
+class DuplicateAwareBeamSearch(Search):
+    """Beam search for vocabularies with duplicated tokens.
+
+    With duplication BPE, a token ``x`` can have variants ``複複k複複x`` that
+    are the same string after ``--post-process``, so plain beam search can
+    spend most of the beam on equivalent hypotheses. Here the probabilities of
+    the variants of each token are added to the token itself (with logsumexp)
+    before the beam search step, and the variants are never selected. Every
+    candidate is then a distinct string, and hypotheses only contain base
+    tokens.
+    """
+
+    def __init__(self, tgt_dict):
+        super().__init__(tgt_dict)
+        self.beam = BeamSearch(tgt_dict)
+
+        variant_ids, base_ids = get_duplicate_variants(tgt_dict)
+        self.variant_ids = torch.tensor(variant_ids, dtype=torch.long)
+        # the base tokens with variants, and the index of the base of each
+        # variant among them
+        self.group_ids, self.variant_groups = torch.unique(
+            torch.tensor(base_ids, dtype=torch.long), return_inverse=True
+        )
+
+    @torch.jit.export
+    def merge_variants(self, lprobs):
+        """Add the probabilities of the variants of each token to the token
+        itself, and set the log-probabilities of the variants to -inf."""
+        variant_ids = self.variant_ids.to(lprobs.device)
+        group_ids = self.group_ids.to(lprobs.device)
+        # logsumexp relative to the maximum of each hypothesis
+        max_lprobs = lprobs.max(dim=-1, keepdim=True)[0]
+        group_probs = torch.exp(lprobs.index_select(-1, group_ids) - max_lprobs)
+        group_probs.index_add_(
+            -1,
+            self.variant_groups.to(lprobs.device),
+            torch.exp(lprobs.index_select(-1, variant_ids) - max_lprobs),
+        )
+        lprobs = lprobs.index_copy(-1, group_ids, group_probs.log() + max_lprobs)
+        return lprobs.index_fill_(-1, variant_ids, -math.inf)
+
+    @torch.jit.export
+    def step(
+        self,
+        step: int,
+        lprobs,
+        scores: Optional[Tensor],
+        prev_output_tokens: Optional[Tensor] = None,
+        original_batch_idxs: Optional[Tensor] = None,
+    ):
+        if self.variant_ids.numel() > 0:
+            lprobs = self.merge_variants(lprobs)
+        return self.beam.step(step, lprobs, scores)
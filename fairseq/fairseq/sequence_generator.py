@@ -5,7 +5,8 @@
 
 import math
 import sys
-from typing import Dict, List, Optional
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 import torch
 import torch.nn as nn
@@ -14,6 +15,8 @@ from torch import Tensor
 from fairseq import search, utils
 from fairseq.data import data_utils
 from fairseq.models import FairseqIncrementalDecoder
+from fairseq.models.transformer.transformer_decoder import LEFT_PADDED_TARGET
+from fairseq.modules import MultiheadAttention
 from fairseq.ngram_repeat_block import NGramRepeatBlock
 
 
@@ -39,6 +42,9 @@ class SequenceGenerator(nn.Module):
         lm_model=None,
         lm_weight=1.0,
         tokens_to_suppress=(),
+        preallocate_kv_cache=False,
+        early_stop_nbest=0,
+        encoder_out_cache=None,
     ):
         """Generates translations of a given source sentence.
 
@@ -63,6 +69,21 @@ class SequenceGenerator(nn.Module):
                 sharper samples (default: 1.0)
             match_source_len (bool, optional): outputs should match the source
                 length (default: False)
+            preallocate_kv_cache (bool, optional): write the keys and values
+                of the decoder self-attention in place into preallocated
+                buffers at each step, instead of concatenating them to the
+                cached ones, see
+                :func:`~fairseq.modules.MultiheadAttention.set_preallocate_kv_cache`
+                (default: False)
+            early_stop_nbest (int, optional): if > 0, finish a sentence as soon
+                as this many hypotheses are finalized and no active one can
+                score higher than them, instead of waiting for *beam_size*
+                finalized hypotheses. Only these best hypotheses are then
+                complete. The bound relies on token scores being non-positive
+                (default: 0)
+            encoder_out_cache (~fairseq.encoder_out_cache.EncoderOutCache,
+                optional): reuse the encoder outputs of the sentences of
+                samples with ids across calls (default: None)
         """
         super().__init__()
         if isinstance(models, EnsembleModel):
@@ -91,10 +112,26 @@ class SequenceGenerator(nn.Module):
             ).long()
 
         self.vocab_size = len(tgt_dict)
+        if self.model.output_ids is not None:
+            # search over the outputs of decoders that fold duplicated tokens
+            # (see TransformerDecoderBase.fold_duplicate_outputs_)
+            self.vocab_size = self.model.output_ids.numel()
+            if self.token_indices_to_suppress is not None:
+                self.token_indices_to_suppress = self.model.output_index.cpu()[
+                    self.token_indices_to_suppress
+                ]
+            if lm_model is not None or isinstance(
+                search_strategy, search.DuplicateAwareBeamSearch
+            ):
+                raise ValueError(
+                    "folded duplicate outputs are incompatible with an LM and "
+                    "with --merge-duplicates"
+                )
         self.beam_size = beam_size
         # the max beam size is the dictionary size - 1, since we never select pad
         self.beam_size = min(beam_size, self.vocab_size - 1)
         self.model.set_decoder_beam_size(self.beam_size)
+        self.model.set_decoder_preallocate_kv_cache(preallocate_kv_cache)
         self.max_len_a = max_len_a
         self.max_len_b = max_len_b
         self.min_len = min_len
@@ -105,6 +142,9 @@ class SequenceGenerator(nn.Module):
         self.unk_penalty = unk_penalty
         self.temperature = temperature
         self.match_source_len = match_source_len
+        self.early_stop_nbest = min(early_stop_nbest, self.beam_size)
+        self.encoder_out_cache = encoder_out_cache
+        self.use_encoder_out_cache = encoder_out_cache is not None
 
         if no_repeat_ngram_size > 0:
             self.repeat_ngram_blocker = NGramRepeatBlock(no_repeat_ngram_size)
@@ -116,6 +156,14 @@ class SequenceGenerator(nn.Module):
         self.search = (
             search.BeamSearch(tgt_dict) if search_strategy is None else search_strategy
         )
+        if early_stop_nbest > 0:
+            if unk_penalty < 0 or (lm_model is not None and lm_weight < 0):
+                raise ValueError(
+                    "early stopping needs non-positive token scores, without a "
+                    "negative unk penalty or LM weight"
+                )
+            if isinstance(self.search, search.Sampling):
+                raise ValueError("early stopping is not supported with sampling")
         # We only need to set src_lengths in LengthConstrainedBeamSearch.
         # As a module attribute, setting it would break in multithread
         # settings when the model is shared.
@@ -200,15 +248,484 @@ class SequenceGenerator(nn.Module):
                 the list of constraints
             bos_token (int, optional): beginning of sentence token
                 (default: self.eos)
+            encoder_outs (List[dict], optional): the output of
+                ``self.model.forward_encoder`` on the ``net_input`` of
+                *sample*, e.g. to share it between generators with different
+                settings (default: computed from *sample*)
         """
         return self._generate(sample, **kwargs)
 
+    @torch.no_grad()
+    def generate_continuous(
+        self, samples: Iterable[Dict], max_sentences: int
+    ) -> Iterator[Tuple[Dict, List[List[Dict[str, Tensor]]]]]:
+        """Generate translations of a stream of batches with continuous batching.
+
+        Up to *max_sentences* sentences are decoded at once. When sentences
+        finish, their slots are refilled with the next sentences of *samples*,
+        so the batch does not shrink as decoding proceeds. New sentences are
+        encoded and take their first step on their own; their encoder outputs
+        and incremental states are then padded and appended to the running
+        ones, with their target side left-padded up to the current step.
+
+        Only beam search with decoders whose incremental state consists of
+        :class:`~fairseq.modules.MultiheadAttention` caches (e.g. Transformer
+        models) is supported, without prefix tokens, constraints or an LM.
+
+        Args:
+            samples (Iterable[dict]): batches, as for :func:`generate`
+            max_sentences (int): maximum number of sentences decoded at once
+
+        Yields:
+            tuple: each batch of *samples* with its hypotheses, as returned by
+            :func:`generate`, once all its sentences are finished. Batches may
+            finish out of order.
+        """
+        if type(self.search) is not search.BeamSearch or self.lm_model is not None:
+            raise NotImplementedError(
+                "continuous batching only supports beam search without an LM"
+            )
+        if not self.model.has_incremental_states():
+            raise NotImplementedError("continuous batching needs incremental decoders")
+        if self.early_stop_nbest > 0:
+            raise NotImplementedError(
+                "early stopping is not supported with continuous batching"
+            )
+        beam_size = self.beam_size
+        cand_size = 2 * beam_size
+        # refill once a quarter of the slots are free, to amortize the extra
+        # encoder and decoder calls that start new sentences
+        min_refill = max(1, max_sentences // 4)
+        samples = iter(samples)
+        # batches with sentences left to start, with the next row to start
+        pending = deque()
+        # batch and row of each running sentence
+        live: List[Tuple[Dict, int]] = []
+        # tensors of the running sentences, see _start_sentences
+        state: Dict[str, Tensor] = {}
+        encoder_outs = incremental_states = None
+
+        while True:
+            lprobs: Optional[Tensor] = None
+            if len(live) > 0:
+                lprobs, _ = self.model.forward_decoder(
+                    state["tokens"], encoder_outs, incremental_states, self.temperature
+                )
+
+            # start new sentences in the free slots
+            free = max_sentences - len(live)
+            while free >= min_refill:
+                if len(pending) == 0:
+                    sample = next(samples, None)
+                    if sample is None:
+                        break
+                    pending.append([self._start_batch(sample), 0])
+                    continue
+                batch, row = pending[0]
+                num = min(free, batch["bsz"] - row)
+                if row + num == batch["bsz"]:
+                    pending.popleft()
+                else:
+                    pending[0][1] += num
+                (
+                    new_state,
+                    new_encoder_outs,
+                    new_incremental_states,
+                    new_lprobs,
+                ) = self._start_sentences(batch, row, num)
+                if len(live) == 0:
+                    state = new_state
+                    encoder_outs = new_encoder_outs
+                    incremental_states = new_incremental_states
+                    lprobs = new_lprobs
+                else:
+                    length = state["tokens"].size(1)
+                    self._cat_states(state, new_state)
+                    encoder_outs = [
+                        self._cat_encoder_out(a, b)
+                        for a, b in zip(encoder_outs, new_encoder_outs)
+                    ]
+                    self._cat_incremental_states(
+                        incremental_states, new_incremental_states, length
+                    )
+                    lprobs = torch.cat([lprobs, new_lprobs])
+                live.extend((batch, i) for i in range(row, row + num))
+                free -= num
+            if len(live) == 0:
+                break
+            assert lprobs is not None
+
+            bsz = len(live)
+            tokens, scores = state["tokens"], state["scores"]
+            # the step of each sentence
+            steps = tokens.size(1) - 1 - state["start"]
+            beam_steps = steps.repeat_interleave(beam_size)
+            lprobs[lprobs != lprobs] = torch.tensor(-math.inf).to(lprobs)
+            lprobs[:, self.pad] = -math.inf  # never select pad
+            lprobs[:, self.unk] -= self.unk_penalty  # apply unk penalty
+            # handle max length constraint
+            at_max_len = beam_steps >= state["max_lens"].repeat_interleave(beam_size)
+            lprobs[at_max_len, : self.eos] = -math.inf
+            lprobs[at_max_len, self.eos + 1 :] = -math.inf
+            # minimum length constraint
+            lprobs[:, self.eos].masked_fill_(beam_steps < self.min_len, -math.inf)
+            if self.token_indices_to_suppress is not None:
+                lprobs[:, self.token_indices_to_suppress] = -math.inf
+            if self.repeat_ngram_blocker is not None:
+                lprobs = self.repeat_ngram_blocker(
+                    tokens, lprobs, bsz, beam_size, tokens.size(1) - 1
+                )
+            # all the hypotheses of a sentence are equal at its first step, so
+            # only use the first beam
+            lprobs = lprobs.view(bsz, beam_size, -1)
+            lprobs[:, 1:].masked_fill_(steps.eq(0).view(-1, 1, 1), -math.inf)
+
+            cand_scores, cand_indices, cand_beams = self.search.step(
+                1, lprobs, scores[:, -1:].view(bsz, beam_size, 1).type_as(lprobs)
+            )
+            bbsz_offsets = (torch.arange(0, bsz) * beam_size).unsqueeze(1).to(tokens)
+            cand_bbsz_idx = cand_beams.add(bbsz_offsets)
+
+            # finalize hypotheses that end in eos
+            eos_mask = cand_indices.eq(self.eos) & cand_scores.ne(-math.inf)
+            eos_mask[:, :beam_size][state["cands_to_ignore"]] = torch.tensor(0).to(
+                eos_mask
+            )
+            eos_bbsz_idx = torch.masked_select(
+                cand_bbsz_idx[:, :beam_size], mask=eos_mask[:, :beam_size]
+            )
+            finished_sents: List[int] = []
+            if eos_bbsz_idx.numel() > 0:
+                eos_scores = torch.masked_select(
+                    cand_scores[:, :beam_size], mask=eos_mask[:, :beam_size]
+                )
+                finished_sents = self._finalize_continuous(
+                    eos_bbsz_idx, eos_scores, state, live
+                )
+
+            # remove the finished sentences
+            finished_batches = []
+            if len(finished_sents) > 0:
+                for sent in finished_sents:
+                    batch = live[sent][0]
+                    batch["remaining"] -= 1
+                    if batch["remaining"] == 0:
+                        finished_batches.append(batch)
+                finished_sents_set = set(finished_sents)
+                keep = [i for i in range(bsz) if i not in finished_sents_set]
+                live = [live[i] for i in keep]
+                batch_idxs = torch.tensor(keep, dtype=torch.long).to(tokens.device)
+                eos_mask = eos_mask[batch_idxs]
+                cand_bbsz_idx = cand_bbsz_idx[batch_idxs]
+                cand_scores = cand_scores[batch_idxs]
+                cand_indices = cand_indices[batch_idxs]
+                for key in ["start", "max_lens", "src_lengths", "cands_to_ignore"]:
+                    state[key] = state[key][batch_idxs]
+
+            if len(live) > 0:
+                # select the top beam_size active hypotheses, as in _generate
+                cands_to_ignore = state["cands_to_ignore"]
+                eos_mask[:, :beam_size] = ~(
+                    (~cands_to_ignore) & (~eos_mask[:, :beam_size])
+                )
+                cand_offsets = torch.arange(0, cand_size).to(tokens)
+                active_mask = torch.add(
+                    eos_mask.type_as(cand_offsets) * cand_size,
+                    cand_offsets[: eos_mask.size(1)],
+                )
+                new_cands_to_ignore, active_hypos = torch.topk(
+                    active_mask, k=beam_size, dim=1, largest=False
+                )
+                cands_to_ignore = new_cands_to_ignore.ge(cand_size)[:, :beam_size]
+                assert (~cands_to_ignore).any(dim=1).all()
+                state["cands_to_ignore"] = cands_to_ignore
+
+                active_bbsz_idx = torch.gather(
+                    cand_bbsz_idx, dim=1, index=active_hypos
+                ).view(-1)
+                active_tokens = torch.gather(cand_indices, dim=1, index=active_hypos)
+                active_scores = torch.gather(cand_scores, dim=1, index=active_hypos)
+                state["tokens"] = torch.cat(
+                    [
+                        tokens.index_select(0, active_bbsz_idx),
+                        active_tokens.view(-1, 1),
+                    ],
+                    dim=1,
+                )
+                state["scores"] = torch.cat(
+                    [
+                        scores.index_select(0, active_bbsz_idx).type_as(active_scores),
+                        active_scores.view(-1, 1),
+                    ],
+                    dim=1,
+                )
+                self.model.reorder_incremental_state(
+                    incremental_states, active_bbsz_idx
+                )
+                encoder_outs = self.model.reorder_encoder_out(
+                    encoder_outs, active_bbsz_idx
+                )
+
+                # drop the columns before the oldest running sentence
+                first = int(state["start"].min())
+                if first > 0:
+                    state["tokens"] = state["tokens"][:, first:]
+                    state["scores"] = state["scores"][:, first:]
+                    state["start"] = state["start"] - first
+                    self._trim_incremental_states(incremental_states, first)
+            else:
+                state = {}
+                encoder_outs = incremental_states = None
+
+            for batch in finished_batches:
+                hypos = [
+                    sorted(sent, key=lambda hypo: hypo["score"].item(), reverse=True)
+                    for sent in batch["finalized"]
+                ]
+                yield batch["sample"], hypos
+
+    def _start_batch(self, sample: Dict) -> Dict:
+        """Bookkeeping of a batch of :func:`generate_continuous`."""
+        net_input = sample["net_input"]
+        assert "src_tokens" in net_input, "continuous batching needs src_tokens"
+        src_tokens = net_input["src_tokens"]
+        bsz, src_len = src_tokens.size()[:2]
+        if "src_lengths" in net_input:
+            src_lengths = net_input["src_lengths"]
+        else:
+            src_lengths = (
+                (src_tokens.ne(self.eos) & src_tokens.ne(self.pad)).long().sum(dim=1)
+            )
+        if self.match_source_len:
+            max_len = src_lengths.max().item()
+        else:
+            max_len = min(
+                int(self.max_len_a * src_len + self.max_len_b),
+                self.max_len - 1,
+            )
+        assert (
+            self.min_len <= max_len
+        ), "min_len cannot be larger than max_len, please adjust these!"
+        return {
+            "sample": sample,
+            "bsz": bsz,
+            "src_lengths": src_lengths,
+            "max_len": max_len,
+            "remaining": bsz,
+            "finalized": [[] for _ in range(bsz)],
+        }
+
+    def _start_sentences(self, batch: Dict, row: int, num: int):
+        """
+        Encode *num* sentences of *batch* from *row* and take their first step.
+
+        Returns the state of the sentences: the beam-level ``tokens`` and
+        cumulative ``scores`` (one column per step), and the sentence-level
+        column of the first token (``start``), ``max_lens``, ``src_lengths``
+        and ``cands_to_ignore``; then their encoder outputs, incremental
+        states and the lprobs of the first step.
+        """
+        beam_size = self.beam_size
+        net_input = {
+            k: v[row : row + num] if isinstance(v, Tensor) and v.dim() > 0 else v
+            for k, v in batch["sample"]["net_input"].items()
+        }
+        src_tokens = net_input["src_tokens"]
+        if self.use_encoder_out_cache and "id" in batch["sample"]:
+            encoder_outs = self._forward_encoder_cached(net_input, batch["sample"], row)
+        else:
+            encoder_outs = self.model.forward_encoder(net_input)
+        new_order = torch.arange(num).repeat_interleave(beam_size).to(src_tokens)
+        encoder_outs = self.model.reorder_encoder_out(encoder_outs, new_order)
+        incremental_states = [{} for _ in range(self.model.models_size)]
+        tokens = torch.full(
+            (num * beam_size, 1), self.eos, dtype=torch.long, device=src_tokens.device
+        )
+        lprobs, _ = self.model.forward_decoder(
+            tokens, encoder_outs, incremental_states, self.temperature
+        )
+        state = {
+            "tokens": tokens,
+            "scores": torch.zeros_like(tokens, dtype=torch.float),
+            "start": tokens.new_zeros(num),
+            "max_lens": tokens.new_full((num,), batch["max_len"]),
+            "src_lengths": batch["src_lengths"][row : row + num].to(tokens),
+            "cands_to_ignore": tokens.new_zeros(num, beam_size, dtype=torch.bool),
+        }
+        return state, encoder_outs, incremental_states, lprobs
+
+    def _cat_states(self, state: Dict[str, Tensor], new_state: Dict[str, Tensor]):
+        """Append the state of new sentences, whose first step is the last
+        column of the running ones."""
+        length = state["tokens"].size(1)
+        for key, value in new_state.items():
+            if key in ["tokens", "scores"]:
+                value = _pad_dim(
+                    value, 1, length, self.pad if key == "tokens" else 0, left=True
+                )
+            elif key == "start":
+                value = value + length - 1
+            state[key] = torch.cat([state[key], value.to(state[key])])
+
+    def _cat_encoder_out(
+        self, encoder_out: Dict[str, List[Tensor]], new_encoder_out
+    ) -> Dict[str, List[Tensor]]:
+        """Concatenate the encoder outputs of a
+        :class:`~fairseq.models.transformer.TransformerEncoder` along the batch,
+        padding the shorter sources."""
+        # (time dim, batch dim, padding value) of each tensor
+        layouts = {
+            "encoder_out": (0, 1, 0),
+            "encoder_states": (0, 1, 0),
+            "encoder_embedding": (1, 0, 0),
+            "encoder_padding_mask": (1, 0, True),
+            "src_tokens": (1, 0, self.pad),
+            "src_lengths": (None, 0, 0),
+        }
+        result = {}
+        for key, values in encoder_out.items():
+            if key not in layouts:
+                raise NotImplementedError(
+                    f"continuous batching cannot merge encoder outputs with {key}"
+                )
+            time_dim, batch_dim, value = layouts[key]
+            result[key] = []
+            for x, y in zip(values, new_encoder_out[key]):
+                if time_dim is not None:
+                    length = max(x.size(time_dim), y.size(time_dim))
+                    x = _pad_dim(x, time_dim, length, value)
+                    y = _pad_dim(y, time_dim, length, value)
+                result[key].append(torch.cat([x, y], dim=batch_dim))
+        return result
+
+    def _attention_modules(self, model, incremental_state) -> List[MultiheadAttention]:
+        modules = [
+            module
+            for module in model.decoder.modules()
+            if isinstance(module, MultiheadAttention)
+            and len(module._get_input_buffer(incremental_state)) > 0
+        ]
+        if len(modules) != len(incremental_state) - int(
+            LEFT_PADDED_TARGET in incremental_state
+        ):
+            raise NotImplementedError(
+                "continuous batching only supports incremental states of "
+                "MultiheadAttention caches"
+            )
+        return modules
+
+    def _cat_incremental_states(
+        self,
+        incremental_states: List[Dict[str, Dict[str, Optional[Tensor]]]],
+        new_incremental_states: List[Dict[str, Dict[str, Optional[Tensor]]]],
+        length: int,
+    ):
+        """Append the attention caches of new sentences, which took their first
+        step on their own, to the running ones of *length* steps."""
+        for model, state, new_state in zip(
+            self.model.models, incremental_states, new_incremental_states
+        ):
+            for module in self._attention_modules(model, new_state):
+                buffer = module._get_input_buffer(state)
+                new_buffer = module._get_input_buffer(new_state)
+                if module.self_attention:
+                    # the new sentences are left-padded up to the current step
+                    buffer = _pad_attention_buffer(buffer, length)
+                    new_buffer = _pad_attention_buffer(new_buffer, length, left=True)
+                else:
+                    src_len = max(
+                        buffer["prev_key"].size(2), new_buffer["prev_key"].size(2)
+                    )
+                    buffer = _pad_attention_buffer(buffer, src_len)
+                    new_buffer = _pad_attention_buffer(new_buffer, src_len)
+                module._set_input_buffer(
+                    state,
+                    {key: torch.cat([buffer[key], new_buffer[key]]) for key in buffer},
+                )
+            # the decoder can no longer count positions from the cache length
+            state[LEFT_PADDED_TARGET] = {}
+
+    def _trim_incremental_states(
+        self,
+        incremental_states: List[Dict[str, Dict[str, Optional[Tensor]]]],
+        first: int,
+    ):
+        """Drop the first *first* steps of the self-attention caches."""
+        for model, state in zip(self.model.models, incremental_states):
+            for module in self._attention_modules(model, state):
+                if module.self_attention:
+                    buffer = module._get_input_buffer(state)
+                    for key in ["prev_key", "prev_value"]:
+                        buffer[key] = buffer[key][:, :, first:]
+                    mask = buffer.get("prev_key_padding_mask")
+                    if mask is not None:
+                        buffer["prev_key_padding_mask"] = mask[:, first:]
+                    module._set_input_buffer(state, buffer)
+
+    def _finalize_continuous(
+        self,
+        bbsz_idx,
+        eos_scores,
+        state: Dict[str, Tensor],
+        live: List[Tuple[Dict, int]],
+    ) -> List[int]:
+        """Like :func:`finalize_hypos` for :func:`generate_continuous`, where
+        each sentence started at its own column. Returns the finished
+        sentences."""
+        beam_size = self.beam_size
+        length = state["tokens"].size(1)
+        tokens_clone = state["tokens"].index_select(0, bbsz_idx)
+        output_ids = self.model.output_ids
+        if output_ids is not None:
+            tokens_clone = output_ids[tokens_clone]
+        scores_clone = state["scores"].index_select(0, bbsz_idx).type_as(eos_scores)
+        eos = tokens_clone.new_full((1,), self.eos)
+        starts: List[int] = state["start"].tolist()
+        max_lens: List[int] = state["max_lens"].tolist()
+        src_lengths: List[int] = state["src_lengths"].tolist()
+
+        sents: List[int] = torch.div(
+            bbsz_idx, beam_size, rounding_mode="trunc"
+        ).tolist()
+        for i, sent in enumerate(sents):
+            batch, row = live[sent]
+            finalized = batch["finalized"][row]
+            if len(finalized) == beam_size:
+                continue
+            first, step = starts[sent] + 1, length - 1 - starts[sent]
+            # convert from cumulative to per-position scores
+            pos_scores = torch.cat([scores_clone[i, first:], eos_scores[i : i + 1]])
+            pos_scores[1:] = pos_scores[1:] - pos_scores[:-1]
+            score = eos_scores[i]
+            if self.normalize_scores:
+                score = score / (step + 1) ** self.len_penalty
+            if self.match_source_len and step > src_lengths[sent]:
+                score = torch.tensor(-math.inf).to(score)
+            finalized.append(
+                {
+                    "tokens": torch.cat([tokens_clone[i, first:], eos]),
+                    "score": score,
+                    "attention": torch.empty(0),
+                    "alignment": torch.empty(0),
+                    "positional_scores": pos_scores,
+                }
+            )
+
+        finished: List[int] = []
+        for sent in sorted(set(sents)):
+            batch, row = live[sent]
+            step = length - 1 - starts[sent]
+            if len(batch["finalized"][row]) == beam_size or step == max_lens[sent]:
+                finished.append(sent)
+        return finished
+
     def _generate(
         self,
         sample: Dict[str, Dict[str, Tensor]],
         prefix_tokens: Optional[Tensor] = None,
         constraints: Optional[Tensor] = None,
         bos_token: Optional[int] = None,
+        encoder_outs: Optional[List[Dict[str, List[Tensor]]]] = None,
     ):
         incremental_states = torch.jit.annotate(
             List[Dict[str, Dict[str, Optional[Tensor]]]],
@@ -261,6 +778,18 @@ class SequenceGenerator(nn.Module):
                 "Target-side constraints were provided, but search method doesn't support them"
             )
 
+        output_index = self.model.output_index
+        if output_index is not None:
+            # the decoders fold duplicated tokens: search over their outputs
+            if constraints is not None:
+                raise NotImplementedError(
+                    "constraints are not supported with folded duplicate outputs"
+                )
+            if prefix_tokens is not None:
+                prefix_tokens = output_index[prefix_tokens]
+            if bos_token is not None:
+                bos_token = int(output_index[bos_token].item())
+
         # Initialize constraints, when active
         self.search.init_constraints(constraints, beam_size)
 
@@ -276,8 +805,19 @@ class SequenceGenerator(nn.Module):
             self.min_len <= max_len
         ), "min_len cannot be larger than max_len, please adjust these!"
         # compute the encoder output for each beam
-        with torch.autograd.profiler.record_function("EnsembleModel: forward_encoder"):
-            encoder_outs = self.model.forward_encoder(net_input)
+        if encoder_outs is None:
+            with torch.autograd.profiler.record_function(
+                "EnsembleModel: forward_encoder"
+            ):
+                if self.use_encoder_out_cache and "id" in sample:
+                    encoder_outs = self._forward_encoder_cached(net_input, sample, 0)
+                else:
+                    encoder_outs = self.model.forward_encoder(net_input)
+        else:
+            # copy the given outputs, which some encoders reorder in place
+            encoder_outs = [
+                {k: v for k, v in encoder_out.items()} for encoder_out in encoder_outs
+            ]
 
         # placeholder of indices for bsz * beam_size to hold tokens and accumulative scores
         new_order = torch.arange(bsz).view(-1, 1).repeat(1, beam_size).view(-1)
@@ -307,14 +847,17 @@ class SequenceGenerator(nn.Module):
             torch.zeros(bsz, beam_size).to(src_tokens).eq(-1)
         )  # forward and backward-compatible False mask
 
-        # list of completed sentences
-        finalized = torch.jit.annotate(
-            List[List[Dict[str, Tensor]]],
-            [torch.jit.annotate(List[Dict[str, Tensor]], []) for i in range(bsz)],
-        )  # contains lists of dictionaries of infomation about the hypothesis being finalized at each step
-
-        # a boolean array indicating if the sentence at the index is finished or not
-        finished = [False for i in range(bsz)]
+        # buffers of the completed hypotheses of each sentence, see
+        # finalize_hypos, which are turned into dicts once decoding is done
+        finalized: Dict[str, Tensor] = {
+            "tokens": torch.full((bsz, beam_size, max_len + 1), self.pad).to(tokens),
+            "score": torch.zeros(bsz, beam_size).to(scores),
+            "positional_scores": torch.zeros(bsz, beam_size, max_len + 1).to(scores),
+            "length": torch.zeros(bsz, beam_size).to(tokens),
+            "count": torch.zeros(bsz).to(tokens),
+        }
+        # the index in the original batch of each sentence of the current one
+        batch_sents = torch.arange(bsz).to(tokens)
         num_remaining_sent = bsz  # number of sentences remaining
 
         # number of candidate hypos per step
@@ -405,6 +948,12 @@ class SequenceGenerator(nn.Module):
                     attn = torch.empty(
                         bsz * beam_size, avg_attn_scores.size(1), max_len + 2
                     ).to(scores)
+                    finalized["attention"] = torch.zeros(
+                        finalized["count"].numel(),
+                        beam_size,
+                        avg_attn_scores.size(1),
+                        max_len + 1,
+                    ).to(scores)
                 attn[:, :, step + 1].copy_(avg_attn_scores)
 
             scores = scores.type_as(lprobs)
@@ -460,7 +1009,7 @@ class SequenceGenerator(nn.Module):
                     tokens,
                     scores,
                     finalized,
-                    finished,
+                    batch_sents,
                     beam_size,
                     attn,
                     src_lengths,
@@ -468,6 +1017,19 @@ class SequenceGenerator(nn.Module):
                 )
                 num_remaining_sent -= len(finalized_sents)
 
+            if self.early_stop_nbest > 0 and step < max_len:
+                stopped_sents = self._stop_early(
+                    step,
+                    cand_scores,
+                    cand_indices,
+                    finalized,
+                    finalized_sents,
+                    batch_sents,
+                    max_len,
+                )
+                finalized_sents = finalized_sents + stopped_sents
+                num_remaining_sent -= len(stopped_sents)
+
             assert num_remaining_sent >= 0
             if num_remaining_sent == 0:
                 break
@@ -504,6 +1066,7 @@ class SequenceGenerator(nn.Module):
                     prefix_tokens = prefix_tokens[batch_idxs]
                 src_lengths = src_lengths[batch_idxs]
                 cands_to_ignore = cands_to_ignore[batch_idxs]
+                batch_sents = batch_sents[batch_idxs]
 
                 scores = scores.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
                 tokens = tokens.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
@@ -581,17 +1144,21 @@ class SequenceGenerator(nn.Module):
             # reorder incremental state in decoder
             reorder_state = active_bbsz_idx
 
-        # sort by score descending
-        for sent in range(len(finalized)):
-            scores = torch.tensor(
-                [float(elem["score"].item()) for elem in finalized[sent]]
-            )
-            _, sorted_scores_indices = torch.sort(scores, descending=True)
-            finalized[sent] = [finalized[sent][ssi] for ssi in sorted_scores_indices]
-            finalized[sent] = torch.jit.annotate(
-                List[Dict[str, Tensor]], finalized[sent]
-            )
-        return finalized
+        return self._finalized_hypos(finalized)
+
+    @torch.jit.unused
+    def _forward_encoder_cached(
+        self,
+        net_input: Dict[str, Tensor],
+        sample: Dict[str, Dict[str, Tensor]],
+        row: int,
+    ) -> Optional[List[Dict[str, List[Tensor]]]]:
+        """Run the encoder through :attr:`encoder_out_cache` on *net_input*,
+        the sentences of *sample* from *row*."""
+        if not self.model.has_encoder() or "src_tokens" not in net_input:
+            return self.model.forward_encoder(net_input)
+        ids = sample["id"][row : row + net_input["src_tokens"].size(0)]
+        return self.encoder_out_cache.forward_encoder(self.model.models, net_input, ids)
 
     def _prefix_tokens(
         self, step: int, lprobs, scores, tokens, prefix_tokens, beam_size: int
@@ -634,20 +1201,26 @@ class SequenceGenerator(nn.Module):
         eos_scores,
         tokens,
         scores,
-        finalized: List[List[Dict[str, Tensor]]],
-        finished: List[bool],
+        finalized: Dict[str, Tensor],
+        batch_sents,
         beam_size: int,
         attn: Optional[Tensor],
         src_lengths,
         max_len: int,
-    ):
-        """Finalize hypothesis, store finalized information in `finalized`, and change `finished` accordingly.
-        A sentence is finalized when {beam_size} finished items have been collected for it.
-
-        Returns number of sentences (not beam items) being finalized.
-        These will be removed from the batch and not processed further.
-        Args:
-            bbsz_idx (Tensor):
+    ) -> List[int]:
+        """Finalize hypotheses, by copying them into the next free slots of the
+        buffers in `finalized` of their sentences. These hold, for each sentence
+        of the original batch and each of its {beam_size} slots, the ``tokens``,
+        ``positional_scores`` and ``attention`` (if any) up to the ``length`` of
+        the hypothesis, and its ``score``; ``count`` is the number of
+        finalized hypotheses of each sentence.
+
+        A sentence is finalized when {beam_size} finished items have been
+        collected for it, or when the maximum length is reached.
+
+        Returns the indices in the current batch of the sentences being
+        finalized. These will be removed from the batch and not processed
+        further.
         """
         assert bbsz_idx.numel() == eos_scores.numel()
 
@@ -659,11 +1232,9 @@ class SequenceGenerator(nn.Module):
         ]  # skip the first index, which is EOS
 
         tokens_clone[:, step] = self.eos
-        attn_clone = (
-            attn.index_select(0, bbsz_idx)[:, :, 1 : step + 2]
-            if attn is not None
-            else None
-        )
+        output_ids = self.model.output_ids
+        if output_ids is not None:
+            tokens_clone = output_ids[tokens_clone]
 
         # compute scores per token position
         pos_scores = scores.index_select(0, bbsz_idx)[:, : step + 1]
@@ -675,86 +1246,178 @@ class SequenceGenerator(nn.Module):
         if self.normalize_scores:
             eos_scores /= (step + 1) ** self.len_penalty
 
-        # cum_unfin records which sentences in the batch are finished.
-        # It helps match indexing between (a) the original sentences
-        # in the batch and (b) the current, possibly-reduced set of
-        # sentences.
-        cum_unfin: List[int] = []
-        prev = 0
-        for f in finished:
-            if f:
-                prev += 1
-            else:
-                cum_unfin.append(prev)
-        cum_fin_tensor = torch.tensor(cum_unfin, dtype=torch.int).to(bbsz_idx)
-
+        # sentence index in the current (possibly reduced) batch, and in the
+        # original one
         unfin_idx = torch.div(bbsz_idx, beam_size, rounding_mode="trunc")
-        sent = unfin_idx + torch.index_select(cum_fin_tensor, 0, unfin_idx)
-
-        # Create a set of "{sent}{unfin_idx}", where
-        # "unfin_idx" is the index in the current (possibly reduced)
-        # list of sentences, and "sent" is the index in the original,
-        # unreduced batch
-        # For every finished beam item
-        # sentence index in the current (possibly reduced) batch
-        seen = (sent << 32) + unfin_idx
-        unique_seen: List[int] = torch.unique(seen).tolist()
+        sent = batch_sents.index_select(0, unfin_idx)
 
         if self.match_source_len:
             condition = step > torch.index_select(src_lengths, 0, unfin_idx)
             eos_scores = torch.where(condition, torch.tensor(-math.inf), eos_scores)
-        sent_list: List[int] = sent.tolist()
-        for i in range(bbsz_idx.size()[0]):
-            # An input sentence (among those in a batch) is finished when
-            # beam_size hypotheses have been collected for it
-            if len(finalized[sent_list[i]]) < beam_size:
-                if attn_clone is not None:
-                    # remove padding tokens from attn scores
-                    hypo_attn = attn_clone[i]
+
+        # the finished items of a sentence are contiguous in bbsz_idx: give
+        # them the slots following the already finalized hypotheses, and drop
+        # the ones beyond {beam_size}
+        counts = torch.bincount(unfin_idx, minlength=batch_sents.numel())
+        first = torch.cumsum(counts, dim=0) - counts
+        slot = (
+            finalized["count"].index_select(0, sent)
+            + torch.arange(bbsz_idx.numel()).to(bbsz_idx)
+            - first.index_select(0, unfin_idx)
+        )
+        keep = slot < beam_size
+        sent, slot = sent[keep], slot[keep]
+
+        fin_tokens = finalized["tokens"]
+        fin_tokens[sent, slot, : step + 1] = tokens_clone[keep]
+        fin_pos_scores = finalized["positional_scores"]
+        fin_pos_scores[sent, slot, : step + 1] = pos_scores[keep].to(fin_pos_scores)
+        finalized["score"][sent, slot] = eos_scores[keep].to(fin_pos_scores)
+        finalized["length"][sent, slot] = step + 1
+        finalized["count"].index_add_(0, sent, torch.ones_like(sent))
+        if attn is not None:
+            fin_attn = finalized["attention"]
+            attn_clone = attn.index_select(0, bbsz_idx)[:, :, 1 : step + 2]
+            fin_attn[sent, slot, :, : step + 1] = attn_clone[keep].to(fin_attn)
+
+        # check termination conditions for the sentences with finished items
+        newly_finished = counts > 0
+        if step < max_len:
+            newly_finished &= (
+                finalized["count"].index_select(0, batch_sents).eq(beam_size)
+            )
+        finalized_sents: List[int] = newly_finished.nonzero().view(-1).tolist()
+        return finalized_sents
+
+    def _stop_early(
+        self,
+        step: int,
+        cand_scores,
+        cand_indices,
+        finalized: Dict[str, Tensor],
+        finalized_sents: List[int],
+        batch_sents,
+        max_len: int,
+    ) -> List[int]:
+        """Find the sentences none of whose active hypotheses can score higher
+        than their {early_stop_nbest} best finalized ones (see
+        :func:`finalize_hypos`), as cumulative scores can only decrease. These
+        best hypotheses are the same as when decoding the sentences to the end.
+
+        Returns the indices in the current batch of these sentences, except
+        the ones in *finalized_sents*.
+        """
+        count = finalized["count"].index_select(0, batch_sents)
+        scores = finalized["score"].index_select(0, batch_sents)
+        beam_size = scores.size(1)
+        used = torch.arange(beam_size).to(count).unsqueeze(0) < count.unsqueeze(1)
+        nbest_scores, _ = torch.topk(
+            scores.masked_fill(~used, -math.inf), self.early_stop_nbest, dim=1
+        )
+        # the active hypotheses are the best candidates that do not end in eos
+        best_scores, _ = cand_scores.masked_fill(
+            cand_indices.eq(self.eos), -math.inf
+        ).max(dim=1)
+        best_scores = best_scores.to(scores)
+        if self.normalize_scores:
+            # a hypothesis ends at the earliest at the next step, at the
+            # latest at max_len, and its normalized score is monotonic in
+            # its length
+            best_scores = torch.max(
+                best_scores / (step + 2) ** self.len_penalty,
+                best_scores / (max_len + 1) ** self.len_penalty,
+            )
+        stop = best_scores < nbest_scores[:, -1]
+        if len(finalized_sents) > 0:
+            stop[finalized_sents] = False
+        stopped_sents: List[int] = stop.nonzero().view(-1).tolist()
+        return stopped_sents
+
+    def _finalized_hypos(
+        self, finalized: Dict[str, Tensor]
+    ) -> List[List[Dict[str, Tensor]]]:
+        """Turn the buffers filled by :func:`finalize_hypos` into the list of
+        hypotheses of each sentence, sorted by score descending."""
+        count = finalized["count"]
+        bsz, beam_size = finalized["score"].size()
+        used = torch.arange(beam_size).to(count).unsqueeze(0) < count.unsqueeze(1)
+        # sort the slots of each sentence, the unused ones last
+        _, order = torch.sort(
+            finalized["score"].masked_fill(~used, -math.inf),
+            dim=1,
+            descending=True,
+            stable=True,
+        )
+        lengths = finalized["length"].gather(1, order)
+        max_len = finalized["tokens"].size(2)
+        order = order.unsqueeze(2)
+        # the steps of each hypothesis, none for the unused slots
+        steps = torch.arange(max_len).to(count) < lengths.unsqueeze(2)
+        # split the hypotheses with one copy of each buffer
+        split_sizes: List[int] = lengths[used].tolist()
+        tokens = finalized["tokens"].gather(1, order.expand(-1, -1, max_len))
+        tokens_list = tokens[steps].split(split_sizes)
+        pos_scores = finalized["positional_scores"].gather(
+            1, order.expand(-1, -1, max_len)
+        )
+        pos_scores_list = pos_scores[steps].split(split_sizes)
+        scores_list = finalized["score"].gather(1, order.squeeze(2))[used].unbind(0)
+        attn_list: List[Tensor] = []
+        if "attention" in finalized:
+            attn = finalized["attention"]
+            attn = attn.gather(1, order.unsqueeze(3).expand_as(attn))
+            # src_len x tgt_len
+            attn_list = attn.permute(2, 0, 1, 3)[:, steps].split(split_sizes, dim=1)
+
+        counts: List[int] = count.tolist()
+        hypos = torch.jit.annotate(List[List[Dict[str, Tensor]]], [])
+        first = 0
+        for sent in range(bsz):
+            sent_hypos = torch.jit.annotate(List[Dict[str, Tensor]], [])
+            for i in range(first, first + counts[sent]):
+                if len(attn_list) > 0:
+                    hypo_attn = attn_list[i]
                 else:
                     hypo_attn = torch.empty(0)
-
-                finalized[sent_list[i]].append(
+                sent_hypos.append(
                     {
-                        "tokens": tokens_clone[i],
-                        "score": eos_scores[i],
+                        "tokens": tokens_list[i],
+                        "score": scores_list[i],
                         "attention": hypo_attn,  # src_len x tgt_len
                         "alignment": torch.empty(0),
-                        "positional_scores": pos_scores[i],
+                        "positional_scores": pos_scores_list[i],
                     }
                 )
-
-        newly_finished: List[int] = []
-        for unique_s in unique_seen:
-            # check termination conditions for this sentence
-            unique_sent: int = unique_s >> 32
-            unique_unfin_idx: int = unique_s - (unique_sent << 32)
-
-            if not finished[unique_sent] and self.is_finished(
-                step, unique_unfin_idx, max_len, len(finalized[unique_sent]), beam_size
-            ):
-                finished[unique_sent] = True
-                newly_finished.append(unique_unfin_idx)
-
-        return newly_finished
-
-    def is_finished(
-        self,
-        step: int,
-        unfin_idx: int,
-        max_len: int,
-        finalized_sent_len: int,
-        beam_size: int,
-    ):
-        """
-        Check whether decoding for a sentence is finished, which
-        occurs when the list of finalized sentences has reached the
-        beam size, or when we reach the maximum length.
-        """
-        assert finalized_sent_len <= beam_size
-        if finalized_sent_len == beam_size or step == max_len:
-            return True
-        return False
+            hypos.append(sent_hypos)
+            first += counts[sent]
+        return hypos
+
+
+def _pad_dim(x: Tensor, dim: int, length: int, value, left: bool = False):
+    """Pad *x* with *value* along *dim* up to *length*."""
+    if x.size(dim) >= length:
+        return x
+    shape = list(x.size())
+    shape[dim] = length - x.size(dim)
+    padding = x.new_full(shape, value)
+    return torch.cat([padding, x] if left else [x, padding], dim=dim)
+
+
+def _pad_attention_buffer(
+    buffer: Dict[str, Optional[Tensor]], length: int, left: bool = False
+) -> Dict[str, Tensor]:
+    """Pad the cached keys and values of a MultiheadAttention up to *length*
+    steps, masking the padding."""
+    prev_key = buffer["prev_key"]
+    assert prev_key is not None
+    mask = buffer.get("prev_key_padding_mask")
+    if mask is None:
+        mask = prev_key.new_zeros(prev_key.size(0), prev_key.size(2), dtype=torch.bool)
+    return {
+        "prev_key": _pad_dim(prev_key, 2, length, 0, left=left),
+        "prev_value": _pad_dim(buffer["prev_value"], 2, length, 0, left=left),
+        "prev_key_padding_mask": _pad_dim(mask.bool(), 1, length, True, left=left),
+    }
 
 
 class EnsembleModel(nn.Module):
@@ -774,6 +1437,21 @@ class EnsembleModel(nn.Module):
         ):
             self.has_incremental = True
 
+        # the dictionary ids of the outputs of decoders that fold duplicated
+        # tokens, and the output of each id (see
+        # TransformerDecoderBase.fold_duplicate_outputs_)
+        self.output_ids: Optional[Tensor] = None
+        self.output_index: Optional[Tensor] = None
+        decoders = [getattr(m, "decoder", None) for m in models]
+        folded = [getattr(d, "output_ids", None) is not None for d in decoders]
+        if any(folded):
+            if not all(folded) or not all(
+                torch.equal(d.output_ids, decoders[0].output_ids) for d in decoders
+            ):
+                raise ValueError("all models must fold the same duplicated tokens")
+            self.output_ids = decoders[0].output_ids
+            self.output_index = decoders[0].output_index
+
     def forward(self):
         pass
 
@@ -800,6 +1478,14 @@ class EnsembleModel(nn.Module):
                 if hasattr(model, "set_beam_size"):
                     model.set_beam_size(beam_size)
 
+    def set_decoder_preallocate_kv_cache(self, preallocate_kv_cache):
+        """Set whether the attention modules cache keys and values in
+        preallocated buffers."""
+        for model in self.models:
+            for module in model.modules():
+                if hasattr(module, "set_preallocate_kv_cache"):
+                    module.set_preallocate_kv_cache(preallocate_kv_cache)
+
     @torch.jit.export
     def forward_encoder(self, net_input: Dict[str, Tensor]):
         if not self.has_encoder():
@@ -814,6 +1500,8 @@ class EnsembleModel(nn.Module):
         incremental_states: List[Dict[str, Dict[str, Optional[Tensor]]]],
         temperature: float = 1.0,
     ):
+        if self.output_ids is not None:
+            tokens = self.output_ids[tokens]
         log_probs = []
         avg_attn: Optional[Tensor] = None
         encoder_out: Optional[Dict[str, List[Tensor]]] = None
@@ -925,6 +1613,8 @@ class SequenceGeneratorWithAlignment(SequenceGenerator):
                 hypothesis should be left padded or not when they are
                 teacher forced for generating alignments.
         """
+        if kwargs.get("early_stop_nbest", 0) > 0:
+            raise ValueError("alignments need all the hypotheses of the beam")
         super().__init__(EnsembleModelWithAlignment(models), tgt_dict, **kwargs)
         self.left_pad_target = left_pad_target
 
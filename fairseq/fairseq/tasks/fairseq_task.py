@@ -3,12 +3,15 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import hashlib
+import json
 import logging
 import os
 import warnings
 from argparse import Namespace
 from typing import Any, Callable, Dict, List
 
+import numpy as np
 import torch
 from fairseq import search, tokenizer, utils
 from fairseq.logging import metrics
@@ -223,6 +226,7 @@ class FairseqTask(object):
         skip_remainder_batch=False,
         grouped_shuffling=False,
         update_epoch_batch_itr=False,
+        data_buffer_process=False,
     ):
         """
         Get an iterator that yields batches of data from the given dataset.
@@ -263,6 +267,8 @@ class FairseqTask(object):
                 between sequence lengths among workers for batches sorted by length.
             update_epoch_batch_itr (bool optional): if true then donot use the cached
                 batch iterator for the epoch
+            data_buffer_process (bool, optional): preload batches in a
+                background process rather than a thread (default: False).
 
         Returns:
             ~fairseq.iterators.EpochBatchIterator: a batched iterator over the
@@ -283,7 +289,26 @@ class FairseqTask(object):
         # initialize the dataset with the correct starting epoch
         dataset.set_epoch(epoch)
 
+        batch_plan_cache = getattr(self.cfg, "batch_plan_cache", None)
+        batching_args = {
+            "max_tokens": max_tokens,
+            "max_sentences": max_sentences,
+            "max_positions": max_positions,
+            "ignore_invalid_inputs": ignore_invalid_inputs,
+            "required_batch_size_multiple": required_batch_size_multiple,
+            "seed": seed,
+        }
+
         def make_batches(dataset, epoch):
+            cache_path = None
+            if batch_plan_cache:
+                cache_path = self._batch_plan_path(
+                    batch_plan_cache, dataset, epoch, batching_args
+                )
+            if cache_path is not None and os.path.exists(cache_path):
+                logger.info(f"loading batches for epoch {epoch} from {cache_path}")
+                return data_utils.load_batches(cache_path)
+
             logger.info(f"creating new batches for epoch {epoch}")
 
             # get indices ordered by example size
@@ -303,6 +328,9 @@ class FairseqTask(object):
                 max_sentences=max_sentences,
                 required_batch_size_multiple=required_batch_size_multiple,
             )
+            if cache_path is not None:
+                os.makedirs(batch_plan_cache, exist_ok=True)
+                data_utils.save_batches(cache_path, batches)
             return batches
 
         reuse_dataloader = getattr(self.cfg, "reuse_dataloader", True)
@@ -332,6 +360,7 @@ class FairseqTask(object):
             grouped_shuffling=grouped_shuffling,
             reuse_dataloader=reuse_dataloader,
             persistent_workers=persistent_workers,
+            buffer_process=data_buffer_process,
         )
 
         if can_reuse_epoch_itr:
@@ -339,6 +368,32 @@ class FairseqTask(object):
 
         return epoch_iter
 
+    def _batch_plan_path(self, cache_dir, dataset, epoch, batching_args):
+        """
+        Where to cache the batches of *dataset* for *epoch*: the file name
+        hashes the dataset sizes, the batching arguments and the dataset
+        options that change the order or grouping of the indices.
+        """
+        sizes = getattr(dataset, "sizes", None)
+        if sizes is None:
+            return None
+        key = dict(
+            batching_args,
+            epoch=epoch,
+            task=type(self).__name__,
+            dataset=type(dataset).__name__,
+            # LanguagePairDataset options
+            shuffle=getattr(dataset, "shuffle", None),
+            buckets=str(getattr(dataset, "buckets", None)),
+            min_padding_batches=getattr(dataset, "min_padding_batches", None),
+            # OutputLengthSortedDataset options
+            max_len_a=getattr(dataset, "max_len_a", None),
+            max_len_b=getattr(dataset, "max_len_b", None),
+        )
+        sha1 = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode())
+        sha1.update(np.ascontiguousarray(sizes).tobytes())
+        return os.path.join(cache_dir, f"batches.{sha1.hexdigest()}.npy")
+
     def build_model(self, cfg: FairseqDataclass, from_checkpoint=False):
         """
         Build the :class:`~fairseq.models.BaseFairseqModel` instance for this
@@ -411,6 +466,7 @@ class FairseqTask(object):
                 compute_alignment=getattr(args, "print_alignment", False),
             )
 
+        from fairseq.encoder_out_cache import EncoderOutCache
         from fairseq.sequence_generator import (
             SequenceGenerator,
             SequenceGeneratorWithAlignment,
@@ -425,6 +481,7 @@ class FairseqTask(object):
         match_source_len = getattr(args, "match_source_len", False)
         diversity_rate = getattr(args, "diversity_rate", -1)
         constrained = getattr(args, "constraints", False)
+        merge_duplicates = getattr(args, "merge_duplicates", False)
         if prefix_allowed_tokens_fn is None:
             prefix_allowed_tokens_fn = getattr(args, "prefix_allowed_tokens_fn", None)
         if (
@@ -435,6 +492,7 @@ class FairseqTask(object):
                     diverse_beam_groups > 0,
                     match_source_len,
                     diversity_rate > 0,
+                    merge_duplicates,
                 ]
             )
             > 1
@@ -474,6 +532,8 @@ class FairseqTask(object):
             search_strategy = search.PrefixConstrainedBeamSearch(
                 self.target_dictionary, prefix_allowed_tokens_fn
             )
+        elif merge_duplicates:
+            search_strategy = search.DuplicateAwareBeamSearch(self.target_dictionary)
         else:
             search_strategy = search.BeamSearch(self.target_dictionary)
 
@@ -499,6 +559,17 @@ class FairseqTask(object):
             match_source_len=getattr(args, "match_source_len", False),
             no_repeat_ngram_size=getattr(args, "no_repeat_ngram_size", 0),
             search_strategy=search_strategy,
+            preallocate_kv_cache=getattr(args, "preallocate_kv_cache", False),
+            early_stop_nbest=(
+                getattr(args, "nbest", 1)
+                if getattr(args, "bound_early_stopping", False)
+                else 0
+            ),
+            encoder_out_cache=(
+                EncoderOutCache(args.encoder_out_cache_mb * 2**20)
+                if getattr(args, "encoder_out_cache_mb", 0) > 0
+                else None
+            ),
             **extra_gen_cls_kwargs,
         )
 
@@ -566,6 +637,12 @@ class FairseqTask(object):
         """Hook function called before the start of each validation epoch."""
         pass
 
+    def should_revalidate(self, stats):
+        """Hook function called after each pass over a validation subset, with
+        its aggregated *stats*. Return True to validate the subset again, e.g.
+        with a more expensive generator."""
+        return False
+
     def aggregate_logging_outputs(self, logging_outputs, criterion):
         """[deprecated] Aggregate logging outputs from data parallel training."""
         utils.deprecation_warning(
@@ -8,6 +8,7 @@ import itertools
 import json
 import logging
 import os
+import time
 from typing import Optional
 from argparse import Namespace
 from omegaconf import II
@@ -59,6 +60,8 @@ def load_langpair_dataset(
     shuffle=True,
     pad_to_multiple=1,
     prepend_bos_src=None,
+    min_padding_batches=False,
+    shared_cache=None,
 ):
     def split_exists(split, src, tgt, lang, data_path):
         filename = os.path.join(data_path, "{}.{}-{}.{}".format(split, src, tgt, lang))
@@ -84,7 +87,7 @@ def load_langpair_dataset(
                 )
 
         src_dataset = data_utils.load_indexed_dataset(
-            prefix + src, src_dict, dataset_impl
+            prefix + src, src_dict, dataset_impl, shared_cache=shared_cache
         )
         if truncate_source:
             src_dataset = AppendTokenDataset(
@@ -97,7 +100,7 @@ def load_langpair_dataset(
         src_datasets.append(src_dataset)
 
         tgt_dataset = data_utils.load_indexed_dataset(
-            prefix + tgt, tgt_dict, dataset_impl
+            prefix + tgt, tgt_dict, dataset_impl, shared_cache=shared_cache
         )
         if tgt_dataset is not None:
             tgt_datasets.append(tgt_dataset)
@@ -168,6 +171,7 @@ def load_langpair_dataset(
         num_buckets=num_buckets,
         shuffle=shuffle,
         pad_to_multiple=pad_to_multiple,
+        min_padding_batches=min_padding_batches,
     )
 
 
@@ -223,6 +227,28 @@ class TranslationConfig(FairseqDataclass):
             "N buckets and pad accordingly; this is useful on TPUs to minimize the number of compilations"
         },
     )
+    min_padding_batches: bool = field(
+        default=False,
+        metadata={
+            "help": "sort by source and target lengths and split into the fewest "
+            "batches with the least padding, instead of filling batches greedily"
+        },
+    )
+    batch_plan_cache: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "directory where the batches of every epoch are saved and "
+            "memory-mapped back when training restarts on the same data"
+        },
+    )
+    shared_index_cache: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "directory in shared memory (e.g. /dev/shm/fairseq) where the "
+            "index of mmap datasets is cached, so that processes on this host "
+            "reading identical data-bins share one copy of it"
+        },
+    )
     train_subset: str = II("dataset.train_subset")
     dataset_impl: Optional[ChoiceEnum(get_available_dataset_impl())] = II(
         "dataset.dataset_impl"
@@ -264,6 +290,21 @@ class TranslationConfig(FairseqDataclass):
     eval_bleu_print_samples: bool = field(
         default=False, metadata={"help": "print sample generations during validation"}
     )
+    eval_bleu_adaptive: bool = field(
+        default=False,
+        metadata={
+            "help": "decode validation subsets greedily and only re-decode the first "
+            "one with --eval-bleu-args when its greedy BLEU is within "
+            "--eval-bleu-adaptive-margin of the best BLEU seen so far"
+        },
+    )
+    eval_bleu_adaptive_margin: float = field(
+        default=1.0,
+        metadata={
+            "help": "BLEU margin below the best score within which greedy validation "
+            "triggers a full --eval-bleu-args decoding pass"
+        },
+    )
 
 
 @register_task("translation", dataclass=TranslationConfig)
@@ -288,6 +329,13 @@ class TranslationTask(FairseqTask):
         self.src_dict = src_dict
         self.tgt_dict = tgt_dict
 
+        # state for --eval-bleu-adaptive
+        self._eval_bleu_use_beam = not cfg.eval_bleu_adaptive
+        self._eval_bleu_gen_time = 0.0
+        self._eval_bleu_beam_time = None
+        self._eval_bleu_best = None
+        self._eval_bleu_time_saved = 0.0
+
     @classmethod
     def setup_task(cls, cfg: TranslationConfig, **kwargs):
         """Setup the task (e.g., load dictionaries).
@@ -361,6 +409,8 @@ class TranslationTask(FairseqTask):
             num_buckets=self.cfg.num_batch_buckets,
             shuffle=(split != "test"),
             pad_to_multiple=self.cfg.required_seq_len_multiple,
+            min_padding_batches=self.cfg.min_padding_batches,
+            shared_cache=self.cfg.shared_index_cache,
         )
 
     def build_dataset_for_inference(self, src_tokens, src_lengths, constraints=None):
@@ -384,12 +434,27 @@ class TranslationTask(FairseqTask):
             self.sequence_generator = self.build_generator(
                 [model], Namespace(**gen_args)
             )
+            if self.cfg.eval_bleu_adaptive:
+                self.greedy_sequence_generator = self.build_generator(
+                    [model], Namespace(**dict(gen_args, beam=1, nbest=1))
+                )
         return model
 
+    def begin_valid_epoch(self, epoch, model):
+        super().begin_valid_epoch(epoch, model)
+        self._eval_bleu_use_beam = not self.cfg.eval_bleu_adaptive
+        self._eval_bleu_gen_time = 0.0
+
     def valid_step(self, sample, model, criterion):
         loss, sample_size, logging_output = super().valid_step(sample, model, criterion)
         if self.cfg.eval_bleu:
-            bleu = self._inference_with_bleu(self.sequence_generator, sample, model)
+            if self._eval_bleu_use_beam:
+                generator = self.sequence_generator
+            else:
+                generator = self.greedy_sequence_generator
+            start = time.perf_counter()
+            bleu = self._inference_with_bleu(generator, sample, model)
+            self._eval_bleu_gen_time += time.perf_counter() - start
             logging_output["_bleu_sys_len"] = bleu.sys_len
             logging_output["_bleu_ref_len"] = bleu.ref_len
             # we split counts into separate entries so that they can be
@@ -453,6 +518,60 @@ class TranslationTask(FairseqTask):
 
                 metrics.log_derived("bleu", compute_bleu)
 
+    def should_revalidate(self, stats):
+        """Decide whether the subset that produced *stats* must be validated again.
+
+        With ``--eval-bleu-adaptive`` the first pass decodes greedily; a
+        second pass with the full ``--eval-bleu-args`` generator is only
+        requested when the greedy BLEU comes within
+        ``--eval-bleu-adaptive-margin`` of the best BLEU seen so far.
+        """
+        if not (self.cfg.eval_bleu and self.cfg.eval_bleu_adaptive):
+            return False
+        bleu = stats.get("bleu", None)
+        gen_time, self._eval_bleu_gen_time = self._eval_bleu_gen_time, 0.0
+
+        if self._eval_bleu_use_beam:
+            # end of the full decoding pass
+            self._eval_bleu_use_beam = False
+            self._eval_bleu_beam_time = gen_time
+            self._update_eval_bleu_best(bleu)
+            return False
+
+        if (
+            bleu is not None
+            and self._eval_bleu_best is not None
+            and bleu < self._eval_bleu_best - self.cfg.eval_bleu_adaptive_margin
+        ):
+            if self._eval_bleu_beam_time is not None:
+                self._eval_bleu_time_saved += self._eval_bleu_beam_time - gen_time
+            logger.info(
+                "greedy BLEU {:.2f} is more than {} below best BLEU {:.2f}, skipping "
+                "full decoding (generation time saved so far: {:.1f}s)".format(
+                    bleu,
+                    self.cfg.eval_bleu_adaptive_margin,
+                    self._eval_bleu_best,
+                    self._eval_bleu_time_saved,
+                )
+            )
+            return False
+
+        logger.info(
+            "greedy BLEU {} is within {} of best BLEU {}, re-decoding with "
+            "--eval-bleu-args".format(
+                bleu, self.cfg.eval_bleu_adaptive_margin, self._eval_bleu_best
+            )
+        )
+        self._eval_bleu_time_saved -= gen_time
+        self._eval_bleu_use_beam = True
+        return True
+
+    def _update_eval_bleu_best(self, bleu):
+        if bleu is not None and (
+            self._eval_bleu_best is None or bleu > self._eval_bleu_best
+        ):
+            self._eval_bleu_best = bleu
+
     def max_positions(self):
         """Return the max sentence length allowed by the task."""
         return (self.cfg.max_source_positions, self.cfg.max_target_positions)
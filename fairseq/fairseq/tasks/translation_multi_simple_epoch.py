@@ -352,6 +352,7 @@ class TranslationMultiSimpleEpochTask(LegacyFairseqTask):
         skip_remainder_batch=False,
         grouped_shuffling=False,
         update_epoch_batch_itr=False,
+        data_buffer_process=False,
     ):
         """
         Get an iterator that yields batches of data from the given dataset.
@@ -389,6 +390,8 @@ class TranslationMultiSimpleEpochTask(LegacyFairseqTask):
                 between sequence lengths among workers for batches sorted by length.
             update_epoch_batch_itr (bool optional): if true then donot use the cached
                 batch iterator for the epoch
+            data_buffer_process (bool, optional): preload batches in a
+                background process rather than a thread (default: False).
 
         Returns:
             ~fairseq.iterators.EpochBatchIterator: a batched iterator over the
@@ -415,6 +418,7 @@ class TranslationMultiSimpleEpochTask(LegacyFairseqTask):
                 disable_iterator_cache=disable_iterator_cache,
                 skip_remainder_batch=skip_remainder_batch,
                 update_epoch_batch_itr=update_epoch_batch_itr,
+                data_buffer_process=data_buffer_process,
             )
             self.dataset_to_epoch_iter[dataset] = batch_iter
             return batch_iter
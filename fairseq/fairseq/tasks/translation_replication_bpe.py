@@ -20,6 +20,7 @@ from fairseq.tasks import translation
 from fairseq.data import (
     AppendTokenDataset,
     ConcatDataset,
+    DuplicationSamplingDataset,
     LanguagePairDataset,
     PrependTokenDataset,
     StripTokenDataset,
@@ -27,6 +28,7 @@ from fairseq.data import (
     data_utils,
     encoders,
     indexed_dataset,
+    load_bpe_merges,
 )
 from fairseq.data.indexed_dataset import get_available_dataset_impl
 from fairseq.dataclass import ChoiceEnum, FairseqDataclass
@@ -258,6 +260,15 @@ class ReplicationBPETranslationConfig(translation.TranslationConfig):
     replication_k: Optional[int] = field(
         default=0, metadata={"help": "make k copies of each replicated token"}
     )
+    online_segmentation: bool = field(
+        default=False,
+        metadata={
+            "help": "train on a single canonical copy of the corpus and sample the "
+            "duplicated tokens (and BPE-dropout, from code.{lang} in the data "
+            "directory) every epoch in the data loader"
+        },
+    )
+    seed: int = II("common.seed")
 
 @register_task(
     "translation-with-replication-bpe", dataclass=ReplicationBPETranslationConfig
@@ -334,8 +345,54 @@ class TranslationWithReplicatedBPE(translation.TranslationTask):
         logger.info("MARCO: LOAD DATASET")
         logger.info(f"MARCO: {data_path}")
 
+        if split == "train" and self.cfg.online_segmentation:
+            # one canonical copy, resegmented in the data loader every epoch
+            assert (
+                self.cfg.num_batch_buckets == 0
+            ), "--online-segmentation does not support --num-batch-buckets"
+            dataset = translation.load_langpair_dataset(
+                data_path,
+                split,
+                src,
+                self.src_dict,
+                tgt,
+                self.tgt_dict,
+                combine=combine,
+                dataset_impl=self.cfg.dataset_impl,
+                upsample_primary=self.cfg.upsample_primary,
+                left_pad_source=self.cfg.left_pad_source,
+                left_pad_target=self.cfg.left_pad_target,
+                max_source_positions=self.cfg.max_source_positions,
+                max_target_positions=self.cfg.max_target_positions,
+                load_alignments=self.cfg.load_alignments,
+                truncate_source=self.cfg.truncate_source,
+                num_buckets=self.cfg.num_batch_buckets,
+                shuffle=(split != "test"),
+                pad_to_multiple=self.cfg.required_seq_len_multiple,
+                min_padding_batches=self.cfg.min_padding_batches,
+                shared_cache=self.cfg.shared_index_cache,
+            )
+            dataset.src = self._sample_segmentation(
+                dataset.src,
+                self.src_dict,
+                data_path,
+                src,
+                self.cfg.src_dropout,
+                self.cfg.max_source_positions,
+                0,
+            )
+            dataset.tgt = self._sample_segmentation(
+                dataset.tgt,
+                self.tgt_dict,
+                data_path,
+                tgt,
+                self.cfg.tgt_dropout,
+                self.cfg.max_target_positions,
+                1,
+            )
+            self.datasets[split] = dataset
         # only retokenize the dataset when its the training split and we are using dropout
-        if split == "train" and (
+        elif split == "train" and (
             self.cfg.src_dropout > 0.0 or self.cfg.tgt_dropout > 0.0
         ):
             logging.info("MARCO RELOAD AND RETOKENIZE DATASET")
@@ -384,8 +441,28 @@ class TranslationWithReplicatedBPE(translation.TranslationTask):
                 num_buckets=self.cfg.num_batch_buckets,
                 shuffle=(split != "test"),
                 pad_to_multiple=self.cfg.required_seq_len_multiple,
+                min_padding_batches=self.cfg.min_padding_batches,
+                shared_cache=self.cfg.shared_index_cache,
             )
 
+    def _sample_segmentation(
+        self, dataset, dictionary, data_path, lang, dropout, max_len, side
+    ):
+        merges = None
+        if dropout > 0.0:
+            merges = load_bpe_merges(
+                os.path.join(data_path, f"code.{lang}"), dictionary
+            )
+        return DuplicationSamplingDataset(
+            dataset,
+            dictionary,
+            # draw the source and target sides independently
+            seed=self.cfg.seed * 2 + side,
+            merges=merges,
+            dropout=dropout,
+            max_len=max_len,
+        )
+
     def has_non_static_dataset(self):
         return True
         # return self.cfg.src_dropout > 0 or self.cfg.tgt_dropout > 0
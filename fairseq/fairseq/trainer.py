@@ -728,6 +728,7 @@ class Trainer(object):
             num_workers=self.cfg.dataset.num_workers,
             epoch=epoch,
             data_buffer_size=self.cfg.dataset.data_buffer_size,
+            data_buffer_process=self.cfg.dataset.data_buffer_process,
             disable_iterator_cache=disable_iterator_cache,
             skip_remainder_batch=self.cfg.optimization.skip_remainder_batch,
             grouped_shuffling=self.cfg.dataset.grouped_shuffling,
@@ -760,6 +761,7 @@ class Trainer(object):
             # across training epochs
             epoch=1,
             data_buffer_size=self.cfg.dataset.data_buffer_size,
+            data_buffer_process=self.cfg.dataset.data_buffer_process,
             disable_iterator_cache=disable_iterator_cache,
             skip_remainder_batch=False,
         )
@@ -8,6 +8,9 @@ Translate pre-processed data with a trained model.
 """
 
 import ast
+import contextlib
+import io
+import json
 import logging
 import math
 import os
@@ -17,12 +20,15 @@ from itertools import chain
 
 import numpy as np
 import torch
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 
 from fairseq import checkpoint_utils, options, scoring, tasks, utils
+from fairseq.data import OutputLengthSortedDataset
 from fairseq.dataclass.utils import convert_namespace_to_omegaconf
 from fairseq.logging import progress_bar
 from fairseq.logging.meters import StopwatchMeter, TimeMeter
+from fairseq.sequence_generator import SequenceGenerator
+from fairseq.tasks import FairseqTask
 
 
 def main(cfg: DictConfig):
@@ -45,11 +51,65 @@ def main(cfg: DictConfig):
             "generate-{}.txt".format(cfg.dataset.gen_subset),
         )
         with open(output_path, "w", buffering=1, encoding="utf-8") as h:
-            return _main(cfg, h)
+            if cfg.generation.decoding_configs is None:
+                return _main(cfg, h)
+            # one output per decoding config
+            with contextlib.ExitStack() as stack:
+                config_output_files = [
+                    stack.enter_context(
+                        open(
+                            os.path.join(
+                                cfg.common_eval.results_path,
+                                "generate-{}.{}.txt".format(cfg.dataset.gen_subset, i),
+                            ),
+                            "w",
+                            buffering=1,
+                            encoding="utf-8",
+                        )
+                    )
+                    for i in range(len(json.loads(cfg.generation.decoding_configs)))
+                ]
+                return _main(cfg, h, config_output_files)
     else:
+        assert (
+            cfg.generation.decoding_configs is None
+        ), "--decoding-configs requires --results-path"
         return _main(cfg, sys.stdout)
 
 
+# generation args applied to the models by prepare_for_inference_, or used
+# outside of the generators, which are shared by all the decoding configs
+SHARED_GENERATION_ARGS = {
+    "fold_duplicate_outputs",
+    "print_alignment",
+    "retain_dropout",
+    "retain_dropout_modules",
+    "replace_unk",
+    "continuous_batching",
+    "sort_by_output_length",
+    "no_beamable_mm",
+    "preallocate_kv_cache",
+}
+
+
+def get_decoding_configs(cfg: DictConfig):
+    """Return the generation config of each of ``--decoding-configs``, the
+    generation args of *cfg* with its overrides."""
+    gen_cfgs = []
+    for overrides in json.loads(cfg.generation.decoding_configs):
+        shared = sorted(SHARED_GENERATION_ARGS.intersection(overrides))
+        assert len(shared) == 0, (
+            "--decoding-configs cannot override {}, which apply to all the "
+            "configs: set them on the command line instead".format(", ".join(shared))
+        )
+        gen_cfg = OmegaConf.merge(cfg.generation, overrides)
+        assert (
+            not gen_cfg.sampling or gen_cfg.nbest == gen_cfg.beam
+        ), "--sampling requires --nbest to be equal to --beam"
+        gen_cfgs.append(gen_cfg)
+    return gen_cfgs
+
+
 def get_symbols_to_strip_from_output(generator):
     if hasattr(generator, "symbols_to_strip_from_output"):
         return generator.symbols_to_strip_from_output
@@ -57,7 +117,7 @@ def get_symbols_to_strip_from_output(generator):
         return {generator.eos}
 
 
-def _main(cfg: DictConfig, output_file):
+def _main(cfg: DictConfig, output_file, config_output_files=None):
     logging.basicConfig(
         format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
@@ -123,6 +183,21 @@ def _main(cfg: DictConfig, output_file):
     else:
         lms = [None]
 
+    if cfg.generation.decoding_configs is not None:
+        gen_cfgs = get_decoding_configs(cfg)
+        assert (
+            cfg.generation.continuous_batching == 0
+        ), "--decoding-configs does not support --continuous-batching"
+        assert (
+            type(task).inference_step is FairseqTask.inference_step
+        ), "--decoding-configs does not support tasks with their own inference_step"
+        if len({cfg.generation.beam} | {gen_cfg.beam for gen_cfg in gen_cfgs}) > 1:
+            # BeamableMM is specialized for the beam size of cfg.generation
+            cfg.generation.no_beamable_mm = True
+    else:
+        gen_cfgs = [cfg.generation]
+        config_output_files = [output_file]
+
     # Optimize ensemble for generation
     for model in chain(models, lms):
         if model is None:
@@ -137,9 +212,24 @@ def _main(cfg: DictConfig, output_file):
     # (None if no unknown word replacement, empty if no path to align dictionary)
     align_dict = utils.load_align_dict(cfg.generation.replace_unk)
 
+    dataset = task.dataset(cfg.dataset.gen_subset)
+    # print the results in the order of the dataset when batches are reordered
+    reorder_output = cfg.generation.sort_by_output_length
+    outputs = [{} for _ in gen_cfgs]
+    if reorder_output:
+        assert hasattr(
+            dataset, "src_sizes"
+        ), "--sort-by-output-length requires a dataset with source sizes"
+        dataset = OutputLengthSortedDataset(
+            dataset,
+            dataset.src_sizes,
+            max_len_a=cfg.generation.max_len_a,
+            max_len_b=cfg.generation.max_len_b,
+        )
+
     # Load dataset (possibly sharded)
     itr = task.get_batch_iterator(
-        dataset=task.dataset(cfg.dataset.gen_subset),
+        dataset=dataset,
         max_tokens=cfg.dataset.max_tokens,
         max_sentences=cfg.dataset.batch_size,
         max_positions=utils.resolve_max_positions(
@@ -163,10 +253,17 @@ def _main(cfg: DictConfig, output_file):
     # Initialize generator
     gen_timer = StopwatchMeter()
 
-    extra_gen_cls_kwargs = {"lm_model": lms[0], "lm_weight": cfg.generation.lm_weight}
-    generator = task.build_generator(
-        models, cfg.generation, extra_gen_cls_kwargs=extra_gen_cls_kwargs
-    )
+    generators = [
+        task.build_generator(
+            models,
+            gen_cfg,
+            extra_gen_cls_kwargs={"lm_model": lms[0], "lm_weight": gen_cfg.lm_weight},
+        )
+        for gen_cfg in gen_cfgs
+    ]
+    assert len(generators) == 1 or all(
+        isinstance(generator, SequenceGenerator) for generator in generators
+    ), "--decoding-configs requires a SequenceGenerator"
 
     # Handle tokenization and BPE
     tokenizer = task.build_tokenizer(cfg.tokenizer)
@@ -179,187 +276,263 @@ def _main(cfg: DictConfig, output_file):
             x = tokenizer.decode(x)
         return x
 
-    scorer = scoring.build_scorer(cfg.scoring, tgt_dict)
+    scorers = [scoring.build_scorer(cfg.scoring, tgt_dict) for _ in gen_cfgs]
 
     num_sentences = 0
     has_target = True
     wps_meter = TimeMeter()
-    for sample in progress:
-        sample = utils.move_to_cuda(sample) if use_cuda else sample
-        if "net_input" not in sample:
-            continue
-
-        prefix_tokens = None
-        if cfg.generation.prefix_size > 0:
-            prefix_tokens = sample["target"][:, : cfg.generation.prefix_size]
-
-        constraints = None
-        if "constraints" in sample:
-            constraints = sample["constraints"]
 
-        gen_timer.start()
-        hypos = task.inference_step(
-            generator,
-            models,
-            sample,
-            prefix_tokens=prefix_tokens,
-            constraints=constraints,
+    def get_prefix_tokens(sample, gen_cfg):
+        if gen_cfg.prefix_size > 0:
+            return sample["target"][:, : gen_cfg.prefix_size]
+        return None
+
+    def generate_batches():
+        for sample in progress:
+            sample = utils.move_to_cuda(sample) if use_cuda else sample
+            if "net_input" not in sample:
+                continue
+
+            constraints = None
+            if "constraints" in sample:
+                constraints = sample["constraints"]
+
+            gen_timer.start()
+            if len(generators) == 1:
+                config_hypos = [
+                    task.inference_step(
+                        generators[0],
+                        models,
+                        sample,
+                        prefix_tokens=get_prefix_tokens(sample, gen_cfgs[0]),
+                        constraints=constraints,
+                    )
+                ]
+            else:
+                with torch.no_grad():
+                    # run the encoder once for all the decoding configs
+                    encoder_outs = generators[0].model.forward_encoder(
+                        sample["net_input"]
+                    )
+                    config_hypos = [
+                        generator.generate(
+                            models,
+                            sample,
+                            prefix_tokens=get_prefix_tokens(sample, gen_cfg),
+                            constraints=constraints,
+                            encoder_outs=encoder_outs,
+                        )
+                        for gen_cfg, generator in zip(gen_cfgs, generators)
+                    ]
+            gen_timer.stop(
+                sum(len(h[0]["tokens"]) for hypos in config_hypos for h in hypos)
+            )
+            yield sample, config_hypos
+
+    def generate_continuous():
+        generator = generators[0]
+        assert hasattr(
+            generator, "generate_continuous"
+        ), "--continuous-batching requires a SequenceGenerator"
+        assert (
+            cfg.generation.prefix_size == 0 and not cfg.generation.constraints
+        ), "--continuous-batching does not support --prefix-size and --constraints"
+        samples = (
+            utils.move_to_cuda(sample) if use_cuda else sample
+            for sample in progress
+            if "net_input" in sample
+        )
+        # batches are returned once all their sentences are finished
+        results = generator.generate_continuous(
+            samples, cfg.generation.continuous_batching
         )
-        num_generated_tokens = sum(len(h[0]["tokens"]) for h in hypos)
-        gen_timer.stop(num_generated_tokens)
+        while True:
+            gen_timer.start()
+            result = next(results, None)
+            if result is None:
+                break
+            sample, hypos = result
+            gen_timer.stop(sum(len(h[0]["tokens"]) for h in hypos))
+            yield sample, [hypos]
+
+    if cfg.generation.continuous_batching > 0:
+        results = generate_continuous()
+    else:
+        results = generate_batches()
 
-        for i, sample_id in enumerate(sample["id"].tolist()):
-            has_target = sample["target"] is not None
+    for sample, config_hypos in results:
+        num_generated_tokens = sum(
+            len(h[0]["tokens"]) for hypos in config_hypos for h in hypos
+        )
 
-            # Remove padding
-            if "src_tokens" in sample["net_input"]:
-                src_tokens = utils.strip_pad(
-                    sample["net_input"]["src_tokens"][i, :], tgt_dict.pad()
-                )
-            else:
-                src_tokens = None
+        for c, hypos in enumerate(config_hypos):
+            gen_cfg, generator, scorer = gen_cfgs[c], generators[c], scorers[c]
+            config_output_file = config_output_files[c]
 
-            target_tokens = None
-            if has_target:
-                target_tokens = (
-                    utils.strip_pad(sample["target"][i, :], tgt_dict.pad()).int().cpu()
-                )
+            for i, sample_id in enumerate(sample["id"].tolist()):
+                has_target = sample["target"] is not None
+                sample_output = io.StringIO() if reorder_output else config_output_file
 
-            # Either retrieve the original sentences or regenerate them from tokens.
-            if align_dict is not None:
-                src_str = task.dataset(cfg.dataset.gen_subset).src.get_original_text(
-                    sample_id
-                )
-                target_str = task.dataset(cfg.dataset.gen_subset).tgt.get_original_text(
-                    sample_id
-                )
-            else:
-                if src_dict is not None:
-                    src_str = src_dict.string(src_tokens, cfg.common_eval.post_process)
+                # Remove padding
+                if "src_tokens" in sample["net_input"]:
+                    src_tokens = utils.strip_pad(
+                        sample["net_input"]["src_tokens"][i, :], tgt_dict.pad()
+                    )
                 else:
-                    src_str = ""
+                    src_tokens = None
+
+                target_tokens = None
                 if has_target:
-                    target_str = tgt_dict.string(
-                        target_tokens,
-                        cfg.common_eval.post_process,
-                        escape_unk=True,
-                        extra_symbols_to_ignore=get_symbols_to_strip_from_output(
-                            generator
-                        ),
+                    target_tokens = (
+                        utils.strip_pad(sample["target"][i, :], tgt_dict.pad())
+                        .int()
+                        .cpu()
                     )
 
-            src_str = decode_fn(src_str)
-            if has_target:
-                target_str = decode_fn(target_str)
+                # Either retrieve the original sentences or regenerate them from tokens.
+                if align_dict is not None:
+                    src_str = task.dataset(
+                        cfg.dataset.gen_subset
+                    ).src.get_original_text(sample_id)
+                    target_str = task.dataset(
+                        cfg.dataset.gen_subset
+                    ).tgt.get_original_text(sample_id)
+                else:
+                    if src_dict is not None:
+                        src_str = src_dict.string(
+                            src_tokens, cfg.common_eval.post_process
+                        )
+                    else:
+                        src_str = ""
+                    if has_target:
+                        target_str = tgt_dict.string(
+                            target_tokens,
+                            cfg.common_eval.post_process,
+                            escape_unk=True,
+                            extra_symbols_to_ignore=get_symbols_to_strip_from_output(
+                                generator
+                            ),
+                        )
 
-            if not cfg.common_eval.quiet:
-                if src_dict is not None:
-                    print("S-{}\t{}".format(sample_id, src_str), file=output_file)
+                src_str = decode_fn(src_str)
                 if has_target:
-                    print("T-{}\t{}".format(sample_id, target_str), file=output_file)
-
-            # Process top predictions
-            for j, hypo in enumerate(hypos[i][: cfg.generation.nbest]):
-                hypo_tokens, hypo_str, alignment = utils.post_process_prediction(
-                    hypo_tokens=hypo["tokens"].int().cpu(),
-                    src_str=src_str,
-                    alignment=hypo["alignment"],
-                    align_dict=align_dict,
-                    tgt_dict=tgt_dict,
-                    remove_bpe=cfg.common_eval.post_process,
-                    extra_symbols_to_ignore=get_symbols_to_strip_from_output(generator),
-                )
-                detok_hypo_str = decode_fn(hypo_str)
+                    target_str = decode_fn(target_str)
+
                 if not cfg.common_eval.quiet:
-                    score = hypo["score"] / math.log(2)  # convert to base 2
-                    # original hypothesis (after tokenization and BPE)
-                    print(
-                        "H-{}\t{}\t{}".format(sample_id, score, hypo_str),
-                        file=output_file,
-                    )
-                    # detokenized hypothesis
-                    print(
-                        "D-{}\t{}\t{}".format(sample_id, score, detok_hypo_str),
-                        file=output_file,
-                    )
-                    print(
-                        "P-{}\t{}".format(
-                            sample_id,
-                            " ".join(
-                                map(
-                                    lambda x: "{:.4f}".format(x),
-                                    # convert from base e to base 2
-                                    hypo["positional_scores"]
-                                    .div_(math.log(2))
-                                    .tolist(),
-                                )
-                            ),
+                    if src_dict is not None:
+                        print("S-{}\t{}".format(sample_id, src_str), file=sample_output)
+                    if has_target:
+                        print(
+                            "T-{}\t{}".format(sample_id, target_str), file=sample_output
+                        )
+
+                # Process top predictions
+                for j, hypo in enumerate(hypos[i][: gen_cfg.nbest]):
+                    hypo_tokens, hypo_str, alignment = utils.post_process_prediction(
+                        hypo_tokens=hypo["tokens"].int().cpu(),
+                        src_str=src_str,
+                        alignment=hypo["alignment"],
+                        align_dict=align_dict,
+                        tgt_dict=tgt_dict,
+                        remove_bpe=cfg.common_eval.post_process,
+                        extra_symbols_to_ignore=get_symbols_to_strip_from_output(
+                            generator
                         ),
-                        file=output_file,
                     )
-
-                    if cfg.generation.print_alignment == "hard":
+                    detok_hypo_str = decode_fn(hypo_str)
+                    if not cfg.common_eval.quiet:
+                        score = hypo["score"] / math.log(2)  # convert to base 2
+                        # original hypothesis (after tokenization and BPE)
                         print(
-                            "A-{}\t{}".format(
-                                sample_id,
-                                " ".join(
-                                    [
-                                        "{}-{}".format(src_idx, tgt_idx)
-                                        for src_idx, tgt_idx in alignment
-                                    ]
-                                ),
-                            ),
-                            file=output_file,
+                            "H-{}\t{}\t{}".format(sample_id, score, hypo_str),
+                            file=sample_output,
+                        )
+                        # detokenized hypothesis
+                        print(
+                            "D-{}\t{}\t{}".format(sample_id, score, detok_hypo_str),
+                            file=sample_output,
                         )
-                    if cfg.generation.print_alignment == "soft":
                         print(
-                            "A-{}\t{}".format(
+                            "P-{}\t{}".format(
                                 sample_id,
                                 " ".join(
-                                    [",".join(src_probs) for src_probs in alignment]
+                                    map(
+                                        lambda x: "{:.4f}".format(x),
+                                        # convert from base e to base 2
+                                        hypo["positional_scores"]
+                                        .div_(math.log(2))
+                                        .tolist(),
+                                    )
                                 ),
                             ),
-                            file=output_file,
-                        )
-
-                    if cfg.generation.print_step:
-                        print(
-                            "I-{}\t{}".format(sample_id, hypo["steps"]),
-                            file=output_file,
+                            file=sample_output,
                         )
 
-                    if cfg.generation.retain_iter_history:
-                        for step, h in enumerate(hypo["history"]):
-                            _, h_str, _ = utils.post_process_prediction(
-                                hypo_tokens=h["tokens"].int().cpu(),
-                                src_str=src_str,
-                                alignment=None,
-                                align_dict=None,
-                                tgt_dict=tgt_dict,
-                                remove_bpe=None,
+                        if gen_cfg.print_alignment == "hard":
+                            print(
+                                "A-{}\t{}".format(
+                                    sample_id,
+                                    " ".join(
+                                        [
+                                            "{}-{}".format(src_idx, tgt_idx)
+                                            for src_idx, tgt_idx in alignment
+                                        ]
+                                    ),
+                                ),
+                                file=sample_output,
                             )
+                        if gen_cfg.print_alignment == "soft":
                             print(
-                                "E-{}_{}\t{}".format(sample_id, step, h_str),
-                                file=output_file,
+                                "A-{}\t{}".format(
+                                    sample_id,
+                                    " ".join(
+                                        [",".join(src_probs) for src_probs in alignment]
+                                    ),
+                                ),
+                                file=sample_output,
                             )
 
-                # Score only the top hypothesis
-                if has_target and j == 0:
-                    if (
-                        align_dict is not None
-                        or cfg.common_eval.post_process is not None
-                    ):
-                        # Convert back to tokens for evaluation with unk replacement and/or without BPE
-                        target_tokens = tgt_dict.encode_line(
-                            target_str, add_if_not_exist=True
-                        )
-                        hypo_tokens = tgt_dict.encode_line(
-                            detok_hypo_str, add_if_not_exist=True
-                        )
-                    if hasattr(scorer, "add_string"):
-                        scorer.add_string(target_str, detok_hypo_str)
-                    else:
-                        scorer.add(target_tokens, hypo_tokens)
+                        if gen_cfg.print_step:
+                            print(
+                                "I-{}\t{}".format(sample_id, hypo["steps"]),
+                                file=sample_output,
+                            )
+
+                        if gen_cfg.retain_iter_history:
+                            for step, h in enumerate(hypo["history"]):
+                                _, h_str, _ = utils.post_process_prediction(
+                                    hypo_tokens=h["tokens"].int().cpu(),
+                                    src_str=src_str,
+                                    alignment=None,
+                                    align_dict=None,
+                                    tgt_dict=tgt_dict,
+                                    remove_bpe=None,
+                                )
+                                print(
+                                    "E-{}_{}\t{}".format(sample_id, step, h_str),
+                                    file=sample_output,
+                                )
+
+                    # Score only the top hypothesis
+                    if has_target and j == 0:
+                        if (
+                            align_dict is not None
+                            or cfg.common_eval.post_process is not None
+                        ):
+                            # Convert back to tokens for evaluation with unk replacement and/or without BPE
+                            target_tokens = tgt_dict.encode_line(
+                                target_str, add_if_not_exist=True
+                            )
+                            hypo_tokens = tgt_dict.encode_line(
+                                detok_hypo_str, add_if_not_exist=True
+                            )
+                        if hasattr(scorer, "add_string"):
+                            scorer.add_string(target_str, detok_hypo_str)
+                        else:
+                            scorer.add(target_tokens, hypo_tokens)
+
+                if reorder_output:
+                    outputs[c][sample_id] = sample_output.getvalue()
 
         wps_meter.update(num_generated_tokens)
         progress.log({"wps": round(wps_meter.avg)})
@@ -367,6 +540,10 @@ def _main(cfg: DictConfig, output_file):
             sample["nsentences"] if "nsentences" in sample else sample["id"].numel()
         )
 
+    for config_output_file, config_outputs in zip(config_output_files, outputs):
+        for sample_id in sorted(config_outputs):
+            config_output_file.write(config_outputs[sample_id])
+
     logger.info("NOTE: hypothesis and token scores are output in base 2")
     logger.info(
         "Translated {:,} sentences ({:,} tokens) in {:.1f}s ({:.2f} sentences/s, {:.2f} tokens/s)".format(
@@ -388,14 +565,32 @@ def _main(cfg: DictConfig, output_file):
                     "If you are using BPE on the target side, the BLEU score is computed on BPE tokens, not on proper words.  Use --sacrebleu for standard 13a BLEU tokenization"
                 )
         # use print to be consistent with other main outputs: S-, H-, T-, D- and so on
-        print(
-            "Generate {} with beam={}: {}".format(
-                cfg.dataset.gen_subset, cfg.generation.beam, scorer.result_string()
-            ),
-            file=output_file,
-        )
+        for gen_cfg, scorer, config_output_file in zip(
+            gen_cfgs, scorers, config_output_files
+        ):
+            print(
+                "Generate {} with beam={}: {}".format(
+                    cfg.dataset.gen_subset, gen_cfg.beam, scorer.result_string()
+                ),
+                file=config_output_file,
+            )
+        if cfg.generation.decoding_configs is not None:
+            # the comparison of the decoding configs
+            decoding_configs = json.loads(cfg.generation.decoding_configs)
+            for i, (overrides, scorer) in enumerate(zip(decoding_configs, scorers)):
+                print(
+                    "Generate {} with config {} {}: {}".format(
+                        cfg.dataset.gen_subset,
+                        i,
+                        json.dumps(overrides),
+                        scorer.result_string(),
+                    ),
+                    file=output_file,
+                )
 
-    return scorer
+    if len(scorers) > 1:
+        return scorers
+    return scorers[0]
 
 
 def cli_main():
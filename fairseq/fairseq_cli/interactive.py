@@ -167,6 +167,10 @@ def main(cfg: FairseqConfig):
 
     # Initialize generator
     generator = task.build_generator(models, cfg.generation)
+    if cfg.generation.continuous_batching > 0 and not cfg.generation.constraints:
+        assert hasattr(
+            generator, "generate_continuous"
+        ), "--continuous-batching requires a SequenceGenerator"
 
     # Handle tokenization and BPE
     tokenizer = task.build_tokenizer(cfg.tokenizer)
@@ -199,6 +203,50 @@ def main(cfg: FairseqConfig):
             "NOTE: Constrained decoding currently assumes a shared subword vocabulary."
         )
 
+    def make_sample(batch):
+        src_tokens = batch.src_tokens
+        src_lengths = batch.src_lengths
+        constraints = batch.constraints
+        if use_cuda:
+            src_tokens = src_tokens.cuda()
+            src_lengths = src_lengths.cuda()
+            if constraints is not None:
+                constraints = constraints.cuda()
+
+        return {
+            "id": batch.ids,
+            "net_input": {
+                "src_tokens": src_tokens,
+                "src_lengths": src_lengths,
+            },
+            "constraints": constraints,
+        }
+
+    def translate(batches):
+        samples = (make_sample(batch) for batch in batches)
+        if cfg.generation.continuous_batching > 0 and not cfg.generation.constraints:
+            # samples are returned once all their sentences are finished
+            results = generator.generate_continuous(
+                samples, cfg.generation.continuous_batching
+            )
+        else:
+            results = (
+                (
+                    sample,
+                    task.inference_step(
+                        generator, models, sample, constraints=sample["constraints"]
+                    ),
+                )
+                for sample in samples
+            )
+        while True:
+            translate_start_time = time.time()
+            result = next(results, None)
+            if result is None:
+                break
+            sample, translations = result
+            yield sample, translations, time.time() - translate_start_time
+
     if cfg.interactive.buffer_size > 1:
         logger.info("Sentence buffer size: %s", cfg.interactive.buffer_size)
     logger.info("NOTE: hypothesis and token scores are output in base 2")
@@ -206,33 +254,17 @@ def main(cfg: FairseqConfig):
     start_id = 0
     for inputs in buffered_read(cfg.interactive.input, cfg.interactive.buffer_size):
         results = []
-        for batch in make_batches(inputs, cfg, task, max_positions, encode_fn):
-            bsz = batch.src_tokens.size(0)
-            src_tokens = batch.src_tokens
-            src_lengths = batch.src_lengths
-            constraints = batch.constraints
-            if use_cuda:
-                src_tokens = src_tokens.cuda()
-                src_lengths = src_lengths.cuda()
-                if constraints is not None:
-                    constraints = constraints.cuda()
-
-            sample = {
-                "net_input": {
-                    "src_tokens": src_tokens,
-                    "src_lengths": src_lengths,
-                },
-            }
-            translate_start_time = time.time()
-            translations = task.inference_step(
-                generator, models, sample, constraints=constraints
-            )
-            translate_time = time.time() - translate_start_time
+        for sample, translations, translate_time in translate(
+            make_batches(inputs, cfg, task, max_positions, encode_fn)
+        ):
+            src_tokens = sample["net_input"]["src_tokens"]
+            constraints = sample["constraints"]
+            bsz = src_tokens.size(0)
             total_translate_time += translate_time
             list_constraints = [[] for _ in range(bsz)]
             if cfg.generation.constraints:
                 list_constraints = [unpack_constraints(c) for c in constraints]
-            for i, (id, hypos) in enumerate(zip(batch.ids.tolist(), translations)):
+            for i, (id, hypos) in enumerate(zip(sample["id"].tolist(), translations)):
                 src_tokens_i = utils.strip_pad(src_tokens[i], tgt_dict.pad())
                 constraints = list_constraints[i]
                 results.append(
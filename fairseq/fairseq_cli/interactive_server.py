@@ -0,0 +1,530 @@
+#!/usr/bin/env python3 -u
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Serve translations of raw text with a trained model over HTTP, on a TCP port
+or a unix socket. Batches concurrent requests on-the-fly, e.g.:
+
+    fairseq-interactive-server data-bin/iwslt14.tokenized.de-en \\
+        --path checkpoint_best.pt --tokenizer moses --bpe subword_nmt \\
+        --bpe-codes code --batch-size 32 --server-port 8080
+
+    curl -d '{"src": "Hallo Welt!"}' localhost:8080/translate
+    curl localhost:8080/stats
+
+The source sentences are tokenized and BPE-encoded by a pool of worker
+processes, then queued. A batch is decoded once it holds ``--batch-size``
+sentences, or once its first sentence has waited ``--max-batch-delay``
+milliseconds, while the next requests are queued for the following batch.
+"""
+
+import ast
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import time
+from argparse import Namespace
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+from fairseq import checkpoint_utils, options, tasks, utils
+from fairseq.data import encoders
+from fairseq.dataclass.configs import FairseqConfig
+from fairseq.dataclass.utils import convert_namespace_to_omegaconf
+from fairseq_cli.generate import get_symbols_to_strip_from_output
+
+logging.basicConfig(
+    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    level=os.environ.get("LOGLEVEL", "INFO").upper(),
+    stream=sys.stdout,
+)
+logger = logging.getLogger("fairseq_cli.interactive_server")
+
+
+Request = namedtuple("Request", "src_tokens future arrival_time")
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    500: "Internal Server Error",
+}
+
+# the tokenizer and BPE of a preprocessing worker process
+_worker_tokenizer = None
+_worker_bpe = None
+
+
+def _init_preprocess_worker(common_cfg, tokenizer_cfg, bpe_cfg):
+    global _worker_tokenizer, _worker_bpe
+    utils.import_user_module(common_cfg)
+    _worker_tokenizer = encoders.build_tokenizer(tokenizer_cfg)
+    _worker_bpe = encoders.build_bpe(bpe_cfg)
+
+
+def _encode_in_worker(x: str) -> str:
+    if _worker_tokenizer is not None:
+        x = _worker_tokenizer.encode(x)
+    if _worker_bpe is not None:
+        x = _worker_bpe.encode(x)
+    return x
+
+
+def _decode_in_worker(xs: List[str]) -> List[str]:
+    results = []
+    for x in xs:
+        if _worker_bpe is not None:
+            x = _worker_bpe.decode(x)
+        if _worker_tokenizer is not None:
+            x = _worker_tokenizer.decode(x)
+        results.append(x)
+    return results
+
+
+class Translator(object):
+    """The task, models, generator and tokenizer/BPE pipeline of
+    fairseq-interactive, translating batches of sentences."""
+
+    def __init__(self, cfg: FairseqConfig):
+        self.cfg = cfg
+        self.use_cuda = torch.cuda.is_available() and not cfg.common.cpu
+
+        # Setup task, e.g., translation
+        self.task = tasks.setup_task(cfg.task)
+
+        # Load ensemble
+        overrides = ast.literal_eval(cfg.common_eval.model_overrides)
+        logger.info("loading model(s) from {}".format(cfg.common_eval.path))
+        self.models, _model_args = checkpoint_utils.load_model_ensemble(
+            utils.split_paths(cfg.common_eval.path),
+            arg_overrides=overrides,
+            task=self.task,
+            suffix=cfg.checkpoint.checkpoint_suffix,
+            strict=(cfg.checkpoint.checkpoint_shard_count == 1),
+            num_shards=cfg.checkpoint.checkpoint_shard_count,
+        )
+
+        # Optimize ensemble for generation
+        for model in self.models:
+            if model is None:
+                continue
+            if cfg.common.fp16:
+                model.half()
+            if self.use_cuda and not cfg.distributed_training.pipeline_model_parallel:
+                model.cuda()
+            model.prepare_for_inference_(cfg)
+
+        # Initialize generator
+        self.generator = self.task.build_generator(self.models, cfg.generation)
+
+        # Handle tokenization and BPE
+        self.tokenizer = self.task.build_tokenizer(cfg.tokenizer)
+        self.bpe = self.task.build_bpe(cfg.bpe)
+
+        # Load alignment dictionary for unknown word replacement
+        # (None if no unknown word replacement, empty if no path to align dictionary)
+        self.align_dict = utils.load_align_dict(cfg.generation.replace_unk)
+
+        self.max_positions = utils.resolve_max_positions(
+            self.task.max_positions(), *[model.max_positions() for model in self.models]
+        )
+
+    def encode_fn(self, x):
+        if self.tokenizer is not None:
+            x = self.tokenizer.encode(x)
+        if self.bpe is not None:
+            x = self.bpe.encode(x)
+        return x
+
+    def decode_fn(self, x):
+        if self.bpe is not None:
+            x = self.bpe.decode(x)
+        if self.tokenizer is not None:
+            x = self.tokenizer.decode(x)
+        return x
+
+    def encode(self, src_str: str) -> torch.Tensor:
+        """Tokenize, apply BPE to and binarize a source sentence."""
+        return self.binarize(self.encode_fn(src_str))
+
+    def binarize(self, src_str: str) -> torch.Tensor:
+        """Binarize a tokenized and BPE-encoded source sentence."""
+        tokens, _ = self.task.get_interactive_tokens_and_lengths([src_str], lambda x: x)
+        return tokens[0]
+
+    def translate(self, src_tokens: List[torch.Tensor]) -> List[List[Dict]]:
+        """Translate a batch of binarized source sentences.
+
+        Returns the hypotheses of each sentence, in the order given, or None
+        for the sentences longer than the models accept.
+        """
+        itr = self.task.get_batch_iterator(
+            dataset=self.task.build_dataset_for_inference(
+                src_tokens, [t.numel() for t in src_tokens]
+            ),
+            max_tokens=self.cfg.dataset.max_tokens,
+            max_sentences=self.cfg.dataset.batch_size,
+            max_positions=self.max_positions,
+            ignore_invalid_inputs=True,
+            # a new dataset is built for every batch
+            disable_iterator_cache=True,
+        ).next_epoch_itr(shuffle=False)
+        hypos = [None] * len(src_tokens)
+        for sample in itr:
+            if self.use_cuda:
+                sample = utils.move_to_cuda(sample)
+            translations = self.task.inference_step(self.generator, self.models, sample)
+            for id, sent_hypos in zip(sample["id"].tolist(), translations):
+                hypos[id] = sent_hypos
+        return hypos
+
+    def postprocess(
+        self, src_tokens: torch.Tensor, hypos: List[Dict], detokenize=True
+    ) -> List[Dict]:
+        """Convert the top hypotheses of a sentence to text, with their scores
+        in base 2. Without *detokenize*, the ``"detok"`` hypotheses are left
+        to the caller."""
+        src_str = self.task.source_dictionary.string(
+            src_tokens, self.cfg.common_eval.post_process
+        )
+        results = []
+        for hypo in hypos[: min(len(hypos), self.cfg.generation.nbest)]:
+            hypo_tokens, hypo_str, alignment = utils.post_process_prediction(
+                hypo_tokens=hypo["tokens"].int().cpu(),
+                src_str=src_str,
+                alignment=hypo["alignment"],
+                align_dict=self.align_dict,
+                tgt_dict=self.task.target_dictionary,
+                remove_bpe=self.cfg.common_eval.post_process,
+                extra_symbols_to_ignore=get_symbols_to_strip_from_output(
+                    self.generator
+                ),
+            )
+            result = {
+                # original hypothesis (after tokenization and BPE)
+                "hypo": hypo_str,
+                # detokenized hypothesis
+                "detok": self.decode_fn(hypo_str) if detokenize else None,
+                # convert from base e to base 2
+                "score": float(hypo["score"]) / math.log(2),
+                "positional_scores": (
+                    hypo["positional_scores"].float() / math.log(2)
+                ).tolist(),
+            }
+            if self.cfg.generation.print_alignment:
+                result["alignment"] = [[src, tgt] for src, tgt in alignment]
+            results.append(result)
+        return results
+
+
+class ServerStats(object):
+    """Latency and throughput counters of an :class:`InteractiveServer`.
+
+    The latency percentiles are computed over the last *window* sentences.
+    """
+
+    def __init__(self, window=10000):
+        self.start_time = time.perf_counter()
+        self.latencies = deque(maxlen=window)
+        self.sentences = 0
+        self.tokens = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_sentences = 0
+
+    def log_sentence(self, latency, num_tokens):
+        self.latencies.append(latency)
+        self.sentences += 1
+        self.tokens += num_tokens
+
+    def log_batch(self, bsz):
+        self.batches += 1
+        self.batched_sentences += bsz
+
+    def summary(self) -> Dict:
+        elapsed = time.perf_counter() - self.start_time
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "sentences": self.sentences,
+            "errors": self.errors,
+            "batches": self.batches,
+            "mean_batch_size": self.batched_sentences / max(self.batches, 1),
+            "latency_p50_ms": np.percentile(latencies, 50) if len(latencies) else None,
+            "latency_p99_ms": np.percentile(latencies, 99) if len(latencies) else None,
+            "sentences_per_sec": self.sentences / elapsed,
+            "tokens_per_sec": self.tokens / elapsed,
+            "uptime_sec": elapsed,
+        }
+
+
+class InteractiveServer(object):
+    """Serves the translations of a :class:`Translator` over HTTP/1.1.
+
+    ``POST /translate`` with a JSON object whose ``"src"`` is a sentence, or a
+    list of sentences, returns their hypotheses, and ``GET /stats`` returns the
+    counters of :class:`ServerStats`.
+
+    The sentences of concurrent requests are decoded together, in batches of
+    up to *batch_size* sentences, each of them decoded at the latest
+    *max_batch_delay* seconds after its first sentence was queued (or as soon
+    as the previous batch is decoded).
+
+    Args:
+        translator (Translator): the models and pre/post-processing
+        batch_size (int): the maximum number of sentences of a batch
+        max_batch_delay (float): the maximum time, in seconds, to wait for
+            more sentences before decoding a batch
+        num_workers (int): the number of processes tokenizing, applying BPE
+            to and detokenizing the sentences, which are pure Python; the
+            models are run by a thread
+    """
+
+    def __init__(self, translator, batch_size, max_batch_delay, num_workers=1):
+        self.translator = translator
+        self.batch_size = batch_size
+        self.max_batch_delay = max_batch_delay
+        self.num_workers = num_workers
+        cfg = translator.cfg
+        # spawned, as forking the threads of the server and the models is unsafe
+        self.preprocess_pool = ProcessPoolExecutor(
+            num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_preprocess_worker,
+            initargs=(cfg.common, cfg.tokenizer, cfg.bpe),
+        )
+        self.generate_pool = ThreadPoolExecutor(1)
+        self.stats = ServerStats()
+        self.pending = deque()
+        self.server = None
+
+    async def start(self, host=None, port=None, unix_socket=None):
+        """Start serving on the TCP *port* of *host*, or on *unix_socket*, and
+        return the address served on."""
+        self.queued = asyncio.Event()
+        # start the preprocessing workers before the first request
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *[
+                loop.run_in_executor(self.preprocess_pool, _encode_in_worker, "")
+                for _ in range(self.num_workers)
+            ]
+        )
+        self.batcher = asyncio.ensure_future(self._batch_loop())
+        if unix_socket is not None:
+            self.server = await asyncio.start_unix_server(
+                self._handle_connection, path=unix_socket
+            )
+        else:
+            self.server = await asyncio.start_server(
+                self._handle_connection, host, port
+            )
+        return self.server.sockets[0].getsockname()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.cancel()
+        self.preprocess_pool.shutdown()
+        self.generate_pool.shutdown()
+
+    async def serve_forever(self, host=None, port=None, unix_socket=None):
+        address = await self.start(host, port, unix_socket)
+        logger.info("serving on {}".format(address))
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    async def translate(self, src_str: str) -> List[Dict]:
+        """Translate a sentence, as part of the next batch."""
+        loop = asyncio.get_running_loop()
+        start_time = time.perf_counter()
+        src_str = await loop.run_in_executor(
+            self.preprocess_pool, _encode_in_worker, src_str
+        )
+        src_tokens = self.translator.binarize(src_str)
+        future = loop.create_future()
+        self.pending.append(Request(src_tokens, future, loop.time()))
+        self.queued.set()
+        hypos = await future
+        results = self.translator.postprocess(src_tokens, hypos, detokenize=False)
+        detoks = await loop.run_in_executor(
+            self.preprocess_pool,
+            _decode_in_worker,
+            [result["hypo"] for result in results],
+        )
+        for result, detok in zip(results, detoks):
+            result["detok"] = detok
+        self.stats.log_sentence(
+            time.perf_counter() - start_time,
+            sum(len(hypo["positional_scores"]) for hypo in results[:1]),
+        )
+        return results
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while len(self.pending) == 0:
+                self.queued.clear()
+                await self.queued.wait()
+            # wait for a full batch until the deadline of the oldest sentence
+            deadline = self.pending[0].arrival_time + self.max_batch_delay
+            while len(self.pending) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                self.queued.clear()
+                try:
+                    await asyncio.wait_for(self.queued.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            batch = [
+                self.pending.popleft()
+                for _ in range(min(len(self.pending), self.batch_size))
+            ]
+            self.stats.log_batch(len(batch))
+            try:
+                hypos = await loop.run_in_executor(
+                    self.generate_pool,
+                    self.translator.translate,
+                    [request.src_tokens for request in batch],
+                )
+            except Exception as e:
+                logger.exception("failed to translate a batch")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            for request, sent_hypos in zip(batch, hypos):
+                if request.future.done():
+                    # the client is gone
+                    continue
+                if sent_hypos is None:
+                    request.future.set_exception(
+                        ValueError(
+                            "the sentence ({} tokens) is longer than the models "
+                            "accept".format(request.src_tokens.numel())
+                        )
+                    )
+                else:
+                    request.future.set_result(sent_hypos)
+
+    async def _respond(self, method, path, body):
+        if method == "GET" and path == "/stats":
+            return 200, self.stats.summary()
+        if method != "POST" or path != "/translate":
+            return 404, {"error": "unknown endpoint {} {}".format(method, path)}
+        try:
+            src = json.loads(body)["src"]
+        except (ValueError, KeyError, TypeError):
+            return 400, {"error": 'expected a JSON object with a "src" field'}
+        src_strs = src if isinstance(src, list) else [src]
+        if not all(isinstance(src_str, str) for src_str in src_strs):
+            return 400, {"error": '"src" must be a string or a list of strings'}
+        results = await asyncio.gather(
+            *[self.translate(src_str.strip()) for src_str in src_strs],
+            return_exceptions=True,
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        self.stats.errors += len(errors)
+        if len(errors) > 0:
+            status = 400 if isinstance(errors[0], ValueError) else 500
+            return status, {"error": str(errors[0])}
+        if isinstance(src, list):
+            return 200, {"hypos": results}
+        return 200, {"hypos": results[0]}
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            method, path, _version = request_line.decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, value = line.decode("latin-1").split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+        except (ValueError, asyncio.IncompleteReadError):
+            status, response = 400, {"error": "malformed HTTP request"}
+        else:
+            status, response = await self._respond(method, path, body)
+        payload = json.dumps(response).encode("utf-8")
+        writer.write(
+            "HTTP/1.1 {} {}\r\n"
+            "Content-Type: application/json\r\n"
+            "Content-Length: {}\r\n"
+            "Connection: close\r\n\r\n".format(
+                status, HTTP_REASONS[status], len(payload)
+            ).encode("latin-1")
+            + payload
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+def main(cfg: FairseqConfig):
+    if isinstance(cfg, Namespace):
+        cfg = convert_namespace_to_omegaconf(cfg)
+
+    utils.import_user_module(cfg.common)
+
+    assert (
+        cfg.interactive.server_port is not None
+        or cfg.interactive.server_socket is not None
+    ), "--server-port or --server-socket is required"
+    assert (
+        not cfg.generation.constraints
+    ), "fairseq-interactive-server does not support --constraints"
+    assert (
+        not cfg.generation.sampling or cfg.generation.nbest == cfg.generation.beam
+    ), "--sampling requires --nbest to be equal to --beam"
+    if cfg.dataset.max_tokens is None and cfg.dataset.batch_size is None:
+        cfg.dataset.batch_size = 32
+
+    logger.info(cfg)
+
+    # Fix seed for stochastic decoding
+    if cfg.common.seed is not None and not cfg.generation.no_seed_provided:
+        np.random.seed(cfg.common.seed)
+        utils.set_torch_seed(cfg.common.seed)
+
+    server = InteractiveServer(
+        Translator(cfg),
+        # with --max-tokens only, batches are only cut by --max-batch-delay
+        batch_size=cfg.dataset.batch_size or sys.maxsize,
+        max_batch_delay=cfg.interactive.max_batch_delay / 1000,
+        num_workers=cfg.interactive.preprocess_workers,
+    )
+    logger.info("NOTE: hypothesis and token scores are output in base 2")
+    asyncio.run(
+        server.serve_forever(
+            cfg.interactive.server_host,
+            cfg.interactive.server_port,
+            cfg.interactive.server_socket,
+        )
+    )
+
+
+def cli_main():
+    parser = options.get_interactive_generation_parser()
+    args = options.parse_args_and_arch(parser)
+    main(args)
+
+
+if __name__ == "__main__":
+    cli_main()
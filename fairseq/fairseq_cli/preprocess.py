@@ -7,6 +7,8 @@
 Data pre-processing: build vocabularies and binarize training data.
 """
 
+import hashlib
+import json
 import logging
 import os
 import shutil
@@ -18,6 +20,7 @@ from itertools import zip_longest
 from fairseq import options, tasks, utils
 from fairseq.binarizer import (
     AlignmentDatasetBinarizer,
+    FastVocabularyDatasetBinarizer,
     FileBinarizer,
     VocabularyDatasetBinarizer,
 )
@@ -93,6 +96,38 @@ def _build_dictionary(
     )
 
 
+#####################################################################
+# incremental binarization
+#####################################################################
+
+
+def _manifest_path(args):
+    return os.path.join(args.destdir, "preprocess_manifest.json")
+
+
+def _load_manifest(args) -> tp.Dict[str, tp.Any]:
+    path = _manifest_path(args)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_manifest(args, manifest: tp.Dict[str, tp.Any]):
+    path = _manifest_path(args)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def _binarizer_fingerprint(vocab: Dictionary, args: Namespace) -> str:
+    """what, besides the input text, determines the binarized output"""
+    sha1 = hashlib.sha1()
+    sha1.update(f"{args.dataset_impl} append_eos=True\n".encode("utf-8"))
+    sha1.update("\n".join(vocab.symbols).encode("utf-8"))
+    return sha1.hexdigest()
+
+
 #####################################################################
 # bin file creation logic
 #####################################################################
@@ -108,22 +143,45 @@ def _make_binary_dataset(
 ):
     logger.info("[{}] Dictionary: {} types".format(lang, len(vocab)))
 
-    binarizer = VocabularyDatasetBinarizer(
-        vocab,
-        append_eos=True,
-    )
+    if args.fast_binarize:
+        binarizer = FastVocabularyDatasetBinarizer(
+            vocab,
+            append_eos=True,
+        )
+    else:
+        binarizer = VocabularyDatasetBinarizer(
+            vocab,
+            append_eos=True,
+        )
 
     input_file = "{}{}".format(input_prefix, ("." + lang) if lang is not None else "")
     full_output_prefix = dataset_dest_prefix(args, output_prefix, lang)
 
-    final_summary = FileBinarizer.multiprocess_dataset(
-        input_file,
-        args.dataset_impl,
-        binarizer,
-        full_output_prefix,
-        vocab_size=len(vocab),
-        num_workers=num_workers,
-    )
+    if args.incremental:
+        manifest = _load_manifest(args)
+        key = os.path.basename(full_output_prefix)
+        final_summary, chunks = FileBinarizer.incremental_dataset(
+            input_file,
+            args.dataset_impl,
+            binarizer,
+            full_output_prefix,
+            fingerprint=_binarizer_fingerprint(vocab, args),
+            previous_chunks=manifest.get(key),
+            vocab_size=len(vocab),
+            num_workers=num_workers,
+            chunk_bytes=args.incremental_chunk_mb * 2**20,
+        )
+        manifest[key] = chunks
+        _save_manifest(args, manifest)
+    else:
+        final_summary = FileBinarizer.multiprocess_dataset(
+            input_file,
+            args.dataset_impl,
+            binarizer,
+            full_output_prefix,
+            vocab_size=len(vocab),
+            num_workers=num_workers,
+        )
 
     logger.info(f"[{lang}] {input_file}: {final_summary} (by {vocab.unk_word})")
 
@@ -290,16 +348,29 @@ def main(args):
     assert (
         args.dataset_impl != "huffman"
     ), "preprocessing.py doesn't support Huffman yet, use HuffmanCodeBuilder directly."
+    assert (
+        not args.fast_binarize or args.dataset_impl == "mmap"
+    ), "--fast-binarize is only supported with --dataset-impl mmap"
+    assert (
+        not args.incremental or args.dataset_impl == "mmap"
+    ), "--incremental is only supported with --dataset-impl mmap"
 
     # build dictionaries
 
     target = not args.only_source
 
-    if not args.srcdict and os.path.exists(_dict_path(args.source_lang, args.destdir)):
+    # an incremental run rebuilds the dictionaries in place, the binarized
+    # data is only reused where they did not change
+    if (
+        not args.incremental
+        and not args.srcdict
+        and os.path.exists(_dict_path(args.source_lang, args.destdir))
+    ):
         raise FileExistsError(_dict_path(args.source_lang, args.destdir))
 
     if (
-        target
+        not args.incremental
+        and target
         and not args.tgtdict
         and os.path.exists(_dict_path(args.target_lang, args.destdir))
     ):
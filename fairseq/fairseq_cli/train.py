@@ -470,60 +470,70 @@ def validate(
     valid_losses = []
     for subset_idx, subset in enumerate(subsets):
         logger.info('begin validation on "{}" subset'.format(subset))
+        # only tracking the best metric on the 1st validation subset
+        tracking_best = subset_idx == 0
 
-        # Initialize data iterator
-        itr = trainer.get_valid_iterator(subset).next_epoch_itr(
-            shuffle=False, set_dataset_epoch=False  # use a fixed valid set
-        )
-        if cfg.common.tpu:
-            itr = utils.tpu_data_loader(itr)
-        progress = progress_bar.progress_bar(
-            itr,
-            log_format=cfg.common.log_format,
-            log_interval=cfg.common.log_interval,
-            epoch=epoch_itr.epoch,
-            prefix=f"valid on '{subset}' subset",
-            aim_repo=(
-                cfg.common.aim_repo
-                if distributed_utils.is_master(cfg.distributed_training)
-                else None
-            ),
-            aim_run_hash=(
-                cfg.common.aim_run_hash
-                if distributed_utils.is_master(cfg.distributed_training)
-                else None
-            ),
-            aim_param_checkpoint_dir=cfg.checkpoint.save_dir,
-            tensorboard_logdir=(
-                cfg.common.tensorboard_logdir
-                if distributed_utils.is_master(cfg.distributed_training)
-                else None
-            ),
-            default_log_format=("tqdm" if not cfg.common.no_progress_bar else "simple"),
-            wandb_project=(
-                cfg.common.wandb_project
-                if distributed_utils.is_master(cfg.distributed_training)
-                else None
-            ),
-            wandb_run_name=os.environ.get(
-                "WANDB_NAME", os.path.basename(cfg.checkpoint.save_dir)
-            ),
-        )
+        revalidate = True
+        while revalidate:
+            # Initialize data iterator
+            itr = trainer.get_valid_iterator(subset).next_epoch_itr(
+                shuffle=False, set_dataset_epoch=False  # use a fixed valid set
+            )
+            if cfg.common.tpu:
+                itr = utils.tpu_data_loader(itr)
+            progress = progress_bar.progress_bar(
+                itr,
+                log_format=cfg.common.log_format,
+                log_interval=cfg.common.log_interval,
+                epoch=epoch_itr.epoch,
+                prefix=f"valid on '{subset}' subset",
+                aim_repo=(
+                    cfg.common.aim_repo
+                    if distributed_utils.is_master(cfg.distributed_training)
+                    else None
+                ),
+                aim_run_hash=(
+                    cfg.common.aim_run_hash
+                    if distributed_utils.is_master(cfg.distributed_training)
+                    else None
+                ),
+                aim_param_checkpoint_dir=cfg.checkpoint.save_dir,
+                tensorboard_logdir=(
+                    cfg.common.tensorboard_logdir
+                    if distributed_utils.is_master(cfg.distributed_training)
+                    else None
+                ),
+                default_log_format=(
+                    "tqdm" if not cfg.common.no_progress_bar else "simple"
+                ),
+                wandb_project=(
+                    cfg.common.wandb_project
+                    if distributed_utils.is_master(cfg.distributed_training)
+                    else None
+                ),
+                wandb_run_name=os.environ.get(
+                    "WANDB_NAME", os.path.basename(cfg.checkpoint.save_dir)
+                ),
+            )
 
-        # create a new root metrics aggregator so validation metrics
-        # don't pollute other aggregators (e.g., train meters)
-        with metrics.aggregate(new_root=True) as agg:
-            for i, sample in enumerate(progress):
-                if (
-                    cfg.dataset.max_valid_steps is not None
-                    and i > cfg.dataset.max_valid_steps
-                ):
-                    break
-                trainer.valid_step(sample)
+            # create a new root metrics aggregator so validation metrics
+            # don't pollute other aggregators (e.g., train meters)
+            with metrics.aggregate(new_root=True) as agg:
+                for i, sample in enumerate(progress):
+                    if (
+                        cfg.dataset.max_valid_steps is not None
+                        and i > cfg.dataset.max_valid_steps
+                    ):
+                        break
+                    trainer.valid_step(sample)
+
+            # tasks may request another pass over the subset, e.g. to re-decode
+            # with a more expensive generator (see --eval-bleu-adaptive)
+            revalidate = tracking_best and task.should_revalidate(
+                agg.get_smoothed_values()
+            )
 
         # log validation stats
-        # only tracking the best metric on the 1st validation subset
-        tracking_best = subset_idx == 0
         stats = get_valid_stats(cfg, trainer, agg.get_smoothed_values(), tracking_best)
 
         if hasattr(task, "post_validate"):
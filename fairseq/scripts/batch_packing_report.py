@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Report how well the batches of a binarized translation dataset are packed:
+the padding ratio, the tokens per batch and histograms of the batch sizes,
+for greedy batching and for --min-padding-batches, e.g.:
+
+    python scripts/batch_packing_report.py data-bin/iwslt14.tokenized.de-en \\
+        --max-tokens 4096
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from fairseq.data import Dictionary, LanguagePairDataset, data_utils
+
+
+def packing_stats(dataset, batches, max_tokens):
+    src_sizes, tgt_sizes = dataset.src_sizes, dataset.tgt_sizes
+    num_sentences = np.array([len(b) for b in batches])
+    real = np.array([src_sizes[b].sum() + tgt_sizes[b].sum() for b in batches])
+    padded = np.array(
+        [len(b) * (src_sizes[b].max() + tgt_sizes[b].max()) for b in batches]
+    )
+    tgt_tokens = np.array([tgt_sizes[b].sum() for b in batches])
+    # what --max-tokens is checked against
+    budget = np.array([len(b) * dataset.num_tokens_vec(b).max() for b in batches])
+    return {
+        "batches": len(batches),
+        "padding_ratio": float(1 - real.sum() / padded.sum()),
+        "tgt_tokens_per_batch": float(tgt_tokens.mean()),
+        "padded_tokens_per_batch": float(padded.mean()),
+        "max_tokens_fill": float(budget.mean() / max_tokens) if max_tokens else None,
+        "sentences_per_batch": float(num_sentences.mean()),
+        "sentences_histogram": histogram(num_sentences),
+        "padded_tokens_histogram": histogram(padded),
+    }
+
+
+def histogram(values, bins=10):
+    counts, edges = np.histogram(values, bins=bins)
+    return {
+        "counts": counts.tolist(),
+        "edges": [float(e) for e in edges],
+    }
+
+
+def print_histogram(name, hist):
+    print(f"  {name}:")
+    width = max(hist["counts"])
+    for count, lo, hi in zip(hist["counts"], hist["edges"], hist["edges"][1:]):
+        bar = "#" * int(round(40 * count / width)) if width else ""
+        print(f"    {lo:>8.0f} - {hi:<8.0f} {count:>7} {bar}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("data", help="data-bin directory")
+    parser.add_argument("-s", "--source-lang", default=None)
+    parser.add_argument("-t", "--target-lang", default=None)
+    parser.add_argument("--split", default="train")
+    parser.add_argument("--dataset-impl", default=None)
+    parser.add_argument("--max-tokens", type=int, default=4096)
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--required-batch-size-multiple", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print one JSON object")
+    args = parser.parse_args()
+
+    src, tgt = args.source_lang, args.target_lang
+    if src is None or tgt is None:
+        src, tgt = data_utils.infer_language_pair(args.data)
+    prefix = os.path.join(args.data, f"{args.split}.{src}-{tgt}.")
+    datasets = {}
+    for lang in [src, tgt]:
+        dictionary = Dictionary.load(os.path.join(args.data, f"dict.{lang}.txt"))
+        datasets[lang] = (
+            data_utils.load_indexed_dataset(
+                prefix + lang, dictionary, args.dataset_impl
+            ),
+            dictionary,
+        )
+    (src_dataset, src_dict), (tgt_dataset, tgt_dict) = datasets[src], datasets[tgt]
+
+    report = {
+        "data": args.data,
+        "split": args.split,
+        "pair": f"{src}-{tgt}",
+        "sentences": len(src_dataset),
+        "max_tokens": args.max_tokens,
+        "strategies": {},
+    }
+    for strategy in ["greedy", "min_padding"]:
+        dataset = LanguagePairDataset(
+            src_dataset,
+            src_dataset.sizes,
+            src_dict,
+            tgt_dataset,
+            tgt_dataset.sizes,
+            tgt_dict,
+            min_padding_batches=strategy == "min_padding",
+        )
+        with data_utils.numpy_seed(args.seed):
+            indices = dataset.ordered_indices()
+        start = time.perf_counter()
+        batches = dataset.batch_by_size(
+            indices,
+            max_tokens=args.max_tokens,
+            max_sentences=args.batch_size,
+            required_batch_size_multiple=args.required_batch_size_multiple,
+        )
+        stats = packing_stats(dataset, batches, args.max_tokens)
+        stats["seconds"] = time.perf_counter() - start
+        report["strategies"][strategy] = stats
+
+    if args.json:
+        print(json.dumps(report))
+        return
+
+    print(
+        f"{args.data} {args.split} {src}-{tgt}: {report['sentences']} sentences, "
+        f"--max-tokens {args.max_tokens}"
+    )
+    for strategy, stats in report["strategies"].items():
+        print(
+            f"{strategy}: {stats['batches']} batches in {stats['seconds']:.2f}s, "
+            f"{100 * stats['padding_ratio']:.1f}% padding, "
+            f"{stats['tgt_tokens_per_batch']:.0f} target tokens/batch, "
+            f"{stats['sentences_per_batch']:.1f} sentences/batch"
+        )
+        print_histogram("sentences per batch", stats["sentences_histogram"])
+        print_histogram("padded tokens per batch", stats["padded_tokens_histogram"])
+
+
+if __name__ == "__main__":
+    main()
@@ -216,6 +216,7 @@ def do_setup(package_data):
                 "fairseq-generate = fairseq_cli.generate:cli_main",
                 "fairseq-hydra-train = fairseq_cli.hydra_train:cli_main",
                 "fairseq-interactive = fairseq_cli.interactive:cli_main",
+                "fairseq-interactive-server = fairseq_cli.interactive_server:cli_main",
                 "fairseq-preprocess = fairseq_cli.preprocess:cli_main",
                 "fairseq-score = fairseq_cli.score:cli_main",
                 "fairseq-train = fairseq_cli.train:cli_main",
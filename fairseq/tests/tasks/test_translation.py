@@ -0,0 +1,64 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+from fairseq.data import Dictionary
+from fairseq.tasks.translation import TranslationConfig, TranslationTask
+
+
+class TestTranslationTask(unittest.TestCase):
+    def validate(self, task, bleu, gen_time):
+        # the generation time of a validation pass, as logged by valid_step
+        task._eval_bleu_gen_time = gen_time
+        return task.should_revalidate({"bleu": bleu})
+
+    def test_eval_bleu_adaptive(self):
+        cfg = TranslationConfig(
+            eval_bleu=True, eval_bleu_adaptive=True, eval_bleu_adaptive_margin=1.0
+        )
+        task = TranslationTask(cfg, Dictionary(), Dictionary())
+
+        # without a best BLEU yet, the first greedy pass is decoded again
+        task.begin_valid_epoch(1, None)
+        self.assertFalse(task._eval_bleu_use_beam)
+        self.assertTrue(self.validate(task, bleu=10.0, gen_time=2.0))
+        self.assertTrue(task._eval_bleu_use_beam)
+        self.assertEqual(task._eval_bleu_time_saved, -2.0)
+        # the full pass updates the best BLEU
+        self.assertFalse(self.validate(task, bleu=12.0, gen_time=10.0))
+        self.assertEqual(task._eval_bleu_best, 12.0)
+        self.assertFalse(task._eval_bleu_use_beam)
+
+        # a greedy BLEU far below the best skips the full pass
+        task.begin_valid_epoch(2, None)
+        self.assertFalse(self.validate(task, bleu=5.0, gen_time=2.0))
+        self.assertEqual(task._eval_bleu_best, 12.0)
+        self.assertEqual(task._eval_bleu_time_saved, -2.0 + (10.0 - 2.0))
+
+        # a greedy BLEU within the margin of the best is decoded again
+        task.begin_valid_epoch(3, None)
+        self.assertTrue(self.validate(task, bleu=11.5, gen_time=2.0))
+        self.assertEqual(task._eval_bleu_time_saved, 6.0 - 2.0)
+        self.assertFalse(self.validate(task, bleu=13.0, gen_time=10.0))
+        self.assertEqual(task._eval_bleu_best, 13.0)
+
+        # a worse full pass keeps the best BLEU
+        task.begin_valid_epoch(4, None)
+        self.assertTrue(self.validate(task, bleu=12.5, gen_time=2.0))
+        self.assertFalse(self.validate(task, bleu=12.8, gen_time=10.0))
+        self.assertEqual(task._eval_bleu_best, 13.0)
+
+    def test_eval_bleu_not_adaptive(self):
+        task = TranslationTask(
+            TranslationConfig(eval_bleu=True), Dictionary(), Dictionary()
+        )
+        task.begin_valid_epoch(1, None)
+        self.assertTrue(task._eval_bleu_use_beam)
+        self.assertFalse(self.validate(task, bleu=10.0, gen_time=2.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
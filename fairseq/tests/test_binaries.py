@@ -3,6 +3,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import asyncio
 import contextlib
 import json
 import logging
@@ -18,7 +19,8 @@ from typing import Dict, List
 import torch
 
 from fairseq import options
-from fairseq_cli import eval_lm, train
+from fairseq.dataclass.utils import convert_namespace_to_omegaconf
+from fairseq_cli import eval_lm, generate, interactive, interactive_server, train
 from tests.utils import (
     create_dummy_data,
     create_laser_data_and_config_json,
@@ -163,6 +165,217 @@ class TestTranslation(unittest.TestCase):
                     )
                 generate_main(data_dir, ["--prefix-size", "2"])
                 generate_main(data_dir, ["--retain-dropout"])
+                generate_main(data_dir, ["--bound-early-stopping", "--nbest", "2"])
+                generate_main(data_dir, ["--encoder-out-cache-mb", "1"])
+
+    def test_generation_sort_by_output_length(self):
+        with contextlib.redirect_stdout(StringIO()):
+            with tempfile.TemporaryDirectory("test_sort_by_output_length") as data_dir:
+                create_dummy_data(data_dir)
+                preprocess_translation_data(data_dir)
+                train_translation_model(data_dir, "fconv_iwslt_de_en")
+                results = {}
+                for name, flags in [
+                    ("default", []),
+                    ("sorted", ["--sort-by-output-length", "--max-tokens", "50"]),
+                    ("sorted_ratio", ["--sort-by-output-length", "--max-len-a", "1"]),
+                ]:
+                    results_path = os.path.join(data_dir, name)
+                    # keep the batches that are not a multiple of 8
+                    flags += ["--required-batch-size-multiple", "1"]
+                    generate_main(data_dir, ["--results-path", results_path] + flags)
+                    with open(os.path.join(results_path, "generate-valid.txt")) as f:
+                        # ids, sources and hypotheses (the scores vary with padding)
+                        results[name] = [
+                            (line.split("\t")[0], line.split("\t")[-1])
+                            for line in f
+                            if line.startswith(("S-", "H-"))
+                        ]
+
+                sorted_ids = [
+                    int(key[2:]) for key, _ in results["sorted"] if key[0] == "S"
+                ]
+                self.assertEqual(sorted_ids, sorted(sorted_ids))
+                for name in ["sorted", "sorted_ratio"]:
+                    self.assertEqual(sorted(results[name]), sorted(results["default"]))
+
+    def test_generation_decoding_configs(self):
+        with contextlib.redirect_stdout(StringIO()):
+            with tempfile.TemporaryDirectory("test_decoding_configs") as data_dir:
+                create_dummy_data(data_dir)
+                preprocess_translation_data(data_dir)
+                train_translation_model(data_dir, "fconv_iwslt_de_en")
+
+                def read_hypos(path):
+                    with open(path) as f:
+                        # ids, sources and hypotheses (the scores vary with the
+                        # beam sizes BeamableMM is specialized for)
+                        return [
+                            (line.split("\t")[0], line.split("\t")[-1])
+                            for line in f
+                            if line.startswith(("S-", "H-"))
+                        ]
+
+                configs = [{"beam": 2}, {"beam": 4, "lenpen": 0.5, "nbest": 2}]
+                expected = []
+                for i, config in enumerate(configs):
+                    results_path = os.path.join(data_dir, str(i))
+                    flags = ["--results-path", results_path]
+                    for key, value in config.items():
+                        flags += ["--" + key.replace("_", "-"), str(value)]
+                    generate_main(data_dir, flags)
+                    expected.append(
+                        read_hypos(os.path.join(results_path, "generate-valid.txt"))
+                    )
+
+                results_path = os.path.join(data_dir, "configs")
+                generate_main(
+                    data_dir,
+                    [
+                        "--results-path",
+                        results_path,
+                        "--decoding-configs",
+                        json.dumps(configs),
+                    ],
+                )
+                for i in range(len(configs)):
+                    self.assertEqual(
+                        read_hypos(
+                            os.path.join(
+                                results_path, "generate-valid.{}.txt".format(i)
+                            )
+                        ),
+                        expected[i],
+                    )
+                with open(os.path.join(results_path, "generate-valid.txt")) as f:
+                    summary = [line for line in f if line.startswith("Generate")]
+                self.assertEqual(len(summary), len(configs))
+
+                # BeamableMM is specialized for --beam, which the configs override
+                results_path = os.path.join(data_dir, "same_beam")
+                generate_main(
+                    data_dir,
+                    [
+                        "--results-path",
+                        results_path,
+                        "--decoding-configs",
+                        json.dumps([configs[1]]),
+                    ],
+                )
+                self.assertEqual(
+                    read_hypos(os.path.join(results_path, "generate-valid.0.txt")),
+                    expected[1],
+                )
+
+                # args preparing the models cannot differ between configs
+                args = options.parse_args_and_arch(
+                    options.get_generation_parser(),
+                    [
+                        data_dir,
+                        "--decoding-configs",
+                        json.dumps([{"beam": 2}, {"fold_duplicate_outputs": True}]),
+                    ],
+                )
+                with self.assertRaisesRegex(AssertionError, "fold_duplicate_outputs"):
+                    generate.get_decoding_configs(convert_namespace_to_omegaconf(args))
+
+    def test_interactive_server(self):
+        with contextlib.redirect_stdout(StringIO()) as stdout:
+            with tempfile.TemporaryDirectory("test_interactive_server") as data_dir:
+                create_dummy_data(data_dir)
+                preprocess_translation_data(data_dir)
+                train_translation_model(data_dir, "fconv_iwslt_de_en")
+                with open(os.path.join(data_dir, "valid.in")) as f:
+                    lines = [line.strip() for line in f][:10]
+
+                flags = [
+                    data_dir,
+                    "--path",
+                    os.path.join(data_dir, "checkpoint_last.pt"),
+                    "--beam",
+                    "3",
+                    "--max-len-b",
+                    "5",
+                ]
+                args = options.parse_args_and_arch(
+                    options.get_interactive_generation_parser(),
+                    flags + ["--buffer-size", "10", "--batch-size", "10"],
+                )
+                orig_stdin = sys.stdin
+                sys.stdin = StringIO("\n".join(lines) + "\n")
+                interactive.main(args)
+                sys.stdin = orig_stdin
+                expected = [
+                    line.split("\t")[-1]
+                    for line in stdout.getvalue().splitlines()
+                    if line.startswith("H-")
+                ]
+
+                args = options.parse_args_and_arch(
+                    options.get_interactive_generation_parser(),
+                    flags
+                    + ["--batch-size", "4", "--max-batch-delay", "500"]
+                    + ["--tokenizer", "space"],
+                )
+                cfg = convert_namespace_to_omegaconf(args)
+                server = interactive_server.InteractiveServer(
+                    interactive_server.Translator(cfg),
+                    batch_size=4,
+                    max_batch_delay=0.5,
+                )
+                unix_socket = os.path.join(data_dir, "server.sock")
+
+                async def request(method, path, body=b""):
+                    reader, writer = await asyncio.open_unix_connection(unix_socket)
+                    writer.write(
+                        "{} {} HTTP/1.1\r\nContent-Length: {}\r\n\r\n".format(
+                            method, path, len(body)
+                        ).encode()
+                        + body
+                    )
+                    response = await reader.read()
+                    writer.close()
+                    head, body = response.split(b"\r\n\r\n", 1)
+                    return int(head.split()[1]), json.loads(body)
+
+                async def run_requests():
+                    await server.start(unix_socket=unix_socket)
+                    try:
+                        responses = await asyncio.gather(
+                            *[
+                                request(
+                                    "POST",
+                                    "/translate",
+                                    json.dumps({"src": line}).encode(),
+                                )
+                                for line in lines
+                            ]
+                        )
+                        stats = await request("GET", "/stats")
+                        errors = [
+                            await request("POST", "/translate", b"{}"),
+                            await request("GET", "/unknown"),
+                        ]
+                    finally:
+                        await server.close()
+                    return responses, stats, errors
+
+                responses, stats, errors = asyncio.run(run_requests())
+                self.assertEqual(
+                    [(200, hypo) for hypo in expected],
+                    [(status, r["hypos"][0]["hypo"]) for status, r in responses],
+                )
+                # detokenized by the preprocessing workers
+                self.assertEqual(
+                    [r["hypos"][0]["hypo"] for _, r in responses],
+                    [r["hypos"][0]["detok"] for _, r in responses],
+                )
+                status, stats = stats
+                self.assertEqual(status, 200)
+                self.assertEqual(stats["sentences"], len(lines))
+                self.assertEqual(stats["batches"], 3)
+                self.assertLessEqual(stats["latency_p50_ms"], stats["latency_p99_ms"])
+                self.assertEqual([status for status, _ in errors], [400, 404])
 
     def test_eval_bleu(self):
         with contextlib.redirect_stdout(StringIO()):
@@ -183,6 +396,27 @@ class TestTranslation(unittest.TestCase):
                     ],
                 )
 
+    def test_eval_bleu_adaptive(self):
+        with contextlib.redirect_stdout(StringIO()):
+            with tempfile.TemporaryDirectory("test_eval_bleu_adaptive") as data_dir:
+                create_dummy_data(data_dir)
+                preprocess_translation_data(data_dir)
+                train_translation_model(
+                    data_dir,
+                    "fconv_iwslt_de_en",
+                    [
+                        "--eval-bleu",
+                        "--eval-bleu-remove-bpe",
+                        "--eval-bleu-detok",
+                        "space",
+                        "--eval-bleu-args",
+                        '{"beam": 4, "min_len": 10}',
+                        "--eval-bleu-adaptive",
+                        "--eval-bleu-adaptive-margin",
+                        "0.5",
+                    ],
+                )
+
     def test_lstm(self):
         with contextlib.redirect_stdout(StringIO()):
             with tempfile.TemporaryDirectory("test_lstm") as data_dir:
@@ -254,6 +488,48 @@ class TestTranslation(unittest.TestCase):
                 )
                 generate_main(data_dir)
 
+    def test_transformer_continuous_batching(self):
+        with contextlib.redirect_stdout(StringIO()):
+            with tempfile.TemporaryDirectory("test_continuous_batching") as data_dir:
+                create_dummy_data(data_dir)
+                preprocess_translation_data(data_dir)
+                train_translation_model(
+                    data_dir,
+                    "transformer_iwslt_de_en",
+                    [
+                        "--encoder-layers",
+                        "2",
+                        "--decoder-layers",
+                        "2",
+                        "--encoder-embed-dim",
+                        "8",
+                        "--decoder-embed-dim",
+                        "8",
+                    ],
+                )
+                results = {}
+                for name, flags in [
+                    ("default", []),
+                    (
+                        "continuous",
+                        ["--batch-size", "8", "--continuous-batching", "12"],
+                    ),
+                ]:
+                    results_path = os.path.join(data_dir, name)
+                    # keep the batches that are not a multiple of 8
+                    flags += ["--required-batch-size-multiple", "1"]
+                    generate_main(data_dir, ["--results-path", results_path] + flags)
+                    with open(os.path.join(results_path, "generate-valid.txt")) as f:
+                        # ids, sources and hypotheses (the scores vary with padding)
+                        results[name] = [
+                            (line.split("\t")[0], line.split("\t")[-1])
+                            for line in f
+                            if line.startswith(("S-", "H-"))
+                        ]
+                self.assertEqual(
+                    sorted(results["continuous"]), sorted(results["default"])
+                )
+
     def test_multilingual_transformer(self):
         # test with all combinations of encoder/decoder lang tokens
         encoder_langtok_flags = [
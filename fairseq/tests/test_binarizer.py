@@ -4,12 +4,22 @@
 # LICENSE file in the root directory of this source tree.
 
 
+import contextlib
+import errno
 import os
+import pickle
 import typing as tp
 import unittest
 from tempfile import TemporaryDirectory
+from unittest.mock import patch
 
-from fairseq.binarizer import BinarizeSummary, FileBinarizer, VocabularyDatasetBinarizer
+from fairseq.binarizer import (
+    BinarizeSummary,
+    DictionaryHashTable,
+    FastVocabularyDatasetBinarizer,
+    FileBinarizer,
+    VocabularyDatasetBinarizer,
+)
 from fairseq.data import Dictionary, indexed_dataset
 from tests.utils import make_data, sizes
 
@@ -120,3 +130,199 @@ class TestBinarizer(unittest.TestCase):
             )
 
             self.compare_ds_data(summary, data, prefix_multi, impl, vocab)
+
+    def test_fast_binarizer_matches_default(self):
+        with TemporaryDirectory() as dirname:
+            raw_file = os.path.join(dirname, "raw1")
+            impl = "mmap"
+            data = make_data(out_file=raw_file)
+            # leave some symbols out of the vocabulary to exercise unk replacement
+            vocab = build_vocab([s for s in data if "z" not in s])
+
+            for append_eos, reverse_order in [(True, False), (False, True)]:
+                summaries, datasets = [], []
+                for name, binarizer in [
+                    (
+                        "slow",
+                        VocabularyDatasetBinarizer(
+                            vocab, append_eos=append_eos, reverse_order=reverse_order
+                        ),
+                    ),
+                    (
+                        "fast",
+                        FastVocabularyDatasetBinarizer(
+                            vocab,
+                            append_eos=append_eos,
+                            reverse_order=reverse_order,
+                            batch_bytes=1000,
+                        ),
+                    ),
+                ]:
+                    prefix = os.path.join(dirname, f"{name}{append_eos}")
+                    summaries.append(
+                        FileBinarizer.multiprocess_dataset(
+                            raw_file,
+                            impl,
+                            binarizer,
+                            output_prefix=prefix,
+                            vocab_size=len(vocab),
+                            num_workers=3,
+                        )
+                    )
+                    datasets.append(indexed_dataset.make_dataset(prefix, impl))
+
+                slow_summary, fast_summary = summaries
+                self.assertEqual(str(fast_summary), str(slow_summary))
+                self.assertEqual(fast_summary.replaced, slow_summary.replaced)
+                self.assertGreater(fast_summary.num_replaced, 0)
+
+                slow_ds, fast_ds = datasets
+                self.assertEqual(len(fast_ds), len(slow_ds))
+                self.assertEqual(fast_ds.sizes.tolist(), slow_ds.sizes.tolist())
+                for i in range(len(slow_ds)):
+                    self.assertEqual(fast_ds[i].tolist(), slow_ds[i].tolist())
+
+    def test_dictionary_hash_table(self):
+        with TemporaryDirectory() as dirname:
+            data = make_data(length=10)
+            vocab = build_vocab(data[:-1])
+            words = [w for s in data for w in s] + ["<unk>", "notinvocab"]
+            expected = [vocab.index(w) for w in words]
+
+            path = os.path.join(dirname, "table")
+            table = DictionaryHashTable.build(vocab, path)
+            self.assertEqual(table.lookup(words, vocab.unk()).tolist(), expected)
+
+            # workers get the table through pickling
+            table = pickle.loads(pickle.dumps(table))
+            self.assertEqual(table.lookup(words, vocab.unk()).tolist(), expected)
+
+            # processes with another hash salt rebuild the table
+            salted = DictionaryHashTable(path, hash_check=table.hash_check + 1)
+            self.assertEqual(salted.lookup(words, vocab.unk()).tolist(), expected)
+
+            # a word whose hash collides with the hash of a symbol is unknown
+            symbol = data[0][0]
+
+            def colliding_hash(word):
+                return hash(symbol) if word == "collision" else hash(word)
+
+            with patch("fairseq.binarizer.hash", colliding_hash, create=True):
+                self.assertEqual(
+                    table.lookup([symbol, "collision"], vocab.unk()).tolist(),
+                    [vocab.index(symbol), vocab.unk()],
+                )
+
+            table.remove()
+            self.assertEqual(os.listdir(dirname), [])
+
+    def test_incremental_dataset(self):
+        with TemporaryDirectory() as dirname:
+            raw_file = os.path.join(dirname, "raw1")
+            prefix = os.path.join(dirname, "test1")
+            impl = "mmap"
+            data = make_data(out_file=raw_file)
+            vocab = build_vocab(data)
+            binarizer = VocabularyDatasetBinarizer(vocab, append_eos=False)
+
+            def binarize(previous_chunks, fingerprint="v1", num_workers=1):
+                return FileBinarizer.incremental_dataset(
+                    raw_file,
+                    impl,
+                    binarizer,
+                    output_prefix=prefix,
+                    fingerprint=fingerprint,
+                    previous_chunks=previous_chunks,
+                    vocab_size=len(vocab),
+                    num_workers=num_workers,
+                    chunk_bytes=2000,
+                )
+
+            summary, chunks = binarize(None)
+            self.compare_ds_data(summary, data, prefix, impl, vocab)
+            self.assertGreater(len(chunks), 3)
+            self.assertEqual(sum(c["num_seq"] for c in chunks), len(data))
+
+            # nothing changed: the records and the output are kept
+            mtime = os.path.getmtime(indexed_dataset.data_file_path(prefix))
+            summary, same_chunks = binarize(chunks)
+            self.assertEqual(same_chunks, chunks)
+            self.assertEqual(
+                os.path.getmtime(indexed_dataset.data_file_path(prefix)), mtime
+            )
+            self.compare_ds_data(summary, data, prefix, impl, vocab)
+
+            # edit one line in the middle and append some more
+            middle = len(data) // 2
+            data[middle] = list(reversed(data[middle]))
+            data += make_data(length=20)[:20]
+            with open(raw_file, "w", encoding="utf-8") as out:
+                for s in data:
+                    print(" ".join(s), file=out)
+            summary, new_chunks = binarize(chunks, num_workers=3)
+            self.compare_ds_data(summary, data, prefix, impl, vocab)
+            kept = {c["sha1"] for c in chunks} & {c["sha1"] for c in new_chunks}
+            self.assertGreater(len(kept), 0)
+            self.assertLess(len(kept), len(new_chunks))
+
+            # a new fingerprint (e.g. dictionary) invalidates every chunk
+            summary, _ = binarize(new_chunks, fingerprint="v2")
+            self.compare_ds_data(summary, data, prefix, impl, vocab)
+            self.assertEqual(
+                sorted(os.listdir(dirname)), ["raw1", "test1.bin", "test1.idx"]
+            )
+
+    def test_merge_files(self):
+        with TemporaryDirectory() as dirname:
+            impl = "mmap"
+            data = make_data(length=300)
+            vocab = build_vocab(data)
+            shards = []
+            for i in range(4):
+                shards.append(os.path.join(dirname, f"shard{i}"))
+                ds = indexed_dataset.make_builder(
+                    indexed_dataset.data_file_path(shards[-1]),
+                    impl=impl,
+                    vocab_size=len(vocab),
+                )
+                for s in data[i::4]:
+                    ds.add_item(vocab.encode_line(" ".join(s), append_eos=False))
+                ds.finalize(indexed_dataset.index_file_path(shards[-1]))
+            expected = [s for i in range(4) for s in data[i::4]]
+
+            def no_copy_file_range(*args):
+                raise OSError(errno.EXDEV, "cross-device link")
+
+            for name, num_workers, fallback in [
+                ("sequential", 1, False),
+                ("parallel", 3, False),
+                ("fallback", 3, True),
+            ]:
+                prefix = os.path.join(dirname, name)
+                ds = indexed_dataset.make_builder(
+                    indexed_dataset.data_file_path(prefix),
+                    impl=impl,
+                    vocab_size=len(vocab),
+                )
+                context = (
+                    patch.object(os, "copy_file_range", no_copy_file_range, create=True)
+                    if fallback
+                    else contextlib.nullcontext()
+                )
+                with context:
+                    ds.merge_file_(shards[0])
+                    ds.merge_files_(shards[1:], num_workers=num_workers)
+                ds.finalize(indexed_dataset.index_file_path(prefix))
+
+                summary = BinarizeSummary(
+                    num_seq=len(expected), num_tok=sum(len(s) for s in expected)
+                )
+                self.compare_ds_data(summary, expected, prefix, impl, vocab)
+
+            merged = indexed_dataset.make_builder(
+                indexed_dataset.data_file_path(os.path.join(dirname, "merged")),
+                impl=impl,
+                vocab_size=len(vocab),
+            )
+            merged.merge_files_(shards, num_workers=2, remove=True)
+            self.assertFalse(any(os.path.exists(f"{s}.bin") for s in shards))
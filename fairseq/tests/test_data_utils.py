@@ -3,11 +3,17 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import itertools
 import unittest
 
 import numpy as np
 
-from fairseq.data.data_utils_fast import batch_by_size_fn, batch_by_size_vec
+from fairseq.data import data_utils
+from fairseq.data.data_utils_fast import (
+    batch_by_size_fn,
+    batch_by_size_min_padding_vec,
+    batch_by_size_vec,
+)
 
 
 class TestBatchBySize(unittest.TestCase):
@@ -132,5 +138,61 @@ class TestBatchBySizeFn(TestBatchBySize):
         self._run_compare_with_baseline_sweep(batch_by_size_fn_wrapper)
 
 
+class TestBatchBySizeMinPadding(unittest.TestCase):
+    @staticmethod
+    def cost(batches, num_tokens_vec, sizes, max_tokens, max_sentences, bsz_mult):
+        """(batch count, padding), or None if a batch breaks a constraint"""
+        padding = 0
+        for batch in batches:
+            n = len(batch)
+            if n * num_tokens_vec[batch].max() > max_tokens > 0:
+                return None
+            if n > max_sentences > 0 or not (n < bsz_mult or n % bsz_mult == 0):
+                return None
+            padding += int((n * sizes[batch].max(axis=0) - sizes[batch].sum(0)).sum())
+        return len(batches), padding
+
+    def test_optimal(self):
+        rng = np.random.RandomState(0)
+        for _ in range(200):
+            n = rng.randint(1, 9)
+            sizes = rng.randint(1, 10, size=(n, 2))
+            num_tokens_vec = sizes.max(axis=1)
+            max_tokens = rng.randint(num_tokens_vec.max(), 40)
+            max_sentences = rng.randint(0, n + 1)
+            bsz_mult = rng.randint(1, 4)
+            indices = np.arange(n)
+            args = (num_tokens_vec, sizes, max_tokens, max_sentences, bsz_mult)
+
+            batches = batch_by_size_min_padding_vec(
+                indices, num_tokens_vec, sizes, max_tokens, max_sentences, bsz_mult
+            )
+            self.assertEqual(np.concatenate(batches).tolist(), indices.tolist())
+            result = self.cost(batches, *args)
+            self.assertIsNotNone(result)
+
+            # brute force over all the ways to cut indices in contiguous batches
+            best = None
+            for cuts in itertools.product([False, True], repeat=n - 1):
+                ends = [i + 1 for i, cut in enumerate(cuts) if cut]
+                cost = self.cost(np.split(indices, ends), *args)
+                if cost is not None and (best is None or cost < best):
+                    best = cost
+            self.assertEqual(result, best)
+
+    def test_unbounded(self):
+        # without max_tokens or max_sentences, everything goes in one batch
+        # without the quadratic search
+        sizes = np.random.RandomState(0).randint(1, 100, size=(100000, 2))
+        batches = data_utils.batch_by_size(
+            np.arange(len(sizes)),
+            num_tokens_fn=None,
+            num_tokens_vec=sizes.max(axis=1),
+            padding_sizes=sizes,
+        )
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(sorted(batches[0].tolist()), list(range(len(sizes))))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -3,11 +3,23 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import itertools
 import logging
+import os
 import unittest
+from tempfile import TemporaryDirectory
 from typing import Sequence
 
-from fairseq.data import LanguagePairDataset, ListDataset, RoundRobinZipDatasets
+import numpy as np
+import torch
+
+from fairseq.data import (
+    LanguagePairDataset,
+    ListDataset,
+    RoundRobinZipDatasets,
+    data_utils,
+    indexed_dataset,
+)
 from tests.test_train import mock_dict
 
 
@@ -64,3 +76,87 @@ class TestDataset(unittest.TestCase):
         self.assertEqual(dict(dataset[0]), {"a": sample(5, 7), "b": sample(2, 9)})
         self.assertEqual(dict(dataset[2]), {"a": sample(0, 10), "b": sample(2, 9)})
         self.assertEqual(dict(dataset[4]), {"a": sample(6, 12), "b": sample(2, 9)})
+
+    def test_gathered_collate(self):
+        vocab = mock_dict()
+        rng = np.random.RandomState(0)
+        with TemporaryDirectory() as dirname:
+            datasets = []
+            for name in ["src", "tgt"]:
+                prefix = os.path.join(dirname, name)
+                builder = indexed_dataset.MMapIndexedDatasetBuilder(
+                    prefix + ".bin", dtype=np.uint16
+                )
+                for _ in range(30):
+                    length = rng.randint(1, 12)
+                    tokens = rng.randint(4, 100, size=length).tolist()
+                    if rng.rand() < 0.2:
+                        # padding in the samples changes their lengths
+                        tokens[0] = vocab.pad()
+                    builder.add_item(torch.IntTensor(tokens + [vocab.eos()]))
+                builder.finalize(prefix + ".idx")
+                datasets.append(indexed_dataset.MMapIndexedDataset(prefix))
+            src, tgt = datasets
+
+            indices = rng.permutation(len(src))[:13].tolist()
+            batch, sizes = src.get_batch(indices, vocab.pad(), left_pad=True)
+            expected = data_utils.collate_tokens(
+                [src[i] for i in indices], vocab.pad(), left_pad=True
+            )
+            self.assertTrue(torch.equal(batch, expected))
+            self.assertEqual(sizes.tolist(), src.sizes[indices].tolist())
+            # into a reused buffer
+            out = torch.zeros(len(indices) * 20, dtype=torch.long)
+            batch, _ = src.get_batch(indices, vocab.pad(), left_pad=True, out=out)
+            self.assertTrue(torch.equal(batch, expected))
+            self.assertEqual(batch.data_ptr(), out.data_ptr())
+
+            options = [[True, False], [True, False], [True, False], [None, 16]]
+            for left_pad_source, left_pad_target, with_target, pad in itertools.product(
+                *options
+            ):
+                dataset = LanguagePairDataset(
+                    src,
+                    src.sizes,
+                    vocab,
+                    tgt if with_target else None,
+                    tgt.sizes if with_target else None,
+                    vocab,
+                    left_pad_source=left_pad_source,
+                    left_pad_target=left_pad_target,
+                )
+                pad_to_length = {"source": pad, "target": pad} if pad else None
+                expected = dataset.collater(
+                    [dataset[i] for i in indices], pad_to_length=pad_to_length
+                )
+                samples = dataset.__getitems__(indices)
+                self.assertIsInstance(samples, dict)
+                batch = dataset.collater(samples, pad_to_length=pad_to_length)
+                self.assertEqual(batch.keys(), expected.keys())
+                self.assertEqual(batch["ntokens"], expected["ntokens"])
+                self.assertEqual(batch["nsentences"], expected["nsentences"])
+                for key in ["id", "target"]:
+                    if expected[key] is None:
+                        self.assertIsNone(batch[key])
+                    else:
+                        self.assertTrue(torch.equal(batch[key], expected[key]))
+                net_input = expected["net_input"]
+                self.assertEqual(batch["net_input"].keys(), net_input.keys())
+                for key, value in net_input.items():
+                    self.assertTrue(torch.equal(batch["net_input"][key], value))
+
+            # samples that need editing are still read one by one
+            dataset = LanguagePairDataset(
+                src, src.sizes, vocab, tgt, tgt.sizes, remove_eos_from_source=True
+            )
+            samples = dataset.__getitems__(indices)
+            self.assertEqual([s["id"] for s in samples], indices)
+
+            # and so are the samples of subclasses with their own collater
+            class CollatingDataset(LanguagePairDataset):
+                def collater(self, samples, pad_to_length=None):
+                    return samples
+
+            dataset = CollatingDataset(src, src.sizes, vocab, tgt, tgt.sizes)
+            samples = dataset.__getitems__(indices)
+            self.assertEqual([s["id"] for s in samples], indices)
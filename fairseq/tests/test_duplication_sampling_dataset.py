@@ -0,0 +1,132 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import torch
+
+from fairseq.data import (
+    Dictionary,
+    DuplicationSamplingDataset,
+    LanguagePairDataset,
+    ListDataset,
+    load_bpe_merges,
+)
+from fairseq.tasks import FairseqTask
+
+
+class TestDuplicationSamplingDataset(unittest.TestCase):
+    def setUp(self):
+        self.vocab = Dictionary()
+        for symbol in ["h@@", "e@@", "l@@", "o", "he@@", "llo", "hello", "x"]:
+            self.vocab.add_symbol(symbol)
+        for k in range(1, 4):
+            self.vocab.add_symbol(f"複複{k}複複llo")
+            self.vocab.add_symbol(f"複複{k}複複hello")
+        self.variants = {
+            base: {self.vocab.index(f"複複{k}複複{base}") for k in range(1, 4)}
+            for base in ["llo", "hello"]
+        }
+        sentences = [
+            "hello x hello",
+            "he@@ llo x",
+            "複複2複複hello 複複1複複llo",
+        ]
+        self.data = [
+            self.vocab.encode_line(s, add_if_not_exist=False) for s in sentences
+        ]
+
+    def test_resamples_duplicates(self):
+        dataset = DuplicationSamplingDataset(ListDataset(self.data), self.vocab, seed=3)
+        hello, llo, x = (self.vocab.index(s) for s in ["hello", "llo", "x"])
+
+        samples = []
+        for epoch in range(1, 21):
+            dataset.set_epoch(epoch)
+            item = dataset[0]
+            self.assertEqual(item.tolist()[1], x)
+            self.assertIn(item[0].item(), self.variants["hello"])
+            self.assertIn(item[2].item(), self.variants["hello"])
+            # existing variants are resampled too
+            self.assertIn(dataset[2][1].item(), self.variants["llo"])
+            self.assertEqual(dataset[1][0].item(), self.vocab.index("he@@"))
+            samples.append(tuple(item.tolist()))
+
+            # the sample only depends on (seed, epoch, index)
+            self.assertTrue(torch.equal(dataset[0], item))
+        self.assertGreater(len(set(samples)), 1)
+        self.assertNotIn(hello, dataset[0].tolist())
+        self.assertNotIn(llo, dataset[2].tolist())
+
+    def test_dropout(self):
+        with TemporaryDirectory() as dirname:
+            codes = os.path.join(dirname, "code")
+            with open(codes, "w", encoding="utf-8") as f:
+                print("#version: 0.2", file=f)
+                for merge in ["h e", "l l", "ll o</w>", "he llo</w>"]:
+                    print(merge, file=f)
+            merges = load_bpe_merges(codes, self.vocab)
+
+            # "ll" is not in the vocabulary, so "llo" cannot be split
+            left, right = merges
+            self.assertEqual(left[self.vocab.index("llo")], -1)
+            self.assertEqual(left[self.vocab.index("hello")], self.vocab.index("he@@"))
+            self.assertEqual(right[self.vocab.index("hello")], self.vocab.index("llo"))
+            self.assertEqual(left[self.vocab.index("he@@")], self.vocab.index("h@@"))
+
+            dataset = DuplicationSamplingDataset(
+                ListDataset(self.data), self.vocab, merges=merges, dropout=0.5
+            )
+            lengths = set()
+            for epoch in range(1, 21):
+                dataset.set_epoch(epoch)
+                item = dataset[0]
+                lengths.add(len(item))
+                words = self.vocab.string(item).split()
+                text = " ".join(words).replace("@@ ", "")
+                self.assertEqual(
+                    text.replace("複複1複複", "").replace("複複2複複", "").replace("複複3複複", ""),
+                    "hello x hello",
+                )
+            self.assertGreater(len(lengths), 1)
+
+            # "hello x hello" and eos are 4 tokens long, one merge can be undone
+            dataset = DuplicationSamplingDataset(
+                ListDataset(self.data),
+                self.vocab,
+                merges=merges,
+                dropout=0.9,
+                max_len=5,
+            )
+            lengths = set()
+            for epoch in range(1, 21):
+                dataset.set_epoch(epoch)
+                lengths.add(len(dataset[0]))
+            self.assertEqual(lengths, {5})
+
+    def test_resamples_with_data_loader_workers(self):
+        sizes = np.array([len(item) for item in self.data])
+        src = DuplicationSamplingDataset(
+            ListDataset(self.data, sizes), self.vocab, seed=3
+        )
+        dataset = LanguagePairDataset(src, sizes, self.vocab, shuffle=False)
+        self.assertFalse(dataset.can_reuse_epoch_itr_across_epochs)
+
+        task = FairseqTask(None)
+        samples = []
+        for epoch in range(1, 3):
+            # as the trainer does at the start of each epoch
+            itr = task.get_batch_iterator(
+                dataset, max_sentences=len(self.data), num_workers=1, epoch=epoch
+            ).next_epoch_itr(shuffle=False)
+            samples.append([batch["net_input"]["src_tokens"] for batch in itr])
+        self.assertFalse(all(torch.equal(x, y) for x, y in zip(samples[0], samples[1])))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -61,3 +61,18 @@ class TestFileChunker(unittest.TestCase):
                 self.assertListEqual(
                     all_lines, [self._line_content for _ in range(len(all_lines))]
                 )
+
+    def test_read_line_batches(self):
+        from fairseq.file_chunker_utils import (
+            Chunker,
+            find_offsets,
+            read_line_batches,
+        )
+
+        offsets = find_offsets(self._tmpfile, self._num_splits)
+        for start, end in zip(offsets, offsets[1:]):
+            with Chunker(self._tmpfile, start, end) as lines:
+                expected = [line.rstrip("\n") for line in lines]
+            batches = list(read_line_batches(self._tmpfile, start, end, batch_bytes=20))
+            self.assertGreater(len(batches), 1)
+            self.assertListEqual([line for b in batches for line in b], expected)
@@ -3,9 +3,18 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
+import tempfile
 import unittest
+from argparse import Namespace
+from unittest.mock import patch
 
-from fairseq.data import iterators, ListDataset
+import torch
+
+import tests.utils as test_utils
+from fairseq.data import LanguagePairDataset, ListDataset, iterators
+from fairseq.logging import metrics
+from fairseq.tasks import FairseqTask
 
 
 class TestIterators(unittest.TestCase):
@@ -132,6 +141,43 @@ class TestIterators(unittest.TestCase):
         self.assertFalse(itr.has_next())
         self.assertRaises(StopIteration, next, buffered_itr)
 
+    def test_buffered_iterator_process(self):
+        ref = [torch.full((3,), i) for i in range(10)]
+        with metrics.aggregate() as agg:
+            buffered_itr = iterators.BufferedIterator(2, ref, use_process=True)
+            out = list(buffered_itr)
+        self.assertEqual([t.tolist() for t in out], [t.tolist() for t in ref])
+        self.assertEqual(agg["data_stall"].count, 10)
+        self.assertIn("data_queue", agg)
+
+        class Failing:
+            def __len__(self):
+                return 2
+
+            def __iter__(self):
+                yield torch.zeros(1)
+                raise ValueError("bad batch")
+
+        buffered_itr = iterators.BufferedIterator(2, Failing(), use_process=True)
+        self.assertEqual(next(buffered_itr).tolist(), [0.0])
+        with self.assertRaisesRegex(ValueError, "bad batch"):
+            next(buffered_itr)
+
+    def test_buffered_iterator_process_with_workers(self):
+        # the buffer process starts the DataLoader workers
+        dataset = ListDataset(list(range(10)))
+        epoch_itr = iterators.EpochBatchIterator(
+            dataset=dataset,
+            collate_fn=dataset.collater,
+            batch_sampler=[[i, i + 1] for i in range(0, 10, 2)],
+            num_workers=1,
+            buffer_size=2,
+            buffer_process=True,
+        )
+        for _ in range(2):
+            itr = epoch_itr.next_epoch_itr(shuffle=False)
+            self.assertEqual(list(itr), [[i, i + 1] for i in range(0, 10, 2)])
+
     def test_epoch_batch_iterator_skip_remainder_batch(self):
         reference = [1, 2, 3]
         itr1 = _get_epoch_batch_itr(reference, 2, True)
@@ -148,6 +194,32 @@ class TestIterators(unittest.TestCase):
         itr6 = _get_epoch_batch_itr(reference, 4, False)
         self.assertEqual(len(itr6), 1)
 
+    def test_batch_plan_cache(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            data = test_utils.dummy_dictionary(10)
+            samples = test_utils.make_data(length=200)
+            tokens = [data.encode_line(" ".join(s)) for s in samples]
+            sizes = [len(t) for t in tokens]
+            dataset = LanguagePairDataset(tokens, sizes, data, tokens, sizes, data)
+
+            def batches(task, epoch=1):
+                itr = task.get_batch_iterator(
+                    dataset, max_tokens=64, seed=3, epoch=epoch
+                )
+                return [b.tolist() for b in itr.frozen_batches]
+
+            expected = batches(FairseqTask(Namespace()))
+            cfg = Namespace(batch_plan_cache=dirname)
+            self.assertEqual(batches(FairseqTask(cfg)), expected)
+            self.assertEqual(len(os.listdir(dirname)), 1)
+            # a new task (i.e. a restart) reads the plan back
+            with patch.object(dataset, "batch_by_size") as batch_by_size:
+                self.assertEqual(batches(FairseqTask(cfg)), expected)
+                batch_by_size.assert_not_called()
+            # other epochs get their own plan
+            batches(FairseqTask(cfg), epoch=2)
+            self.assertEqual(len(os.listdir(dirname)), 2)
+
     def test_grouped_iterator_skip_remainder_batch(self):
         reference = [1, 2, 3, 4, 5, 6, 7, 8, 9]
         itr1 = _get_epoch_batch_itr(reference, 3, False)
@@ -483,6 +483,40 @@ class TestMultiheadAttention(unittest.TestCase):
         self.assertEqual(mha.head_dim, embed_dim / num_heads)
         self.assertEqual(mha.num_heads, num_heads_to_keep)
 
+    def test_preallocate_kv_cache(self):
+        _reset_seeds()
+        embed_dim, num_heads, bsz = 16, 4, 6
+        mha = MultiheadAttention(embed_dim, num_heads, self_attention=True).eval()
+        states = {}
+        for preallocate_kv_cache in [False, True]:
+            mha.set_preallocate_kv_cache(preallocate_kv_cache)
+            state = states[preallocate_kv_cache] = {}
+            torch.manual_seed(1)
+            outputs = []
+            buffers = []
+            for step in range(12):
+                # drop a hypothesis from time to time, as beam search does
+                step_bsz = bsz - step // 4
+                x = torch.randn(1, step_bsz, embed_dim)
+                new_order = torch.randint(0, step_bsz, (bsz - (step + 1) // 4,))
+                with torch.no_grad():
+                    outputs.append(mha(x, x, x, incremental_state=state)[0])
+                    mha.reorder_incremental_state(state, new_order)
+                if preallocate_kv_cache and step > 0:
+                    buffers.append(mha._get_input_buffer(state)["prev_key_buffer"])
+            if preallocate_kv_cache:
+                # allocated at the second step, for 4 steps, then reallocated
+                # for 10 and 22 steps, each time with a spare buffer
+                self.assertEqual(len({buffer.data_ptr() for buffer in buffers}), 6)
+            else:
+                expected = outputs
+        for output, expected_output in zip(outputs, expected):
+            assert_almost_equal(output, expected_output, decimal=5)
+        buffer = mha._get_input_buffer(states[True])
+        expected_buffer = mha._get_input_buffer(states[False])
+        for key in ["prev_key", "prev_value"]:
+            assert_almost_equal(buffer[key], expected_buffer[key], decimal=5)
+
 
 if __name__ == "__main__":
     unittest.main()
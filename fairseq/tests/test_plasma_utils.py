@@ -1,10 +1,16 @@
 import contextlib
+import os
+import pickle
+import shutil
 import tempfile
 import unittest
 from io import StringIO
 
 import numpy as np
+import torch
 
+from fairseq.data.indexed_dataset import MMapIndexedDataset, MMapIndexedDatasetBuilder
+from fairseq.data.plasma_utils import SharedFileCache
 from tests.utils import create_dummy_data, preprocess_lm_data, train_language_model
 
 try:
@@ -125,3 +131,40 @@ class TestPlasmaView(unittest.TestCase):
                     ["--use-plasma-view", "--plasma-path", self.path],
                     run_validation=True,
                 )
+
+
+class TestSharedFileCache(unittest.TestCase):
+    def test_identical_indexes_are_shared(self):
+        with tempfile.TemporaryDirectory("test_shared_file_cache") as dirname:
+            prefixes = [os.path.join(dirname, name) for name in ["a", "b"]]
+            builder = MMapIndexedDatasetBuilder(prefixes[0] + ".bin")
+            for length in [3, 1, 4, 1, 5]:
+                builder.add_item(torch.arange(length, dtype=torch.int32))
+            builder.finalize(prefixes[0] + ".idx")
+            for ext in [".bin", ".idx"]:
+                shutil.copyfile(prefixes[0] + ext, prefixes[1] + ext)
+
+            cache_dir = os.path.join(dirname, "cache")
+            ds1, ds2 = [
+                MMapIndexedDataset(prefix, shared_cache=cache_dir)
+                for prefix in prefixes
+            ]
+            cached = [
+                f
+                for f in os.listdir(cache_dir)
+                if not os.path.islink(os.path.join(cache_dir, f))
+            ]
+            self.assertEqual(len(cached), 1)
+            self.assertTrue(cached[0].endswith(".idx"))
+            self.assertEqual(
+                SharedFileCache(cache_dir).get(prefixes[1] + ".idx"),
+                os.path.join(cache_dir, cached[0]),
+            )
+
+            ds3 = pickle.loads(pickle.dumps(ds2))
+            self.assertEqual(ds3._shared_cache, cache_dir)
+            np.testing.assert_array_equal(ds1.sizes, [3, 1, 4, 1, 5])
+            for ds in [ds2, ds3]:
+                np.testing.assert_array_equal(ds.sizes, ds1.sizes)
+                for i in range(len(ds1)):
+                    self.assertTrue(torch.equal(ds[i], ds1[i]))
@@ -4,6 +4,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
+import gc
 import math
 import tempfile
 import unittest
@@ -14,6 +15,7 @@ import torch
 import tests.utils as test_utils
 from fairseq import search
 from fairseq.data.dictionary import Dictionary
+from fairseq.encoder_out_cache import EncoderOutCache
 from fairseq.models.transformer import TransformerModel
 from fairseq.ngram_repeat_block import NGramRepeatBlock
 from fairseq.sequence_generator import EnsembleModel, SequenceGenerator
@@ -162,6 +164,101 @@ class TestExportSearch(unittest.TestCase):
         )
         torch.jit.script(search_strategy)
 
+    def test_export_duplicate_aware_beam_search(self):
+        search_strategy = search.DuplicateAwareBeamSearch(self.tgt_dict)
+        torch.jit.script(search_strategy)
+
+
+class TestDuplicateAwareBeamSearch(unittest.TestCase):
+    def setUp(self):
+        self.tgt_dict = Dictionary()
+        self.a = self.tgt_dict.add_symbol("a")
+        self.variants = [self.tgt_dict.add_symbol(f"複複{k}複複a") for k in range(1, 3)]
+        self.b = self.tgt_dict.add_symbol("b")
+        # the variants of "a" add up to more than "b"
+        probs = torch.zeros(len(self.tgt_dict))
+        probs[self.tgt_dict.eos()] = 0.06
+        probs[[self.a] + self.variants] = 0.2
+        probs[self.b] = 0.34
+        self.lprobs = probs.log().view(1, 1, -1).repeat(1, 2, 1)
+
+    def test_merges_variants(self):
+        beam_search = search.BeamSearch(self.tgt_dict)
+        _, indices, _ = beam_search.step(0, self.lprobs.clone(), None)
+        self.assertEqual(indices[0, 0].item(), self.b)
+
+        duplicate_aware = search.DuplicateAwareBeamSearch(self.tgt_dict)
+        scores, indices, _ = duplicate_aware.step(0, self.lprobs.clone(), None)
+        self.assertEqual(
+            indices[scores.ne(-math.inf)].tolist(),
+            [self.a, self.b, self.tgt_dict.eos()],
+        )
+        self.assertAlmostEqual(scores[0, 0].exp().item(), 0.6, places=5)
+
+    def test_without_variants(self):
+        tgt_dict = get_dummy_dictionary()
+        lprobs = torch.randn(2, 3, len(tgt_dict)).log_softmax(-1)
+        scores = torch.randn(2, 3, 1)
+        expected = search.BeamSearch(tgt_dict).step(1, lprobs, scores)
+        results = search.DuplicateAwareBeamSearch(tgt_dict).step(1, lprobs, scores)
+        for result, expected_result in zip(results, expected):
+            self.assertTrue(torch.equal(result, expected_result))
+
+
+class TestFoldDuplicateOutputs(TestJitSequenceGeneratorBase):
+    def setUp(self):
+        super().setUp()
+        torch.manual_seed(0)
+        # duplicate some tokens, before building the model
+        self.tgt_dict = self.task.tgt_dict
+        for k in range(1, 4):
+            for token in range(3, 60, 4):
+                self.tgt_dict.add_symbol(f"複複{k}複複{token}")
+        TransformerModel.add_args(self.parser)
+        args = self.parser.parse_args([])
+        args.encoder_layers = args.decoder_layers = 1
+        self.model = TransformerModel.build_model(args, self.task)
+        self.model.eval()
+
+    def test_same_as_duplicate_aware_beam_search(self):
+        generator = SequenceGenerator(
+            [self.model],
+            self.tgt_dict,
+            beam_size=3,
+            max_len_b=8,
+            search_strategy=search.DuplicateAwareBeamSearch(self.tgt_dict),
+        )
+        expected = generator.forward(self.sample)
+        self.model.make_generation_fast_(fold_duplicate_outputs=True)
+        num_outputs = self.model.decoder.output_ids.numel()
+        self.assertEqual(num_outputs, len(self.tgt_dict) - 45)
+        generator = SequenceGenerator(
+            [self.model], self.tgt_dict, beam_size=3, max_len_b=8
+        )
+        self.assertEqual(generator.vocab_size, num_outputs)
+        hypos = generator.forward(self.sample)
+        for sent_hypos, expected_sent_hypos in zip(hypos, expected):
+            for hypo, expected_hypo in zip(sent_hypos, expected_sent_hypos):
+                self.assertTensorEqual(hypo["tokens"], expected_hypo["tokens"])
+                self.assertAlmostEqual(
+                    hypo["positional_scores"], expected_hypo["positional_scores"]
+                )
+
+    def test_export_folded_sequence_generator(self):
+        self.model.make_generation_fast_(fold_duplicate_outputs=True)
+        generator = SequenceGenerator(
+            [self.model], self.tgt_dict, beam_size=2, max_len_b=10
+        )
+        scripted_model = torch.jit.script(generator)
+        with torch.no_grad():
+            hypos = scripted_model.forward(self.sample)
+        self._test_save_and_load(scripted_model)
+        for sent_hypos, expected_sent_hypos in zip(
+            hypos, generator.forward(self.sample)
+        ):
+            for hypo, expected_hypo in zip(sent_hypos, expected_sent_hypos):
+                self.assertHypoEqual(hypo, expected_hypo)
+
 
 class TestSequenceGeneratorBase(unittest.TestCase):
     def assertHypoTokens(self, hypo, tokens):
@@ -237,6 +334,26 @@ class TestSequenceGenerator(TestSequenceGeneratorBase):
         self.assertHypoTokens(hypos[1][1], [w1, w2, w1, eos])
         self.assertHypoScore(hypos[1][1], [0.7, 0.4, 0.4, 1.0], normalized=False)
 
+    def test_early_stop_nbest(self):
+        # the test model cannot drop sentences from the batch: make both
+        # sentences the same as sentence 1, which stops at the same step
+        args = self.model.decoder.args
+        args.beam_probs = [probs[:2].repeat(2, 1) for probs in args.beam_probs]
+        generator = SequenceGenerator(
+            [self.model],
+            self.tgt_dict,
+            beam_size=2,
+            normalize_scores=False,
+            early_stop_nbest=1,
+        )
+        hypos = generator.forward(self.sample)
+        eos, w1 = self.tgt_dict.eos(), self.w1
+        for sent_hypos in hypos:
+            # w2 w1 (0.1*0.9) cannot beat w1 <eos> (0.9*1.0)
+            self.assertEqual(len(sent_hypos), 1)
+            self.assertHypoTokens(sent_hypos[0], [w1, eos])
+            self.assertHypoScore(sent_hypos[0], [0.9, 1.0], normalized=False)
+
     def test_with_lenpen_favoring_short_hypos(self):
         lenpen = 0.6
         generator = SequenceGenerator(
@@ -326,6 +443,262 @@ class TestSequenceGenerator(TestSequenceGeneratorBase):
         self.assertHypoScore(hypos[0][0], [0.9, 1.0])
 
 
+class TestContinuousBatching(TestJitSequenceGeneratorBase):
+    def setUp(self):
+        super().setUp()
+        torch.manual_seed(0)
+        self.transformer_model.eval()
+        dictionary = self.task.tgt_dict
+        self.samples = []
+        for bsz, src_len in [(3, 7), (2, 12), (4, 5), (1, 9)]:
+            src_lengths = torch.randint(2, src_len + 1, (bsz,))
+            src_lengths[0] = src_len
+            src_tokens = torch.full((bsz, src_len), dictionary.pad())
+            for i, length in enumerate(src_lengths.tolist()):
+                src_tokens[i, src_len - length : -1] = torch.randint(
+                    dictionary.nspecial, len(dictionary), (length - 1,)
+                )
+                src_tokens[i, -1] = dictionary.eos()
+            self.samples.append(
+                {
+                    "id": torch.arange(bsz),
+                    "net_input": {
+                        "src_tokens": src_tokens,
+                        "src_lengths": src_lengths,
+                    },
+                }
+            )
+
+    def assertSameHypos(self, hypos, expected):
+        self.assertEqual(len(hypos), len(expected))
+        for sent_hypos, expected_sent_hypos in zip(hypos, expected):
+            self.assertEqual(len(sent_hypos), len(expected_sent_hypos))
+            for hypo, expected_hypo in zip(sent_hypos, expected_sent_hypos):
+                self.assertTensorEqual(hypo["tokens"], expected_hypo["tokens"])
+                self.assertAlmostEqual(
+                    hypo["positional_scores"], expected_hypo["positional_scores"]
+                )
+                self.assertLess(abs(hypo["score"] - expected_hypo["score"]), 1e-4)
+
+    def _test_same_as_generate(self, max_sentences, **kwargs):
+        generator = SequenceGenerator(
+            [self.transformer_model], self.task.tgt_dict, **kwargs
+        )
+        expected = [generator.generate([], sample) for sample in self.samples]
+        results = list(generator.generate_continuous(self.samples, max_sentences))
+        self.assertEqual(len(results), len(self.samples))
+        for sample, hypos in results:
+            index = next(i for i, s in enumerate(self.samples) if s is sample)
+            self.assertSameHypos(hypos, expected[index])
+
+    def test_same_as_generate(self):
+        self._test_same_as_generate(4, beam_size=2, max_len_b=8)
+
+    def test_same_as_generate_refilling_single_slots(self):
+        self._test_same_as_generate(3, beam_size=3, max_len_a=1, max_len_b=2)
+
+    def test_same_as_generate_with_early_eos(self):
+        # make eos likely, so that sentences finish at different steps
+        with torch.no_grad():
+            weight = self.transformer_model.decoder.output_projection.weight
+            weight[self.task.tgt_dict.eos()] *= 4
+        self._test_same_as_generate(3, beam_size=3, max_len_b=12)
+
+    def test_same_as_generate_with_min_len(self):
+        self._test_same_as_generate(5, beam_size=2, max_len_b=10, min_len=3)
+
+    def test_same_as_generate_with_no_repeat_ngram(self):
+        self._test_same_as_generate(
+            3, beam_size=2, max_len_b=12, no_repeat_ngram_size=2
+        )
+
+    def test_same_as_generate_with_preallocated_kv_cache(self):
+        self._test_same_as_generate(
+            3, beam_size=3, max_len_b=12, preallocate_kv_cache=True
+        )
+
+    def test_preallocate_kv_cache(self):
+        # make eos likely, so that finished sentences are dropped from the batch
+        with torch.no_grad():
+            weight = self.transformer_model.decoder.output_projection.weight
+            weight[self.task.tgt_dict.eos()] *= 4
+        for sample in self.samples:
+            generator = SequenceGenerator(
+                [self.transformer_model], self.task.tgt_dict, beam_size=3
+            )
+            expected = generator.generate([], sample)
+            generator = SequenceGenerator(
+                [self.transformer_model],
+                self.task.tgt_dict,
+                beam_size=3,
+                preallocate_kv_cache=True,
+            )
+            self.assertSameHypos(generator.generate([], sample), expected)
+
+
+class TestBoundEarlyStopping(TestJitSequenceGeneratorBase):
+    def setUp(self):
+        torch.manual_seed(0)
+        super().setUp()
+        self.transformer_model.eval()
+        dictionary = self.task.tgt_dict
+        # make eos likely, so that hypotheses finish at different steps
+        with torch.no_grad():
+            weight = self.transformer_model.decoder.output_projection.weight
+            weight[dictionary.eos()] *= 4
+        bsz, src_len = 8, 6
+        src_tokens = torch.randint(dictionary.nspecial, len(dictionary), (bsz, src_len))
+        src_tokens[:, -1] = dictionary.eos()
+        self.sample = {
+            "net_input": {
+                "src_tokens": src_tokens,
+                "src_lengths": torch.full((bsz,), src_len),
+            }
+        }
+
+    def _test_same_nbest(self, nbest, **kwargs):
+        generator = SequenceGenerator(
+            [self.transformer_model], self.task.tgt_dict, **kwargs
+        )
+        expected = generator.generate([], self.sample)
+        generator = SequenceGenerator(
+            [self.transformer_model],
+            self.task.tgt_dict,
+            early_stop_nbest=nbest,
+            **kwargs,
+        )
+        hypos = generator.generate([], self.sample)
+        for sent_hypos, expected_sent_hypos in zip(hypos, expected):
+            self.assertGreaterEqual(len(sent_hypos), nbest)
+            for hypo, expected_hypo in zip(
+                sent_hypos[:nbest], expected_sent_hypos[:nbest]
+            ):
+                self.assertTensorEqual(hypo["tokens"], expected_hypo["tokens"])
+                self.assertAlmostEqual(hypo["score"], expected_hypo["score"])
+        # the number of sentences stopped before beam_size hypotheses finished
+        return sum(len(sent_hypos) < generator.beam_size for sent_hypos in hypos)
+
+    def test_same_nbest(self):
+        stopped = 0
+        for nbest in [1, 2]:
+            for len_penalty in [0.0, 0.5, 1.0, 2.0]:
+                stopped += self._test_same_nbest(
+                    nbest, beam_size=4, max_len_b=15, len_penalty=len_penalty
+                )
+        self.assertGreater(stopped, 0)
+
+    def test_same_nbest_unnormalized(self):
+        stopped = self._test_same_nbest(
+            1, beam_size=4, max_len_b=15, normalize_scores=False
+        )
+        self.assertGreater(stopped, 0)
+
+    def test_rejects_positive_token_scores(self):
+        with self.assertRaises(ValueError):
+            SequenceGenerator(
+                [self.transformer_model],
+                self.task.tgt_dict,
+                unk_penalty=-1.0,
+                early_stop_nbest=1,
+            )
+
+
+class TestEncoderOutCache(TestJitSequenceGeneratorBase):
+    def setUp(self):
+        torch.manual_seed(0)
+        super().setUp()
+        self.transformer_model.eval()
+        dictionary = self.task.tgt_dict
+        self.sents = [
+            torch.randint(dictionary.nspecial, len(dictionary), (length,))
+            for length in [5, 3, 8, 2, 6, 4, 7, 3]
+        ]
+
+    def _sample(self, ids):
+        dictionary = self.task.tgt_dict
+        src_lengths = torch.tensor([len(self.sents[i]) + 1 for i in ids])
+        src_len = src_lengths.max().item()
+        src_tokens = torch.full((len(ids), src_len), dictionary.pad())
+        for row, i in enumerate(ids):
+            src_tokens[row, src_len - len(self.sents[i]) - 1 : -1] = self.sents[i]
+            src_tokens[row, -1] = dictionary.eos()
+        return {
+            "id": torch.tensor(ids),
+            "net_input": {"src_tokens": src_tokens, "src_lengths": src_lengths},
+        }
+
+    def assertSameHypos(self, hypos, expected):
+        self.assertEqual(len(hypos), len(expected))
+        for sent_hypos, expected_sent_hypos in zip(hypos, expected):
+            self.assertEqual(len(sent_hypos), len(expected_sent_hypos))
+            for hypo, expected_hypo in zip(sent_hypos, expected_sent_hypos):
+                self.assertTensorEqual(hypo["tokens"], expected_hypo["tokens"])
+                self.assertLess(abs(hypo["score"] - expected_hypo["score"]), 1e-4)
+
+    def test_same_as_without_cache(self):
+        cache = EncoderOutCache(2**20)
+        all_ids = list(range(len(self.sents)))
+        for ids, beam_size in [(all_ids, 2), ([6, 1, 3], 3), ([3, 1], 2)]:
+            sample = self._sample(ids)
+            generator = SequenceGenerator(
+                [self.transformer_model], self.task.tgt_dict, beam_size=beam_size
+            )
+            expected = generator.generate([], sample)
+            generator = SequenceGenerator(
+                [self.transformer_model],
+                self.task.tgt_dict,
+                beam_size=beam_size,
+                encoder_out_cache=cache,
+            )
+            self.assertSameHypos(generator.generate([], sample), expected)
+        self.assertEqual(len(cache), len(self.sents))
+        self.assertEqual(cache.misses, len(self.sents))
+        self.assertEqual(cache.hits, 5)
+
+    def test_evicts_least_recently_used(self):
+        cache = EncoderOutCache(2**20)
+        models = [self.transformer_model]
+        for i in [0, 7, 0]:
+            sample = self._sample([i])
+            cache.forward_encoder(models, sample["net_input"], sample["id"])
+        # room for sentence 1 (of the length of 7) only after dropping 7
+        cache.max_bytes = cache.num_bytes
+        sample = self._sample([1])
+        cache.forward_encoder(models, sample["net_input"], sample["id"])
+        self.assertLessEqual(cache.num_bytes, cache.max_bytes)
+        self.assertEqual([key[1] for key in cache.entries], [0, 1])
+
+    def test_checks_src_tokens(self):
+        cache = EncoderOutCache(2**20)
+        models = [self.transformer_model]
+        sample = self._sample([0, 1])
+        cache.forward_encoder(models, sample["net_input"], sample["id"])
+        # another sentence with the id of the first one
+        sample = self._sample([2, 1])
+        sample["id"] = torch.tensor([0, 1])
+        cache.forward_encoder(models, sample["net_input"], sample["id"])
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(cache.misses, 4)
+
+    def test_invalidated_by_new_parameters(self):
+        cache = EncoderOutCache(2**20)
+        model_hash = cache.model_hash(self.transformer_model)
+        self.assertEqual(cache.model_hash(self.transformer_model), model_hash)
+        with torch.no_grad():
+            self.transformer_model.encoder.embed_tokens.weight[4] += 1
+        self.assertNotEqual(cache.model_hash(self.transformer_model), model_hash)
+
+    def test_forgets_freed_models(self):
+        cache = EncoderOutCache(2**20)
+        args = self.parser.parse_args([])
+        model = TransformerModel.build_model(args, self.task)
+        cache.model_hash(model)
+        self.assertEqual(len(cache.hashes), 1)
+        del model
+        gc.collect()
+        self.assertEqual(len(cache.hashes), 0)
+
+
 @unittest.skipUnless(torch.cuda.is_available(), "")
 class TestRepeatNgramBlocking(TestSequenceGeneratorBase):
     @classmethod
@@ -423,6 +796,58 @@ class TestRepeatNgramBlocking(TestSequenceGeneratorBase):
         return cuda_ext_result, baseline_result
 
 
+class TestRepeatNgramBlockingNoExtension(TestSequenceGeneratorBase):
+    def _block(self, tokens, lprobs, step, ngram_size):
+        """Reference implementation of the cuda kernel."""
+        lprobs = lprobs.clone()
+        for row, hypo in enumerate(tokens.tolist()):
+            current = hypo[step - ngram_size + 2 : step + 1]
+            for i in range(step - ngram_size + 2):
+                if hypo[i : i + ngram_size - 1] == current:
+                    lprobs[row, hypo[i + ngram_size - 1]] = -math.inf
+        return lprobs
+
+    def test_finds_repetitive_tokens(self):
+        bsz, vocab_size, beam_size, step = 2, 4, 1, 3
+        generated_tok = torch.tensor([[2, 2, 2, 2], [3, 3, 3, 3]])
+        lprobs = torch.zeros((beam_size * bsz, vocab_size))
+        blocker = NGramRepeatBlock(2, use_extension=False)
+        self.assertTensorEqual(
+            blocker(generated_tok, lprobs, bsz, beam_size, step),
+            lprobs.new_tensor([[0.0, 0.0, -math.inf, 0.0], [0.0, 0.0, 0.0, -math.inf]]),
+        )
+
+    def test_same_as_cuda_kernel(self):
+        vocab_size, max_len = 5, 12
+        rng = np.random.RandomState(0)
+        for ngram_size in [1, 2, 3, 4]:
+            blocker = NGramRepeatBlock(ngram_size, use_extension=False)
+            for step in range(max_len):
+                bsz, beam_size = rng.randint(1, 4), rng.randint(1, 4)
+                # the generator passes the whole buffer, padded beyond step
+                generated_tok = torch.from_numpy(
+                    rng.randint(0, vocab_size, size=(bsz * beam_size, max_len + 2))
+                )
+                generated_tok[:, step + 1 :] = 1
+                lprobs = torch.rand((bsz * beam_size, vocab_size))
+                self.assertTensorEqual(
+                    blocker(generated_tok, lprobs.clone(), bsz, beam_size, step),
+                    self._block(generated_tok, lprobs, step, ngram_size),
+                )
+
+    @unittest.skipIf(torch.__version__ < "1.6.0", JIT_MSG)
+    def test_jit(self):
+        bsz, vocab_size, beam_size, step = 2, 6, 2, 5
+        generated_tok = torch.randint(0, vocab_size, (bsz * beam_size, step + 1))
+        lprobs = torch.rand((bsz * beam_size, vocab_size))
+        blocker = NGramRepeatBlock(2, use_extension=False)
+        scripted_blocker = torch.jit.script(blocker)
+        self.assertTensorEqual(
+            blocker(generated_tok, lprobs.clone(), bsz, beam_size, step),
+            scripted_blocker(generated_tok, lprobs.clone(), bsz, beam_size, step),
+        )
+
+
 class TestDiverseBeamSearch(TestSequenceGeneratorBase):
     def setUp(self):
         # construct dummy dictionary